@@ -1,5 +1,6 @@
 import os
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, send_file, Response,
+                   stream_with_context)
 import json
 import smtplib
 from email.mime.text import MIMEText
@@ -9,10 +10,19 @@ from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
 import uuid
 import io
+import time
 
-# Import MongoDB instead of SQLAlchemy
-from mongo_database import mongo, init_mongo_db, Patient, Diagnosis, Stats, fs
-from model import dr_system
+from storage import init_storage, decode_feature_rows
+from metrics import metrics, instrument_storage
+from profiling import init_profiling
+from model_registry import init_model_registry
+from spool import init_spool
+from reports import init_reports
+from image_hash import init_image_index, phash_file
+from explain import explain_image, render_heatmap, render_overlay
+from responses import init_responses
+from export import FORMATS, DEFAULT_BATCH_SIZE, export_chunks, export_filename, parse_date
+from model import AdvancedDRSystem, CLASSES
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_key_retina_ai_2026' # Change in production
@@ -24,8 +34,40 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SESSION_PERMANENT'] = False
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 
-# Initialize MongoDB
-init_mongo_db(app)
+# Storage backend: 'mongo' (default) or 'sqlite' for single-clinic deployments and tests
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'mongo')
+app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/retina_ai')
+app.config['SQLITE_PATH'] = os.environ.get('SQLITE_PATH', os.path.join('instance', 'retina_ai.sqlite3'))
+
+# Metrics: set METRICS_ENABLED=0 to turn instrumentation off
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+metrics.enabled = app.config['METRICS_ENABLED']
+
+# orjson JSON provider, gzip/brotli for large JSON responses, fingerprinted /assets/ (build_assets.py)
+responses = init_responses(app)
+
+# Initialize storage
+storage = init_storage(app)
+if metrics.enabled:
+    instrument_storage(storage)
+
+# On-demand profiling (PROFILING_ENABLED/PROFILING_TOKEN) and slow-request log (SLOW_REQUEST_MS)
+profiler = init_profiling(app)
+
+# Serving model, built here rather than on import so the offline scripts can use model.py
+dr_system = AdvancedDRSystem()
+
+# Model hot reload (MODEL_RELOAD_INTERVAL) and shadow scoring; admin endpoints need ADMIN_TOKEN
+model_registry = init_model_registry(app, dr_system)
+
+# Write-behind persistence for /analyze (WRITE_BEHIND=1); replays any unflushed spool
+spool = init_spool(app, storage)
+
+# PDF reports: background render pool + on-disk cache (REPORT_DIR, REPORT_CACHE_MB)
+reports = init_reports(app, storage, CLASSES)
+
+# Perceptual-hash near-duplicate index, rebuilt from storage in the background (IMAGE_INDEX_ENABLED)
+image_index = init_image_index(app, storage)
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -39,7 +81,22 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# --- ROUTES (Updated for MongoDB) ---
+# --- METRICS HOOKS ---
+@app.before_request
+def start_request_timer():
+    request.start_time = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if metrics.enabled and request.endpoint != 'metrics_endpoint':
+        endpoint = request.endpoint or 'unknown'
+        metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+        start = getattr(request, 'start_time', None)
+        if start is not None:
+            metrics.observe('http_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+    return response
+
+# --- ROUTES ---
 @app.route('/')
 def home():
     """Render the main page"""
@@ -104,6 +161,8 @@ def analyze():
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
+    
+    metrics.inc('analyze_requests_total')
         
     try:
         # Extract Patient Data
@@ -118,26 +177,31 @@ def analyze():
         
         print(f"📋 Patient Details: {patient_details}")
 
-        # Check if patient already exists
-        existing_patient = Patient.find_by_mobile(patient_details['mobile'])
-        print(f"🔍 Existing patient check: {existing_patient}")
-        
-        if existing_patient:
-            # Update existing patient info
-            update_data = {
-                'name': patient_details['name'],
-                'age': int(patient_details['age']) if patient_details['age'].isdigit() else 0,
-                'email': patient_details['email'],
-                'gender': patient_details['gender'],
-                'diabetes_duration': int(patient_details['diabetes_duration']) if patient_details['diabetes_duration'].isdigit() else 0
-            }
-            Patient.update(existing_patient['patient_id'], update_data)
-            patient_id = existing_patient['patient_id']
-            print(f"📝 Updating existing patient: {patient_id}")
+        if spool:
+            # Write-behind: the upsert is spooled ahead of the diagnosis, the id comes from the spool's cache
+            patient_id = spool.upsert_patient(patient_details)
+            print(f"📮 Patient upsert spooled: {patient_id}")
         else:
-            # Create new patient
-            patient_id = Patient.create(patient_details)
-            print(f"➕ Creating new patient: {patient_id}")
+            # Check if patient already exists
+            existing_patient = storage.patients.find_by_mobile(patient_details['mobile'])
+            print(f"🔍 Existing patient check: {existing_patient}")
+            
+            if existing_patient:
+                # Update existing patient info
+                update_data = {
+                    'name': patient_details['name'],
+                    'age': int(patient_details['age']) if patient_details['age'].isdigit() else 0,
+                    'email': patient_details['email'],
+                    'gender': patient_details['gender'],
+                    'diabetes_duration': int(patient_details['diabetes_duration']) if patient_details['diabetes_duration'].isdigit() else 0
+                }
+                storage.patients.update(existing_patient['patient_id'], update_data)
+                patient_id = existing_patient['patient_id']
+                print(f"📝 Updating existing patient: {patient_id}")
+            else:
+                # Create new patient
+                patient_id = storage.patients.create(patient_details)
+                print(f"➕ Creating new patient: {patient_id}")
 
         # Save file temporarily for analysis
         temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
@@ -157,35 +221,56 @@ def analyze():
         
         print(f"✅ Analysis complete: {result['class']}")
         
+        # Feature vector is stored with the diagnosis, not returned to the client
+        features = result.pop('features', None)
+        model_registry.shadow.submit(features, result)
+        
+        # Perceptual hash for near-duplicate lookup (a bad hash never fails the analysis)
+        try:
+            image_phash = phash_file(temp_filepath)
+        except Exception as e:
+            print(f"⚠️ Could not hash {file.filename}: {e}")
+            image_phash = None
+        
         # Reset file pointer for GridFS storage
         file.seek(0)
         
         # Add patient mobile to result for embedding
         result['patient_mobile'] = patient_details['mobile']
         
-        # Save diagnosis to MongoDB with image in GridFS
-        diagnosis_id = Diagnosis.create(
+        # Save diagnosis with its image (spooled and flushed in the background with write-behind)
+        save = spool.append if spool else storage.diagnoses.create
+        diagnosis_id = save(
             patient_id=patient_id,
             analysis_result=result,
             image_file=file,
-            notes="Automated Analysis"
+            notes="Automated Analysis",
+            features=features,
+            image_phash=image_phash
         )
         
+        near_duplicates = []
+        if image_index and image_phash is not None:
+            near_duplicates = image_index.query(image_phash, app.config['DUPLICATE_MAX_DISTANCE'], limit=5)
+            image_index.add(diagnosis_id, patient_id, image_phash)
+        
         # Clean up temp file
         if os.path.exists(temp_filepath):
             os.remove(temp_filepath)
         
-        print(f"💾 Diagnosis saved to MongoDB with ID: {diagnosis_id}")
+        print(f"💾 Diagnosis {'spooled' if spool else 'saved'} ({storage.name}) with ID: {diagnosis_id}")
         
         return jsonify({
             'success': True,
             'data': result,
             'patient_id': patient_id,
-            'diagnosis_id': diagnosis_id
+            'diagnosis_id': diagnosis_id,
+            'near_duplicates': near_duplicates
         })
         
     except Exception as e:
         print(f"🔥 ERROR in /analyze: {str(e)}")
+        metrics.inc('errors_total', type=type(e).__name__)
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
@@ -200,13 +285,13 @@ def get_history():
         skip = (page - 1) * limit
         
         # Get all diagnoses
-        diagnoses = Diagnosis.get_all(limit=limit, skip=skip)
+        diagnoses = storage.diagnoses.get_all(limit=limit, skip=skip)
         
         # Convert to dictionary format
-        diagnoses_list = [Diagnosis.to_dict(d) for d in diagnoses]
+        diagnoses_list = [storage.diagnoses.to_dict(d) for d in diagnoses]
         
         # Get total count for pagination
-        total_count = mongo.db.diagnoses.count_documents({})
+        total_count = storage.diagnoses.count()
         
         return jsonify({
             'data': diagnoses_list,
@@ -224,19 +309,39 @@ def get_history():
 def get_diagnosis(diagnosis_id):
     """Get diagnosis details by ID"""
     try:
-        diagnosis = Diagnosis.get_by_id(diagnosis_id)
+        diagnosis = storage.diagnoses.get_by_id(diagnosis_id)
         if diagnosis:
-            return jsonify(Diagnosis.to_dict(diagnosis))
+            return jsonify(storage.diagnoses.to_dict(diagnosis))
         return jsonify({'error': 'Diagnosis not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/diagnosis/<diagnosis_id>/confirm', methods=['POST'])
+@login_required
+def confirm_diagnosis(diagnosis_id):
+    """Record the clinician-confirmed grade (used by incremental training)"""
+    data = request.get_json(silent=True) or request.form
+    value = data.get('class', data.get('severity_index'))
+    if isinstance(value, str) and value in CLASSES:
+        confirmed_class = CLASSES.index(value)
+    elif str(value).isdigit() and int(value) < len(CLASSES):
+        confirmed_class = int(value)
+    else:
+        return jsonify({'error': f"class must be one of {CLASSES} or 0-{len(CLASSES) - 1}"}), 400
+    try:
+        if not storage.diagnoses.confirm(diagnosis_id, confirmed_class, confirmed_by=session.get('user')):
+            return jsonify({'error': 'Diagnosis not found'}), 404
+        print(f"🩺 Diagnosis {diagnosis_id} confirmed as {CLASSES[confirmed_class]}")
+        return jsonify({'success': True, 'confirmed_class': confirmed_class})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/diagnosis/image/<diagnosis_id>')
 @login_required
 def get_diagnosis_image(diagnosis_id):
-    """Serve image from GridFS"""
+    """Serve the stored diagnosis image"""
     try:
-        image_file = Diagnosis.get_image(diagnosis_id)
+        image_file = storage.diagnoses.get_image(diagnosis_id)
         if image_file:
             # Determine content type
             content_type = image_file.content_type or 'image/jpeg'
@@ -252,11 +357,61 @@ def get_diagnosis_image(diagnosis_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def _duplicate_args():
+    """max_distance/limit/patient_id query parameters shared by the duplicate lookups"""
+    max_distance = request.args.get('max_distance', app.config['DUPLICATE_MAX_DISTANCE'], type=int)
+    limit = request.args.get('limit', 20, type=int)
+    if max_distance is None or not 0 <= max_distance <= 16 or limit is None or limit < 1:
+        raise ValueError('max_distance must be 0-16 and limit a positive integer')
+    return max_distance, limit, request.args.get('patient_id') or None
+
+@app.route('/diagnosis/<diagnosis_id>/duplicates')
+@login_required
+def get_diagnosis_duplicates(diagnosis_id):
+    """Stored images that look like this diagnosis' image (?patient_id= for the same patient only)"""
+    if not image_index:
+        return jsonify({'error': 'Near-duplicate index is disabled'}), 404
+    try:
+        max_distance, limit, patient_id = _duplicate_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        diagnosis = storage.diagnoses.get_by_id(diagnosis_id)
+        if not diagnosis:
+            return jsonify({'error': 'Diagnosis not found'}), 404
+        image_phash = diagnosis.get('image_phash')
+        if image_phash is None:
+            return jsonify({'error': 'Diagnosis has no image hash (run image_hash.py --backfill)'}), 409
+        matches = image_index.query(image_phash, max_distance, limit, patient_id, exclude=str(diagnosis_id))
+        return jsonify({'diagnosis_id': diagnosis_id, 'ready': image_index.ready, 'duplicates': matches})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/duplicates', methods=['POST'])
+@login_required
+def find_duplicates():
+    """Stored images that look like an uploaded one, without analysing or storing it"""
+    if not image_index:
+        return jsonify({'error': 'Near-duplicate index is disabled'}), 404
+    if 'file' not in request.files or request.files['file'].filename == '':
+        return jsonify({'error': 'No file part'}), 400
+    try:
+        max_distance, limit, patient_id = _duplicate_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        image_phash = phash_file(request.files['file'].stream)
+    except Exception as e:
+        return jsonify({'error': f"Could not read image: {e}"}), 400
+    matches = image_index.query(image_phash, max_distance, limit, patient_id)
+    return jsonify({'image_phash': f"{image_phash & 0xFFFFFFFFFFFFFFFF:016x}", 'ready': image_index.ready,
+                    'duplicates': matches})
+
 @app.route('/check_mobile/<mobile>')
 @login_required
 def check_mobile(mobile):
     try:
-        exists = Patient.find_by_mobile(mobile) is not None
+        exists = storage.patients.find_by_mobile(mobile) is not None
         return jsonify({'exists': exists})
     except Exception as e:
         print(f"Error checking mobile: {e}")
@@ -266,10 +421,10 @@ def check_mobile(mobile):
 @login_required
 def get_patient(patient_id):
     try:
-        patient = mongo.db.patients.find_one({'patient_id': patient_id})
+        patient = storage.patients.find_by_id(patient_id)
         if patient:
             # Get patient's diagnoses count
-            diagnoses_count = mongo.db.diagnoses.count_documents({'patient_id': patient_id})
+            diagnoses_count = storage.diagnoses.count(patient_id)
             
             return jsonify({
                 'id': patient['patient_id'],
@@ -286,11 +441,26 @@ def get_patient(patient_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/patient/<patient_id>/trend')
+@login_required
+def get_patient_trend(patient_id):
+    """Severity/risk over time for charting; ?max_points=N buckets long histories server-side"""
+    max_points = request.args.get('max_points', type=int)
+    if max_points is not None and max_points < 1:
+        return jsonify({'error': 'max_points must be a positive integer'}), 400
+    try:
+        trend = storage.diagnoses.trend(patient_id, max_points)
+        return jsonify({'patient_id': patient_id, **trend})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/delete_diagnosis/<diagnosis_id>', methods=['DELETE'])
 @login_required
 def delete_diagnosis(diagnosis_id):
     try:
-        Diagnosis.delete(diagnosis_id)
+        storage.diagnoses.delete(diagnosis_id)
+        if image_index:
+            image_index.remove(diagnosis_id)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -299,16 +469,158 @@ def delete_diagnosis(diagnosis_id):
 @login_required
 def delete_patient(patient_id):
     try:
-        Patient.delete(patient_id)
+        storage.patients.delete(patient_id)
+        if image_index:
+            image_index.remove_patient(patient_id)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/diagnosis/<diagnosis_id>/report')
+@login_required
+def get_diagnosis_report(diagnosis_id):
+    """PDF report; 202 + Retry-After while it renders in the background, 500 if rendering just failed"""
+    try:
+        status, detail = reports.get(diagnosis_id)
+        if status == 'missing':
+            return jsonify({'error': 'Diagnosis not found'}), 404
+        if status == 'rendering':
+            return jsonify({'status': 'rendering'}), 202, {'Retry-After': '1'}
+        if status == 'failed':
+            return jsonify({'status': 'failed', 'error': detail}), 500
+        return send_file(detail, mimetype='application/pdf', as_attachment=True,
+                         download_name=f"report-{diagnosis_id}.pdf")
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/diagnosis/<diagnosis_id>/heatmap')
+@login_required
+def get_diagnosis_heatmap(diagnosis_id):
+    """
+    Per-region attribution of the stored grade as a transparent overlay PNG
+    for the diagnosis image (?composite=1: blended into it, ?format=json: the
+    values, ?class=: explain another grade)
+    """
+    explainer = dr_system.explainer
+    if explainer is None:
+        return jsonify({'error': 'Heatmaps need a gradient-boosted model'}), 501
+    target = request.args.get('class')
+    if target is not None:
+        target = CLASSES.index(target) if target in CLASSES else int(target) if target.isdigit() else -1
+        if target not in explainer.classes:
+            return jsonify({'error': f"class must be one of {CLASSES} or 0-{len(CLASSES) - 1}"}), 400
+    try:
+        diagnosis = storage.diagnoses.get_by_id(diagnosis_id)
+        if not diagnosis:
+            return jsonify({'error': 'Diagnosis not found'}), 404
+        # Explain the grade the record shows, even if the current model would pick another
+        if target is None and diagnosis.get('severity_index') in explainer.classes:
+            target = diagnosis['severity_index']
+        image_file = storage.diagnoses.get_image(diagnosis_id)
+        if not image_file:
+            return jsonify({'error': 'Image not found'}), 404
+        # Stored vectors from an older extractor are re-extracted from the image
+        features = None
+        if diagnosis.get('features') and diagnosis.get('feature_version') == dr_system.extractor.feature_version:
+            features = decode_feature_rows([bytes(diagnosis['features'])])[0]
+        attribution, img = explain_image(explainer, dr_system.extractor, image_file, features, target)
+        attribution['class'] = CLASSES[attribution['class_index']]
+        if request.args.get('format') == 'json':
+            return jsonify({'diagnosis_id': diagnosis_id, **attribution})
+        with metrics.timer('explain_seconds', stage='render'):
+            if request.args.get('composite', '0').lower() in ('1', 'true', 'yes'):
+                png = render_heatmap(img, attribution['cells'])
+            else:
+                png = render_overlay(img.size, attribution['cells'])
+        return Response(png, mimetype='image/png', headers={'X-Explained-Class': attribution['class']})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/reports/bundle', methods=['POST'])
+@login_required
+def create_report_bundle():
+    """Zip all reports of a patient ({"patient_id"}) or a camp ({"from", "to"}) in the background"""
+    data = request.get_json(silent=True) or {}
+    try:
+        if data.get('patient_id'):
+            name = data['patient_id']
+            ids = [str(d['_id']) for d in storage.diagnoses.get_by_patient(name)]
+        elif data.get('from'):
+            since, until = parse_date(data['from']), parse_date(data.get('to') or data['from'], end=True)
+            name = f"{since:%Y%m%d}-{until:%Y%m%d}"
+            ids = [row['id'] for batch in storage.diagnoses.iter_export(since, until) for row in batch]
+        else:
+            return jsonify({'error': 'Give a patient_id or a from/to date range'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not ids:
+        return jsonify({'error': 'No diagnoses match'}), 404
+    if len(ids) > app.config['REPORT_BUNDLE_MAX']:
+        return jsonify({'error': f"{len(ids)} reports requested; the limit is {app.config['REPORT_BUNDLE_MAX']}"}), 400
+
+    job_id = reports.submit_bundle(ids, name)
+    return jsonify({
+        'job_id': job_id,
+        'total': len(ids),
+        'status_url': url_for('get_report_bundle', job_id=job_id),
+        'download_url': url_for('download_report_bundle', job_id=job_id)
+    }), 202
+
+@app.route('/reports/jobs/<job_id>')
+@login_required
+def get_report_bundle(job_id):
+    status = reports.job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(status)
+
+@app.route('/reports/jobs/<job_id>/download')
+@login_required
+def download_report_bundle(job_id):
+    status = reports.job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if status['status'] != 'done':
+        return jsonify(status), 409
+    return send_file(reports.job_zip(job_id), mimetype='application/zip', as_attachment=True,
+                     download_name=status['filename'])
+
+@app.route('/export')
+@login_required
+def export_diagnoses():
+    """Stream diagnoses as NDJSON/CSV/Parquet (?format=&from=&to=&class=&batch_size=&gzip=1)"""
+    fmt = request.args.get('format', 'ndjson')
+    compress = request.args.get('gzip', '0').lower() in ('1', 'true', 'yes')
+    diagnosis_class = request.args.get('class') or None
+    if diagnosis_class and diagnosis_class not in CLASSES:
+        return jsonify({'error': f"Unknown class '{diagnosis_class}'"}), 400
+    try:
+        chunks = export_chunks(
+            storage.diagnoses, fmt,
+            since=parse_date(request.args.get('from')),
+            until=parse_date(request.args.get('to'), end=True),
+            diagnosis_class=diagnosis_class,
+            batch_size=request.args.get('batch_size', DEFAULT_BATCH_SIZE, type=int),
+            compress=compress
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except ImportError:
+        return jsonify({'error': 'Parquet export needs pyarrow (pip install pyarrow)'}), 501
+
+    mimetype = 'application/gzip' if compress else FORMATS[fmt][0]
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(fmt, compress)}"',
+        'X-Accel-Buffering': 'no',  # let nginx pass chunks through as they are produced
+    })
+
 @app.route('/stats')
 @login_required
 def get_stats():
     try:
-        stats = Stats.get_dashboard_stats()
+        stats = storage.stats.get_dashboard_stats()
         return jsonify(stats)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -319,28 +631,12 @@ def search():
     query = request.args.get('q', '')
     try:
         # Search patients by name, mobile, or patient_id
-        pipeline = [
-            {
-                '$match': {
-                    '$or': [
-                        {'name': {'$regex': query, '$options': 'i'}},
-                        {'mobile': {'$regex': query, '$options': 'i'}},
-                        {'patient_id': {'$regex': query, '$options': 'i'}}
-                    ]
-                }
-            },
-            {'$limit': 20}
-        ]
-        
-        patients = list(mongo.db.patients.aggregate(pipeline))
+        patients = storage.patients.search(query, limit=20)
         
         results = []
         for patient in patients:
             # Get latest diagnosis for each patient
-            latest_diagnosis = mongo.db.diagnoses.find_one(
-                {'patient_id': patient['patient_id']},
-                sort=[('date', -1)]
-            )
+            latest_diagnosis = storage.diagnoses.get_latest(patient['patient_id'])
             
             results.append({
                 'patient_id': patient['patient_id'],
@@ -355,5 +651,12 @@ def search():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return app.response_class(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(debug=True, port=3000)
\ No newline at end of file
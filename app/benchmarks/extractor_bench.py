@@ -0,0 +1,156 @@
+# benchmarks/extractor_bench.py
+"""
+Throughput and memory of the feature extractors on CPU.
+
+Each configuration runs in a fresh worker process (spawned, so TensorFlow
+state and thread pools never leak between runs). The worker builds the
+extractor, warms it up, then extracts --images synthetic fundus images at
+every --batch-sizes value. It reports images/sec plus the process's
+resident memory after the model is loaded and its peak - i.e. memory per
+serving worker.
+
+    python -m benchmarks.extractor_bench
+    python -m benchmarks.extractor_bench --configs stats,densenet121,vgg16 --batch-sizes 1,8,32 \\
+        --threads 4 --tflite densenet121_int8.tflite --onnx densenet121.onnx
+
+Deep backbones use random weights (no download) - throughput does not
+depend on the weight values. Configurations whose dependencies are missing
+are reported as skipped.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+
+def rss_mb():
+    """Current resident set size of this process in MB"""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 / 1e6  # KiB on Linux
+
+
+def run_config(config, batch_sizes, n_images, image_size, threads):
+    """Worker process body: returns the result dict for one configuration"""
+    os.environ['TF_INTRA_OP_THREADS'] = str(threads)
+    os.environ['TF_INTER_OP_THREADS'] = '1' if threads else '0'
+    from benchmarks.synthetic import make_fundus_image
+
+    images = [make_fundus_image(image_size, severity=i % 5, seed=i) for i in range(n_images)]
+    for img in images:
+        img.load()
+    baseline_mb = rss_mb()
+
+    name, runtime, graph = config['name'], config.get('runtime', 'keras'), config.get('graph')
+    try:
+        if name == 'stats':
+            with contextlib.redirect_stdout(io.StringIO()):  # model import prints its banner
+                from model import RetinaFeatureExtractor
+            extractor = RetinaFeatureExtractor()
+            run = lambda batch: [extractor.extract(img) for img in batch]  # noqa: E731
+        else:
+            from deep_features import DeepFeatureExtractor
+            extractor = DeepFeatureExtractor(name, runtime=runtime, graph_path=graph,
+                                             intra_op_threads=threads, inter_op_threads=1 if threads else 0)
+    except (ImportError, ValueError, OSError) as e:
+        return {'config': config['label'], 'skipped': str(e)}
+
+    result = {'config': config['label'], 'batches': {}}
+    for batch_size in batch_sizes:
+        if name != 'stats':
+            extractor.set_batch_size(batch_size)
+            run = extractor.extract_batch
+        run(images[:batch_size])  # warm-up / graph build
+        if 'model_rss_mb' not in result:
+            result['model_rss_mb'] = round(rss_mb() - baseline_mb, 1)
+
+        start = time.perf_counter()
+        for i in range(0, n_images, batch_size):
+            run(images[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        result['batches'][batch_size] = {
+            'images_per_sec': round(n_images / elapsed, 2),
+            'ms_per_image': round(elapsed / n_images * 1000, 3),
+        }
+    result['rss_mb'] = round(rss_mb(), 1)
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+def _worker(queue, *args):
+    try:
+        queue.put(run_config(*args))
+    except ImportError as e:  # the deep extractor imports its runtime on first use
+        queue.put({'config': args[0]['label'], 'skipped': str(e)})
+    except Exception as e:
+        queue.put({'config': args[0]['label'], 'error': f"{type(e).__name__}: {e}"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Feature extractor throughput and memory per worker")
+    parser.add_argument('--configs', default='stats,densenet121,vgg16')
+    parser.add_argument('--batch-sizes', default='1,8,32')
+    parser.add_argument('--images', type=int, default=64)
+    parser.add_argument('--image-size', type=int, default=1024, help="Synthetic image side in pixels")
+    parser.add_argument('--threads', type=int, default=0, help="Intra-op threads (0 = all cores)")
+    parser.add_argument('--tflite', default=None, help="Also benchmark this int8 TFLite graph")
+    parser.add_argument('--onnx', default=None, help="Also benchmark this ONNX graph")
+    parser.add_argument('--out', default=None, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    configs = [{'name': c, 'label': c} for c in args.configs.split(',') if c]
+    backbone = next((c['name'] for c in configs if c['name'] != 'stats'), 'densenet121')
+    if args.tflite:
+        configs.append({'name': backbone, 'label': f"{backbone}-int8-tflite", 'runtime': 'tflite',
+                        'graph': args.tflite})
+    if args.onnx:
+        configs.append({'name': backbone, 'label': f"{backbone}-onnx", 'runtime': 'onnx', 'graph': args.onnx})
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',') if b]
+
+    report = {
+        'machine': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'images': args.images,
+        'image_size': args.image_size,
+        'threads': args.threads,
+        'results': [],
+    }
+    ctx = multiprocessing.get_context('spawn')
+    for config in configs:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_worker, args=(queue, config, batch_sizes, args.images, args.image_size,
+                                                 args.threads))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        report['results'].append(result)
+
+        if 'batches' in result:
+            for batch_size, stats in result['batches'].items():
+                print(f"{config['label']:<26} batch {batch_size:>3}  {stats['images_per_sec']:>9.1f} img/s  "
+                      f"{stats['ms_per_image']:>8.2f} ms/img", file=sys.stderr)
+            print(f"{config['label']:<26} model +{result['model_rss_mb']} MB, worker RSS {result['rss_mb']} MB "
+                  f"(peak {result['peak_rss_mb']} MB)", file=sys.stderr)
+        else:
+            print(f"{config['label']:<26} {result.get('skipped') or result.get('error')}", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# benchmarks/hash_index_bench.py
+"""
+Near-duplicate index benchmark: build time and query latency at scale.
+
+Fills a HammingIndex with N random 64-bit hashes (the same bulk path as the
+startup rebuild: add_many(merge=False) + flush), plants a near-duplicate of
+every query hash a few bits away, then times query() and reports
+p50/p95/p99 latency, recall of the planted duplicates and the mean number
+of candidates checked. pHash timing on a synthetic fundus JPEG is included
+for context.
+
+    python -m benchmarks.hash_index_bench --size 1000000 --queries 2000
+"""
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+
+from image_hash import DEFAULT_MAX_DISTANCE, HammingIndex, phash_file
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 4)
+
+
+def _flip(hashes, bits, rng):
+    """Copies of hashes with `bits` random bits flipped"""
+    out = hashes.view(np.uint64).copy()
+    for i in range(len(out)):
+        for b in rng.choice(64, bits, replace=False):
+            out[i] ^= np.uint64(1) << np.uint64(b)
+    return out.view(np.int64)
+
+
+def run(size=1_000_000, queries=2000, max_distance=DEFAULT_MAX_DISTANCE, flip_bits=4, seed=0):
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, size, dtype=np.int64, endpoint=True)
+    probes = hashes[rng.choice(size, queries, replace=False)]
+    planted = _flip(probes, flip_bits, rng)
+
+    index = HammingIndex()
+    start = time.perf_counter()
+    batch = 50000
+    for lo in range(0, size, batch):
+        ids = [f"d{i}" for i in range(lo, min(lo + batch, size))]
+        index.add_many(ids, [f"p{i % 100000}" for i in range(lo, min(lo + batch, size))], hashes[lo:lo + batch],
+                       merge=False)
+    index.flush()
+    build = time.perf_counter() - start
+    # Planted near-duplicates arrive one by one, as they would from /analyze
+    for i, h in enumerate(planted):
+        index.add(f"q{i}", 'planted', h)
+    index.flush()
+
+    latencies, candidates, found = [], [], 0
+    for i, h in enumerate(probes):
+        t = time.perf_counter()
+        matches = index.query(h, max_distance, limit=20)
+        latencies.append(time.perf_counter() - t)
+        candidates.append(index._segment.search(np.int64(h).view(np.uint64), index._masks[max_distance // 4],
+                                                max_distance)[2])
+        found += any(m['diagnosis_id'] == f"q{i}" for m in matches)
+
+    from benchmarks.synthetic import make_fundus_jpeg
+    jpeg = make_fundus_jpeg(3000, severity=2, seed=1)
+    phash_file(io.BytesIO(jpeg))
+    t = time.perf_counter()
+    for _ in range(10):
+        phash_file(io.BytesIO(jpeg))
+    phash_ms = (time.perf_counter() - t) / 10 * 1000
+
+    return {
+        'size': len(index),
+        'queries': queries,
+        'max_distance': max_distance,
+        'build_seconds': round(build, 2),
+        'query_ms': {'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95),
+                     'p99': _percentile(latencies, 99), 'max': _percentile(latencies, 100)},
+        'mean_candidates': round(float(np.mean(candidates)), 1),
+        'recall': round(found / queries, 4),
+        'phash_ms_3000px_jpeg': round(phash_ms, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the perceptual-hash near-duplicate index")
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument('--flip-bits', type=int, default=4, help="Distance of the planted near-duplicates")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.size, args.queries, args.max_distance, args.flip_bits, args.seed), indent=2))
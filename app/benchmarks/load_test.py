@@ -0,0 +1,233 @@
+# benchmarks/load_test.py
+"""
+Reproducible in-process load test for the Flask service.
+
+The app is imported with a throwaway storage backend (mongomock by
+default, or SQLite / a real local mongod) and driven through Flask test
+clients from a thread pool, so no server or network is involved. A seed
+phase uploads synthetic fundus images through /analyze; the measured phase
+then hits each endpoint at the configured concurrency.
+
+The JSON report records throughput and p50/p95/p99 latency per endpoint
+along with the git commit and workload parameters, so runs from different
+commits can be compared with --compare.
+
+Usage (from app/):
+    python -m benchmarks.load_test [--backend mongomock|sqlite|mongo]
+        [--concurrency 8] [--requests 200] [--seed-images 50]
+        [--image-size 640] [--out report.json] [--compare old_report.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ENDPOINTS = ('analyze', 'history', 'search', 'stats', 'diagnosis_image')
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def configure_backend(args):
+    """Point the app at a throwaway store before it is imported; returns a temp dir to clean up, if any"""
+    if args.backend == 'mongomock':
+        os.environ['STORAGE_BACKEND'] = 'mongo'
+        os.environ['MONGO_URI'] = 'mongomock://localhost/retina_ai_loadtest'
+    elif args.backend == 'sqlite':
+        os.environ['STORAGE_BACKEND'] = 'sqlite'
+        # A real WAL-mode file, as in production: concurrent writers wait on busy_timeout
+        tmp = tempfile.TemporaryDirectory(prefix='retina_loadtest_')
+        os.environ['SQLITE_PATH'] = os.path.join(tmp.name, 'loadtest.sqlite3')
+        return tmp
+    else:
+        os.environ['STORAGE_BACKEND'] = 'mongo'
+        os.environ['MONGO_URI'] = args.mongo_uri
+    return None
+
+
+class LoadTester:
+    def __init__(self, flask_app, images, concurrency):
+        self.app = flask_app
+        self.images = images
+        self.concurrency = concurrency
+        self._local = threading.local()
+        self._counter = 0
+        self._counter_lock = threading.Lock()
+        self.patient_queries = []
+        self.diagnosis_ids = []
+
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self.app.test_client()
+            client.post('/login', json={'login_id': 'loadtest'})
+            self._local.client = client
+        return client
+
+    def _next(self):
+        with self._counter_lock:
+            self._counter += 1
+            return self._counter
+
+    def analyze(self, i):
+        n = self._next()
+        data = {
+            'file': (io.BytesIO(self.images[n % len(self.images)]), f"load_{n}.jpg"),
+            'name': f"Load Patient {n}",
+            'age': str(30 + n % 50),
+            'mobile': f"8{n:09d}",
+            'gender': 'F' if n % 2 else 'M',
+            'diabetes_duration': str(n % 20),
+        }
+        response = self.client().post('/analyze', data=data, content_type='multipart/form-data')
+        if response.status_code == 200:
+            body = response.get_json()
+            self.diagnosis_ids.append(body['diagnosis_id'])
+            self.patient_queries.append(data['mobile'][:6])
+        return response
+
+    def history(self, i):
+        return self.client().get(f"/history?page={1 + i % 3}&limit=50")
+
+    def search(self, i):
+        query = self.patient_queries[i % len(self.patient_queries)] if self.patient_queries else 'Load'
+        return self.client().get(f"/search?q={query}")
+
+    def stats(self, i):
+        return self.client().get('/stats')
+
+    def diagnosis_image(self, i):
+        return self.client().get(f"/diagnosis/image/{self.diagnosis_ids[i % len(self.diagnosis_ids)]}")
+
+    def run(self, endpoint, n_requests):
+        fn = getattr(self, endpoint)
+        latencies = [None] * n_requests
+        statuses = [None] * n_requests
+
+        def one(i):
+            start = time.perf_counter()
+            try:
+                statuses[i] = fn(i).status_code
+            except Exception:
+                statuses[i] = 'exception'
+            latencies[i] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(one, range(n_requests)))
+        wall = time.perf_counter() - start
+
+        ordered = sorted(latencies)
+        errors = sum(1 for s in statuses if s != 200)
+        return {
+            'requests': n_requests,
+            'errors': errors,
+            'throughput_rps': round(n_requests / wall, 2),
+            'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+            'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+            'max_ms': round(ordered[-1] * 1000, 2),
+        }
+
+
+def compare(report, baseline_path):
+    """Print per-endpoint deltas against an earlier report"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nComparison vs {baseline.get('commit')} ({baseline_path}):", file=sys.stderr)
+    for endpoint, current in report['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(endpoint)
+        if not old:
+            continue
+        parts = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if old.get(key):
+                parts.append(f"{key} {(current[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"  {endpoint:<16} " + '  '.join(parts), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process load test for the RetinaAI Flask service")
+    parser.add_argument('--backend', choices=('mongomock', 'sqlite', 'mongo'), default='mongomock')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/retina_ai_loadtest',
+                        help="Used with --backend mongo; the database is dropped afterwards")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="Requests per endpoint")
+    parser.add_argument('--seed-images', type=int, default=50, help="Diagnoses created before measuring")
+    parser.add_argument('--image-size', type=int, default=640)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--out', help="Write the JSON report here as well as stdout")
+    parser.add_argument('--compare', help="Earlier JSON report to diff against")
+    parser.add_argument('--verbose', action='store_true', help="Keep the app's per-request logging")
+    args = parser.parse_args()
+
+    tmp = configure_backend(args)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    with quiet:
+        from benchmarks.synthetic import make_fundus_jpeg
+        import app as app_module
+
+        flask_app = app_module.app
+        images = [make_fundus_jpeg(args.image_size, severity=i % 5, seed=args.seed + i) for i in range(10)]
+        tester = LoadTester(flask_app, images, args.concurrency)
+
+        # Seed phase - not measured, gives read endpoints realistic data
+        tester.run('analyze', args.seed_images)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'config': {k: getattr(args, k) for k in ('backend', 'concurrency', 'requests', 'seed_images',
+                                                 'image_size', 'seed')},
+        'endpoints': {},
+    }
+    endpoints = [e.strip() for e in args.endpoints.split(',')]
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error(f"unknown endpoint {endpoint!r}")
+    with quiet:
+        for endpoint in endpoints:
+            report['endpoints'][endpoint] = tester.run(endpoint, args.requests)
+
+    if args.backend == 'mongo':
+        db = app_module.storage.db
+        db.client.drop_database(db.name)
+    if tmp is not None:
+        app_module.storage.close()
+        tmp.cleanup()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# benchmarks/micro_bench.py
+"""
+Micro-benchmarks for the ML hot paths, with stored baselines.
+
+Each benchmark is calibrated so one round takes at least --min-time, then
+timed over --rounds rounds (pytest-benchmark style); min/median/mean per
+call are reported. Inputs are deterministic synthetic fundus images at
+several resolutions, so numbers are comparable between runs on the same
+machine.
+
+    # record a baseline before a change
+    python -m benchmarks.micro_bench --save main
+    # after the change: exit code 1 if any median regressed by > 10%
+    python -m benchmarks.micro_bench --compare main --threshold 10
+
+Baselines are machine-specific and live in benchmarks/baselines/.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+RESOLUTIONS = (640, 1500, 2500, 4000)
+
+
+def bench(fn, min_time=0.2, rounds=7):
+    """Time fn() and return per-call statistics in seconds"""
+    fn()  # warm-up
+    iterations = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or iterations >= 1 << 20:
+            break
+        iterations *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    per_call = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        per_call.append((time.perf_counter() - start) / iterations)
+
+    return {
+        'min': min(per_call),
+        'median': statistics.median(per_call),
+        'mean': statistics.mean(per_call),
+        'stddev': statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+        'iterations': iterations,
+        'rounds': rounds,
+    }
+
+
+def build_cases(resolutions):
+    """Return {name: zero-arg callable} for every hot path"""
+    from sklearn.ensemble import GradientBoostingClassifier
+
+    from benchmarks.synthetic import make_fundus_image
+    from model import AdvancedDRSystem, RetinaFeatureExtractor
+    from storage import DiagnosisRepository
+    from train_model import custom_smote
+
+    cases = {}
+    extractor = RetinaFeatureExtractor()
+
+    for size in resolutions:
+        img = make_fundus_image(size, severity=2, seed=size)
+        img.load()
+        cases[f"extract[{size}px]"] = lambda img=img: extractor.extract(img)
+        cases[f"validate_retinal_image[{size}px]"] = lambda img=img: AdvancedDRSystem.validate_retinal_image(img)
+
+    # Feature matrix with the production dimensionality and class imbalance
+    rng = np.random.default_rng(0)
+    n_features = len(extractor.extract(make_fundus_image(224, seed=1)))
+    counts = [600, 120, 250, 60, 90]
+    y = np.concatenate([np.full(c, k) for k, c in enumerate(counts)])
+    X = rng.normal(size=(len(y), n_features)) + y[:, None] * 0.05
+
+    def smote():
+        random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            custom_smote(X, y)
+    cases['custom_smote[1120x%d]' % n_features] = smote
+
+    clf = GradientBoostingClassifier(n_estimators=100, learning_rate=0.1, max_depth=5, random_state=42)
+    clf.fit(X[::2], y[::2])
+    one = X[:1]
+    batch = X[:256]
+    cases['predict_proba[1]'] = lambda: clf.predict_proba(one)
+    cases['predict_proba[256]'] = lambda: clf.predict_proba(batch)
+
+    docs = [{
+        '_id': f"{i:024x}",
+        'patient_id': f"PID-{i:08X}",
+        'patient_mobile': f"9{i:09d}",
+        'date': datetime(2026, 1, 1 + i % 28, 12, 0),
+        'diagnosis_class': 'Moderate',
+        'severity_index': 2,
+        'progression_risk': 43.0,
+        'probabilities': {'No DR': 0.04, 'Mild': 0.06, 'Moderate': 0.65, 'Severe': 0.06, 'Proliferative': 0.19},
+        'image_filename': 'fundus.jpg',
+        'notes': 'Automated Analysis',
+        'patient_info': {'name': 'Bench Patient', 'age': 55, 'gender': 'F'},
+    } for i in range(50)]
+    cases['Diagnosis.to_dict[50]'] = lambda: [DiagnosisRepository.to_dict(d) for d in docs]
+
+    return cases
+
+
+def compare(results, baseline, threshold, stat):
+    """Return the list of regressions beyond threshold percent"""
+    regressions = []
+    print(f"\n{'benchmark':<34} {'baseline':>12} {'current':>12} {'change':>9}", file=sys.stderr)
+    for name, current in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if not old:
+            print(f"{name:<34} {'-':>12} {current[stat] * 1e3:>10.3f}ms {'new':>9}", file=sys.stderr)
+            continue
+        change = (current[stat] - old[stat]) / old[stat] * 100
+        flag = ''
+        if change > threshold:
+            regressions.append((name, change))
+            flag = '  REGRESSION'
+        print(f"{name:<34} {old[stat] * 1e3:>10.3f}ms {current[stat] * 1e3:>10.3f}ms {change:>+8.1f}%{flag}",
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the ML hot paths")
+    parser.add_argument('--filter', default='', help="Only run benchmarks whose name contains this")
+    parser.add_argument('--resolutions', default=','.join(map(str, RESOLUTIONS)))
+    parser.add_argument('--min-time', type=float, default=0.2, help="Minimum seconds per round")
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--save', metavar='NAME', help="Store results as baseline NAME")
+    parser.add_argument('--compare', metavar='NAME', help="Compare against baseline NAME")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Allowed slowdown in percent")
+    parser.add_argument('--stat', choices=('min', 'median', 'mean'), default='median')
+    args = parser.parse_args()
+
+    resolutions = [int(r) for r in args.resolutions.split(',') if r]
+    with contextlib.redirect_stdout(io.StringIO()):
+        cases = build_cases(resolutions)
+
+    results = {
+        'machine': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'benchmarks': {},
+    }
+    for name, fn in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        results['benchmarks'][name] = stats = bench(fn, args.min_time, args.rounds)
+        print(f"{name:<34} median {stats['median'] * 1e3:10.3f} ms  min {stats['min'] * 1e3:10.3f} ms",
+              file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save}.json")
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {path}", file=sys.stderr)
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.stat)
+        if regressions:
+            print(f"\n❌ {len(regressions)} benchmark(s) regressed by more than {args.threshold}%", file=sys.stderr)
+            sys.exit(1)
+        print(f"\n✅ No regressions beyond {args.threshold}%", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
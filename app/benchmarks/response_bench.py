@@ -0,0 +1,138 @@
+# benchmarks/response_bench.py
+"""
+Bytes on the wire and serialization time for a /history page.
+
+Builds --rows realistic diagnosis documents (varied names, dates and
+full-precision probabilities), converts them with Diagnosis.to_dict as
+/history does, and reports:
+
+- serialization: Flask's json provider vs the orjson provider (responses.py)
+- wire size and compression time per encoding (identity, gzip, brotli)
+- the /history route end to end through the Flask test client, against an
+  throwaway SQLite file, per Accept-Encoding
+
+    python -m benchmarks.response_bench --rows 50
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+from benchmarks.micro_bench import bench
+
+CLASSES = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative']
+NAMES = ['Asha Verma', 'Rahul Menon', 'Fatima Sheikh', 'John Mathew', 'Priya Nair', 'Karthik Rao', 'Meera Iyer']
+
+
+def sample_docs(rows, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1)
+    docs = []
+    for i in range(rows):
+        probs = [rng.random() for _ in CLASSES]
+        total = sum(probs)
+        severity = max(range(len(CLASSES)), key=lambda k: probs[k])
+        docs.append({
+            '_id': f"{rng.getrandbits(96):024x}",
+            'patient_id': f"PID-{rng.getrandbits(32):08X}",
+            'patient_mobile': f"9{rng.randrange(10 ** 9):09d}",
+            'date': start + timedelta(minutes=rng.randrange(500000)),
+            'diagnosis_class': CLASSES[severity],
+            'severity_index': severity,
+            'progression_risk': round(rng.uniform(1, 99.9), 1),
+            'probabilities': {k: p / total for k, p in zip(CLASSES, probs)},
+            'image_filename': f"fundus_{i:05d}.jpg",
+            'notes': 'Automated Analysis',
+            'confirmed_class': rng.choice([None, severity]),
+            'patient_info': {'name': rng.choice(NAMES), 'age': rng.randrange(25, 85),
+                             'gender': rng.choice(['Male', 'Female'])},
+        })
+    return docs
+
+
+def _ms(stats):
+    return round(stats['median'] * 1000, 4)
+
+
+def run(rows=50, min_time=0.2, rounds=5):
+    from flask import Flask
+    from flask.json.provider import DefaultJSONProvider
+
+    import responses
+    from storage import DiagnosisRepository
+
+    docs = sample_docs(rows)
+    page = {'data': [DiagnosisRepository.to_dict(d) for d in docs], 'total': 1000, 'page': 1,
+            'limit': rows, 'pages': -(-1000 // rows)}
+    app = Flask(__name__)
+    report = {'rows': rows, 'to_dict_ms': _ms(bench(lambda: [DiagnosisRepository.to_dict(d) for d in docs],
+                                                    min_time, rounds))}
+
+    providers = {'json': DefaultJSONProvider(app)}
+    if responses.orjson is not None:
+        providers['orjson'] = responses.OrjsonProvider(app)
+    serialization = {}
+    with app.app_context():
+        for name, provider in providers.items():
+            serialization[name] = _ms(bench(lambda: provider.response(page).get_data(), min_time, rounds))
+        body = providers['json'].response(page).get_data()
+    report['serialize_ms'] = serialization
+
+    wire = {'identity': {'bytes': len(body), 'compress_ms': 0.0}}
+    encodings = [('gzip', 1), ('gzip', 6), ('gzip', 9)]
+    if responses.brotli is not None:
+        encodings += [('br', 4), ('br', 11)]
+    for encoding, level in encodings:
+        compressed = responses.compress(body, encoding, gzip_level=level, brotli_quality=level)
+        stats = bench(lambda: responses.compress(body, encoding, gzip_level=level, brotli_quality=level),
+                      min_time, rounds)
+        wire[f"{encoding}-{level}"] = {'bytes': len(compressed), 'compress_ms': _ms(stats)}
+    report['wire'] = wire
+    report['route'] = route_bench(docs, min_time, rounds)
+    return report
+
+
+def route_bench(docs, min_time, rounds):
+    """GET /history?limit=<rows> through the real app, per Accept-Encoding"""
+    with tempfile.TemporaryDirectory(prefix='retina_response_bench_') as tmp:
+        os.environ.update({'STORAGE_BACKEND': 'sqlite', 'SQLITE_PATH': os.path.join(tmp, 'bench.sqlite3'),
+                           'IMAGE_INDEX_ENABLED': '0', 'METRICS_ENABLED': '0'})
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app as app_module
+        try:
+            return _route_bench(app_module, docs, min_time, rounds)
+        finally:
+            app_module.storage.close()
+
+
+def _route_bench(app_module, docs, min_time, rounds):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for doc in docs:
+            app_module.storage.diagnoses.create(doc['patient_id'], {
+                'class': doc['diagnosis_class'], 'severity_index': doc['severity_index'],
+                'progression_risk': doc['progression_risk'], 'probabilities': doc['probabilities'],
+                'patient_mobile': doc['patient_mobile']})
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user'] = 'bench'
+    url = f"/history?page=1&limit={len(docs)}"
+    results = {}
+    for accept in ('identity', 'gzip', 'br, gzip'):
+        response = client.get(url, headers={'Accept-Encoding': accept})
+        stats = bench(lambda: client.get(url, headers={'Accept-Encoding': accept}), min_time, rounds)
+        results[accept] = {'encoding': response.headers.get('Content-Encoding', 'identity'),
+                           'bytes': len(response.get_data()), 'ms': _ms(stats)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark JSON serialization and compression of /history")
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.min_time, args.rounds), indent=2))
@@ -0,0 +1,156 @@
+# benchmarks/storage_bench.py
+"""
+Storage backend benchmark.
+
+Runs the same deterministic workload (patient upserts, diagnosis inserts
+with images, dashboard reads) against each backend and prints per-operation
+throughput and latency as JSON.
+
+Usage (from app/):
+    python -m benchmarks.storage_bench [--patients 500] [--visits 4]
+        [--sqlite-path :memory:] [--mongo-uri mongodb://localhost:27017/retina_ai_bench]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from werkzeug.datastructures import FileStorage
+
+from constants import CLASSES
+from sqlite_database import SQLiteStorage
+
+IMAGE_BYTES = os.urandom(64 * 1024)  # Stand-in for a compressed fundus photo
+
+
+class OpTimer:
+    """Collects per-operation latencies"""
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, op, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.samples.setdefault(op, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        report = {}
+        for op, values in self.samples.items():
+            values = sorted(values)
+            total = sum(values)
+            report[op] = {
+                'count': len(values),
+                'ops_per_sec': round(len(values) / total, 1) if total else None,
+                'mean_ms': round(statistics.mean(values) * 1000, 3),
+                'p95_ms': round(values[int(0.95 * (len(values) - 1))] * 1000, 3),
+            }
+        return report
+
+
+def fake_result(rng):
+    score = rng.randrange(len(CLASSES))
+    probs = [rng.random() for _ in CLASSES]
+    total = sum(probs)
+    return {
+        'class': CLASSES[score],
+        'severity_index': score,
+        'probabilities': {k: p / total for k, p in zip(CLASSES, probs)},
+        'progression_risk': round(rng.uniform(1, 99), 1),
+    }
+
+
+def run_workload(storage, n_patients=500, visits=4, seed=42):
+    """Drive one backend through the shared workload"""
+    rng = random.Random(seed)
+    timer = OpTimer()
+    mobiles = [f"9{rng.randrange(10**9):09d}" for _ in range(n_patients)]
+    patient_ids = []
+
+    for i, mobile in enumerate(mobiles):
+        details = {'name': f"Patient {i}", 'age': str(rng.randrange(20, 90)), 'mobile': mobile}
+        existing = timer.time('patients.find_by_mobile', storage.patients.find_by_mobile, mobile)
+        if existing:
+            patient_ids.append(existing['patient_id'])
+            continue
+        patient_ids.append(timer.time('patients.create', storage.patients.create, details))
+
+    diagnosis_ids = []
+    for _ in range(visits):
+        for patient_id, mobile in zip(patient_ids, mobiles):
+            result = fake_result(rng)
+            result['patient_mobile'] = mobile
+            image = FileStorage(io.BytesIO(IMAGE_BYTES), filename='fundus.jpg', content_type='image/jpeg')
+            diagnosis_ids.append(timer.time('diagnoses.create', storage.diagnoses.create, patient_id, result, image))
+
+    for page in range(20):
+        timer.time('diagnoses.get_all(50)', storage.diagnoses.get_all, limit=50, skip=page * 50)
+        timer.time('diagnoses.count', storage.diagnoses.count)
+    for patient_id in rng.sample(patient_ids, min(200, len(patient_ids))):
+        timer.time('diagnoses.get_by_patient', storage.diagnoses.get_by_patient, patient_id)
+        timer.time('patients.find_by_id', storage.patients.find_by_id, patient_id)
+    for diagnosis_id in rng.sample(diagnosis_ids, min(200, len(diagnosis_ids))):
+        timer.time('diagnoses.get_by_id', storage.diagnoses.get_by_id, diagnosis_id)
+        timer.time('diagnoses.get_image', lambda d: storage.diagnoses.get_image(d).read(), diagnosis_id)
+    for mobile in rng.sample(mobiles, min(100, len(mobiles))):
+        timer.time('patients.search', storage.patients.search, mobile[:5])
+    for _ in range(20):
+        timer.time('stats.get_dashboard_stats', storage.stats.get_dashboard_stats)
+
+    return timer.summary()
+
+
+def mongo_storage(uri):
+    from pymongo import MongoClient
+    from mongo_database import MongoStorage
+
+    client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    client.admin.command('ping')
+    db = client.get_default_database('retina_ai_bench')
+    client.drop_database(db.name)
+    storage = MongoStorage(db)
+    storage.create_indexes()
+    return client, storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare storage backends on a shared workload")
+    parser.add_argument('--patients', type=int, default=500)
+    parser.add_argument('--visits', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--sqlite-path', default=None, help="SQLite file (default: temp file); ':memory:' allowed")
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/retina_ai_bench')
+    parser.add_argument('--skip-mongo', action='store_true')
+    args = parser.parse_args()
+
+    results = {'workload': {'patients': args.patients, 'visits': args.visits, 'seed': args.seed}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_path = args.sqlite_path or os.path.join(tmp, 'bench.sqlite3')
+        storage = SQLiteStorage(sqlite_path)
+        try:
+            results['sqlite'] = run_workload(storage, args.patients, args.visits, args.seed)
+        finally:
+            storage.close()
+
+    if not args.skip_mongo:
+        try:
+            client, storage = mongo_storage(args.mongo_uri)
+        except Exception as e:
+            results['mongo'] = {'skipped': f"MongoDB unavailable: {e}"}
+        else:
+            try:
+                results['mongo'] = run_workload(storage, args.patients, args.visits, args.seed)
+            finally:
+                client.drop_database(storage.db.name)
+                client.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# benchmarks/synthetic.py
+"""
+Deterministic synthetic fundus-like images for benchmarks and load tests.
+
+Images are drawn with numpy only: a dark background, an orange-red retinal
+disc with radial falloff, a bright optic disc, dark vessels and a number of
+lesions that grows with the requested severity. They pass
+AdvancedDRSystem.validate_retinal_image, so they exercise the full
+predict path.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+
+def make_fundus_array(size=640, severity=0, seed=0):
+    """Return an (size, size, 3) uint8 fundus-like image"""
+    rng = np.random.default_rng(seed * 7919 + severity)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    cx = cy = (size - 1) / 2.0
+    radius = size * 0.46
+    r = np.hypot(xx - cx, yy - cy) / radius
+
+    # Retinal disc with vignetting
+    falloff = np.clip(1.0 - r ** 2 * 0.6, 0, 1)
+    img = np.zeros((size, size, 3), dtype=np.float32)
+    img[..., 0] = 200 * falloff
+    img[..., 1] = 85 * falloff
+    img[..., 2] = 30 * falloff
+
+    # Optic disc
+    odx, ody = cx + radius * 0.45, cy + rng.uniform(-0.1, 0.1) * radius
+    od = np.exp(-((xx - odx) ** 2 + (yy - ody) ** 2) / (2 * (size * 0.05) ** 2))
+    img += od[..., None] * np.array([55, 120, 70], dtype=np.float32)
+
+    # Vessels: sinusoidal arcs leaving the optic disc
+    for k in range(8):
+        angle = rng.uniform(0, 2 * np.pi)
+        curve = rng.uniform(-0.004, 0.004)
+        t = np.linspace(0, radius * 1.1, size * 2)
+        vx = odx - np.cos(angle) * t + curve * t ** 2 * np.sin(angle)
+        vy = ody - np.sin(angle) * t + curve * t ** 2 * np.cos(angle)
+        ok = (vx >= 0) & (vx < size) & (vy >= 0) & (vy < size)
+        width = max(1, size // 300)
+        for dx in range(-width, width + 1):
+            px = np.clip(vx[ok].astype(int) + dx, 0, size - 1)
+            img[vy[ok].astype(int), px] *= 0.55
+
+    # Lesions: dark red haemorrhages and yellow exudates
+    n_lesions = int(severity * 12 + rng.integers(0, 4))
+    for _ in range(n_lesions):
+        angle, dist = rng.uniform(0, 2 * np.pi), rng.uniform(0, 0.85) * radius
+        lx, ly = cx + np.cos(angle) * dist, cy + np.sin(angle) * dist
+        lr = size * rng.uniform(0.004, 0.012)
+        mask = ((xx - lx) ** 2 + (yy - ly) ** 2) < lr ** 2
+        if rng.random() < 0.5:
+            img[mask] = img[mask] * 0.35 + np.array([60, 5, 5], dtype=np.float32)
+        else:
+            img[mask] = np.array([235, 210, 90], dtype=np.float32)
+
+    img[r > 1.0] = 0
+    img += rng.normal(0, 3, img.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_fundus_image(size=640, severity=0, seed=0):
+    """Return a synthetic fundus PIL image"""
+    return Image.fromarray(make_fundus_array(size, severity, seed), 'RGB')
+
+
+def make_fundus_jpeg(size=640, severity=0, seed=0, quality=90):
+    """Return JPEG-encoded bytes of a synthetic fundus image"""
+    buf = io.BytesIO()
+    make_fundus_image(size, severity, seed).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
@@ -0,0 +1,111 @@
+# build_assets.py
+"""
+Fingerprint static assets for long-lived browser caching.
+
+Every file under static/ is copied to assets/ with a content hash in its
+name (css/style.css -> css/style.3f9a1c2b7d4e.css), next to precompressed
+.gz and (with the brotli package) .br variants, and listed in
+assets/manifest.json. responses.py serves these from /assets/ with
+`Cache-Control: immutable`, and templates link them through asset_url(),
+so a changed file gets a new URL instead of a revalidation round trip.
+
+Run after changing anything under static/ (and as part of a deploy):
+    python build_assets.py            # from app/
+    python build_assets.py --clean    # also delete files from older builds
+
+Older builds are kept by default so pages already rendered against them
+keep working during a rolling deploy.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+
+STATIC_DIR = 'static'
+ASSET_DIR = 'assets'
+MANIFEST_NAME = 'manifest.json'
+DIGEST_LENGTH = 12
+PRECOMPRESS = {'.css', '.js', '.svg', '.json', '.html', '.txt', '.map'}
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:DIGEST_LENGTH]
+
+
+def fingerprinted_name(name, digest):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _precompressed(data):
+    """{encoding: (suffix, bytes)} for the variants that actually come out smaller"""
+    variants = {'gzip': ('.gz', gzip.compress(data, compresslevel=9, mtime=0))}  # mtime=0: reproducible builds
+    try:
+        import brotli
+        variants['br'] = ('.br', brotli.compress(data, quality=11))
+    except ImportError:
+        pass
+    return {encoding: v for encoding, v in variants.items() if len(v[1]) < len(data)}
+
+
+def build_assets(static_dir=STATIC_DIR, out_dir=ASSET_DIR, clean=False):
+    """Copy, fingerprint and precompress every static file; returns the manifest"""
+    assets = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+            target = fingerprinted_name(name, digest)
+            _write(os.path.join(out_dir, target), data)
+            encodings = []
+            if os.path.splitext(name)[1].lower() in PRECOMPRESS:
+                for encoding, (suffix, compressed) in _precompressed(data).items():
+                    _write(os.path.join(out_dir, target + suffix), compressed)
+                    encodings.append(encoding)
+            assets[name] = {'path': target, 'digest': digest, 'size': len(data), 'encodings': sorted(encodings)}
+
+    manifest = {'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'assets': assets}
+    _write(os.path.join(out_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    if clean:
+        keep = {MANIFEST_NAME}
+        for entry in assets.values():
+            keep.add(entry['path'])
+            keep.update(entry['path'] + s for s in ('.gz', '.br'))
+        for root, _, files in os.walk(out_dir):
+            for filename in files:
+                rel = os.path.relpath(os.path.join(root, filename), out_dir).replace(os.sep, '/')
+                if rel not in keep:
+                    os.remove(os.path.join(root, filename))
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress static assets")
+    parser.add_argument('--static-dir', default=STATIC_DIR)
+    parser.add_argument('--out', default=ASSET_DIR)
+    parser.add_argument('--clean', action='store_true', help="Delete files left over from older builds")
+    args = parser.parse_args()
+
+    manifest = build_assets(args.static_dir, args.out, args.clean)
+    for name, entry in manifest['assets'].items():
+        encodings = ', '.join(entry['encodings']) or 'uncompressed'
+        print(f"  {name} -> {entry['path']} ({entry['size'] / 1024:.1f} KB; {encodings})")
+    print(f"✅ Built {len(manifest['assets'])} assets into {args.out}/")
@@ -0,0 +1,144 @@
+# cascade.py
+"""
+Confidence-gated inference cascade.
+
+A multinomial logistic regression on the six global colour statistics
+(per-channel mean/std, the first columns of the feature vector) answers
+images it is confident about; everything else goes to the full boosted
+model. The gate is evaluated with plain numpy - a few microseconds against
+milliseconds for the ensemble.
+
+The confidence threshold is calibrated on held-out images against the full
+model it was trained with: the lowest threshold whose combined
+predictions keep referable-DR (class >= 2) recall at the target (or at the
+full model's own recall, if that is lower). The gate only runs while that
+same model version is serving, so a hot reload disables it until the
+cascade is re-calibrated with `python train_model.py --cascade`.
+"""
+import pickle
+import time
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+
+from metrics import HELP
+
+CASCADE_PATH = "dr_cascade.pkl"
+GATE_FEATURES = slice(0, 6)
+REFERABLE_CLASS = 2
+
+HELP.update({
+    'cascade_decisions_total': "Predictions by cascade stage (gate = answered by the cheap model)",
+    'cascade_saved_seconds_total': "Estimated full-model time skipped by the cascade gate",
+})
+
+
+def referable_recall(y_true, y_pred):
+    referable = y_true >= REFERABLE_CLASS
+    return float(np.mean(y_pred[referable] >= REFERABLE_CLASS)) if referable.any() else 1.0
+
+
+class CascadeGate:
+    """Cheap first-stage classifier plus its calibrated confidence threshold"""
+    def __init__(self, feature_version, model_version, target_recall=0.95):
+        self.feature_version = feature_version
+        self.model_version = model_version
+        self.target_recall = target_recall
+        self.threshold = np.inf
+        self.report = {}
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)[:, GATE_FEATURES]
+        self.mean_ = X.mean(axis=0)
+        self.scale_ = X.std(axis=0)
+        self.scale_[self.scale_ == 0] = 1.0
+        clf = LogisticRegression(max_iter=1000)
+        clf.fit((X - self.mean_) / self.scale_, y)
+        self.classes_ = clf.classes_.astype(int)
+        self.coef_ = clf.coef_.T.copy()
+        self.intercept_ = clf.intercept_.copy()
+        return self
+
+    def predict_proba(self, X):
+        """(n, d) feature vectors -> (n, n_classes) probabilities"""
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))[:, GATE_FEATURES]
+        z = ((X - self.mean_) / self.scale_) @ self.coef_ + self.intercept_
+        if z.shape[1] == 1:  # binary LogisticRegression keeps one column
+            z = np.hstack([np.zeros_like(z), z])
+        z -= z.max(axis=1, keepdims=True)
+        e = np.exp(z)
+        return e / e.sum(axis=1, keepdims=True)
+
+    def calibrate(self, X, y, full_pred):
+        """Pick the lowest threshold that keeps referable recall at target on (X, y)"""
+        probs = self.predict_proba(X)
+        conf = probs.max(axis=1)
+        gate_pred = self.classes_[probs.argmax(axis=1)]
+        required = min(self.target_recall, referable_recall(y, full_pred))
+
+        self.threshold = np.inf
+        for t in np.unique(conf):
+            combined = np.where(conf >= t, gate_pred, full_pred)
+            if referable_recall(y, combined) >= required:
+                self.threshold = float(t)
+                break
+        return self.threshold
+
+    def decide(self, features, n_classes):
+        """(score, probs) when the gate is confident about one vector, else None"""
+        probs = self.predict_proba(features)[0]
+        best = int(probs.argmax())
+        if probs[best] < self.threshold:
+            return None
+        full = [0.0] * n_classes
+        for cls, p in zip(self.classes_, probs):
+            full[cls] = float(p)
+        return int(self.classes_[best]), full
+
+    def evaluate(self, X, y, full_pred, full_model):
+        """Short-circuit fraction, recall/accuracy and per-image latency on (X, y)"""
+        probs = self.predict_proba(X)
+        gated = probs.max(axis=1) >= self.threshold
+        combined = np.where(gated, self.classes_[probs.argmax(axis=1)], full_pred)
+
+        sample = X[:min(len(X), 200)]
+        start = time.perf_counter()
+        for row in sample:
+            self.predict_proba(row)
+        gate_seconds = (time.perf_counter() - start) / max(len(sample), 1)
+        start = time.perf_counter()
+        for row in sample:
+            full_model.predict_proba(row.reshape(1, -1))
+        full_seconds = (time.perf_counter() - start) / max(len(sample), 1)
+
+        short_circuit = float(gated.mean()) if len(gated) else 0.0
+        return {
+            'images': int(len(y)),
+            'threshold': self.threshold,
+            'short_circuit_fraction': round(short_circuit, 4),
+            'referable_recall_full': round(referable_recall(y, full_pred), 4),
+            'referable_recall_cascade': round(referable_recall(y, combined), 4),
+            'accuracy_full': round(float(np.mean(full_pred == y)), 4),
+            'accuracy_cascade': round(float(np.mean(combined == y)), 4),
+            'gate_ms_per_image': round(gate_seconds * 1000, 4),
+            'full_model_ms_per_image': round(full_seconds * 1000, 4),
+            'expected_ms_saved_per_image': round((short_circuit * full_seconds - gate_seconds) * 1000, 4),
+        }
+
+
+def save_cascade(gate, path=CASCADE_PATH):
+    with open(path, 'wb') as f:
+        pickle.dump(gate, f)
+
+
+def load_cascade(path=CASCADE_PATH, feature_version=None):
+    """Load a CascadeGate, or None if missing or built for another extractor"""
+    try:
+        with open(path, 'rb') as f:
+            gate = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, AttributeError, EOFError):
+        return None
+    if feature_version and gate.feature_version != feature_version:
+        print(f" -> Cascade {path} built for features {gate.feature_version}, ignoring")
+        return None
+    return gate
@@ -0,0 +1,8 @@
+# constants.py
+"""
+Constants shared by the app and the offline scripts (re-exported by
+model.py). Importing this module pulls in nothing else, so scripts that
+only need the class names, like migrate.py, import them from here.
+"""
+
+CLASSES = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative']
@@ -0,0 +1,297 @@
+# deep_features.py
+"""
+CPU deep-backbone feature extractor (DenseNet121 / VGG16).
+
+A drop-in alternative to RetinaFeatureExtractor, selected with
+FEATURE_EXTRACTOR=densenet121 or FEATURE_EXTRACTOR=vgg16. The backbone runs
+without its classifier head and with global average pooling, so each image
+becomes a 1024-d (DenseNet121) or 512-d (VGG16) vector for the same
+GradientBoosting pipeline.
+
+CPU only. Thread pools are sized with TF_INTRA_OP_THREADS /
+TF_INTER_OP_THREADS (0 = TensorFlow's default, all cores). Batches are
+scored at a fixed size (FEATURE_BATCH_SIZE) so the graph is traced once;
+single images (extract, the serving path) get their own batch-1 graph
+instead of being padded to a full batch. An extractor is safe to share
+between request threads. FEATURE_RUNTIME picks the engine:
+
+- keras  : the Keras model wrapped in a tf.function (default)
+- tflite : an int8-quantized TFLite graph (FEATURE_GRAPH), see `export`
+- onnx   : an ONNX graph run by onnxruntime (FEATURE_GRAPH), see `export`
+
+Weights default to None (random initialisation from FEATURE_SEED), which
+needs no download and is what tests and benchmarks use. Set
+FEATURE_WEIGHTS=imagenet, or a path to a .h5 file, for real features. The
+feature version encodes backbone, weights and runtime, so vectors from
+different configurations are never mixed.
+
+Export a quantized or ONNX graph:
+    python deep_features.py --backbone densenet121 --format tflite \\
+        --out densenet121_int8.tflite --calibration-dir ../colored_images
+"""
+import argparse
+import hashlib
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+# name -> (keras.applications constructor, preprocessing mode, output dimension)
+BACKBONES = {
+    'densenet121': ('DenseNet121', 'torch', 1024),
+    'vgg16': ('VGG16', 'caffe', 512),
+}
+RUNTIMES = ('keras', 'tflite', 'onnx')
+INPUT_SIZE = (224, 224)
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+CAFFE_BGR_MEAN = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+_tf_configured = False
+
+
+def configure_tensorflow(intra_op_threads=0, inter_op_threads=0):
+    """Import TensorFlow pinned to the CPU with the given thread pools (first call wins)"""
+    global _tf_configured
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    try:
+        import tensorflow as tf
+    except ImportError as e:
+        raise ImportError("Deep feature extraction needs tensorflow (pip install tensorflow-cpu)") from e
+    if not _tf_configured:
+        # Thread pools can only be set before TensorFlow creates its runtime
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        tf.config.set_visible_devices([], 'GPU')
+        _tf_configured = True
+    return tf
+
+
+def deep_feature_version(backbone, weights=None, runtime='keras', seed=42):
+    """Feature version string for a backbone configuration"""
+    if weights is None:
+        tag = f"random{seed}"
+    elif weights == 'imagenet':
+        tag = 'imagenet'
+    else:
+        with open(weights, 'rb') as f:
+            tag = 'w' + hashlib.sha256(f.read()).hexdigest()[:8]
+    return f"{backbone}-{tag}-{'int8' if runtime == 'tflite' else runtime}"
+
+
+def preprocess(imgs, mode):
+    """PIL images -> (n, 224, 224, 3) float32 in the backbone's input convention"""
+    batch = np.empty((len(imgs), INPUT_SIZE[1], INPUT_SIZE[0], 3), dtype=np.float32)
+    for i, img in enumerate(imgs):
+        img = img.resize(INPUT_SIZE)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        batch[i] = np.asarray(img, dtype=np.float32)
+    return normalize(batch, mode)
+
+
+def normalize(batch, mode):
+    """Scale a float32 (n, 224, 224, 3) RGB batch in place for the backbone"""
+    if mode == 'torch':
+        batch /= 255.0
+        batch -= IMAGENET_MEAN
+        batch /= IMAGENET_STD
+    else:  # caffe: BGR, mean-centred, unscaled
+        batch = batch[..., ::-1] - CAFFE_BGR_MEAN
+    return np.ascontiguousarray(batch)
+
+
+class DeepFeatureExtractor:
+    """Pooled CNN features on CPU; same extract(img) interface as RetinaFeatureExtractor"""
+    def __init__(self, backbone='densenet121', weights=None, runtime='keras', graph_path=None,
+                 batch_size=16, intra_op_threads=0, inter_op_threads=0, seed=42):
+        if backbone not in BACKBONES:
+            raise ValueError(f"Unknown backbone {backbone!r} (expected one of {sorted(BACKBONES)})")
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown runtime {runtime!r} (expected one of {RUNTIMES})")
+        if runtime != 'keras' and not graph_path:
+            raise ValueError(f"FEATURE_RUNTIME={runtime} needs FEATURE_GRAPH (create it with deep_features.py)")
+        self.backbone = backbone
+        self.weights = weights
+        self.runtime = runtime
+        self.graph_path = graph_path
+        self.batch_size = batch_size
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.seed = seed
+        self.mode = BACKBONES[backbone][1]
+        self.dim = BACKBONES[backbone][2]
+        self.feature_version = deep_feature_version(backbone, weights, runtime, seed)
+        # Built on first use, so process pools can fork before TensorFlow starts its threads
+        self._engine = None   # keras model / tflite graph bytes / onnx session, shared by every batch size
+        self._runners = {}    # batch size -> compiled forward function
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, backbone):
+        return cls(
+            backbone=backbone,
+            weights=os.environ.get('FEATURE_WEIGHTS') or None,
+            runtime=os.environ.get('FEATURE_RUNTIME', 'keras'),
+            graph_path=os.environ.get('FEATURE_GRAPH') or None,
+            batch_size=int(os.environ.get('FEATURE_BATCH_SIZE', 16)),
+            intra_op_threads=int(os.environ.get('TF_INTRA_OP_THREADS', 0)),
+            inter_op_threads=int(os.environ.get('TF_INTER_OP_THREADS', 0)),
+            seed=int(os.environ.get('FEATURE_SEED', 42)),
+        )
+
+    def build_keras_model(self):
+        tf = configure_tensorflow(self.intra_op_threads, self.inter_op_threads)
+        if self.weights is None:
+            tf.keras.utils.set_random_seed(self.seed)  # identical random weights in every worker
+        constructor = getattr(tf.keras.applications, BACKBONES[self.backbone][0])
+        return constructor(include_top=False, weights=self.weights, pooling='avg',
+                           input_shape=INPUT_SIZE[::-1] + (3,))
+
+    def set_batch_size(self, batch_size):
+        """Score extract_batch in batches of batch_size from now on (traced again on next use)"""
+        with self._lock:
+            self.batch_size = batch_size
+            self._runners = {size: run for size, run in self._runners.items() if size == 1}
+
+    def _runner(self, batch_size):
+        run = self._runners.get(batch_size)
+        if run is None:
+            with self._lock:  # concurrent first requests build (and trace) once
+                run = self._runners.get(batch_size)
+                if run is None:
+                    if self._engine is None:
+                        self._engine = self._load()
+                    run = self._runners[batch_size] = self._compile(batch_size)
+        return run
+
+    def _load(self):
+        if self.runtime == 'keras':
+            return self.build_keras_model()
+        if self.runtime == 'tflite':
+            with open(self.graph_path, 'rb') as f:
+                return f.read()
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("FEATURE_RUNTIME=onnx needs onnxruntime (pip install onnxruntime)") from e
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        return ort.InferenceSession(self.graph_path, options, providers=['CPUExecutionProvider'])
+
+    def _compile(self, batch_size):
+        """Forward function for (batch_size, 224, 224, 3) float32 input"""
+        shape = (batch_size,) + INPUT_SIZE[::-1] + (3,)
+        if self.runtime == 'keras':
+            tf = configure_tensorflow(self.intra_op_threads, self.inter_op_threads)
+            model = self._engine
+            forward = tf.function(lambda x: model(x, training=False),
+                                  input_signature=[tf.TensorSpec(shape, tf.float32)])
+            forward.get_concrete_function()  # trace now, under the lock
+            return lambda batch: forward(batch).numpy()
+
+        if self.runtime == 'tflite':
+            tf = configure_tensorflow(self.intra_op_threads, self.inter_op_threads)
+            interpreter = tf.lite.Interpreter(model_content=self._engine, num_threads=self.intra_op_threads or None)
+            inp = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(inp['index'], shape)
+            interpreter.allocate_tensors()
+            out = interpreter.get_output_details()[0]
+            lock = threading.Lock()  # an Interpreter's tensors belong to one invoke at a time
+
+            def run(batch):
+                with lock:
+                    interpreter.set_tensor(inp['index'], batch)
+                    interpreter.invoke()
+                    return interpreter.get_tensor(out['index'])  # a copy
+            return run
+
+        session = self._engine  # InferenceSession.run is thread-safe and takes any batch size
+        input_name = session.get_inputs()[0].name
+        return lambda batch: session.run(None, {input_name: batch})[0]
+
+    def extract_batch(self, imgs):
+        """(n, dim) float32 features for a list of PIL images"""
+        return self._forward(imgs, lambda chunk: preprocess(chunk, self.mode))
+
+    def extract_array_batch(self, pixels):
+        """(n, dim) features from an already resized (n, 224, 224, 3) uint8 array (packed datasets)"""
+        return self._forward(pixels, lambda chunk: normalize(chunk.astype(np.float32), self.mode))
+
+    def _forward(self, items, prepare, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        run = self._runner(batch_size)
+        out = np.empty((len(items), self.dim), dtype=np.float32)
+        for start in range(0, len(items), batch_size):
+            chunk = prepare(items[start:start + batch_size])
+            n = len(chunk)
+            if n < batch_size:  # pad the last chunk to the traced batch shape
+                chunk = np.concatenate([chunk, np.zeros((batch_size - n,) + chunk.shape[1:], np.float32)])
+            out[start:start + n] = run(chunk)[:n]
+        return out
+
+    def extract(self, img):
+        """Features of one image, through the batch-1 graph (no padding)"""
+        return self._forward([img], lambda chunk: preprocess(chunk, self.mode), batch_size=1)[0]
+
+    def export(self, out_path, fmt, calibration_images=()):
+        """Write an int8 TFLite graph (calibrated on calibration_images) or an ONNX graph"""
+        tf = configure_tensorflow(self.intra_op_threads, self.inter_op_threads)
+        model = self.build_keras_model()
+
+        if fmt == 'tflite':
+            converter = tf.lite.TFLiteConverter.from_keras_model(model)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if calibration_images:
+                # Full-integer weights and activations; float32 in/out keeps preprocess() unchanged
+                def representative():
+                    for img in calibration_images:
+                        yield [preprocess([img], self.mode)]
+                converter.representative_dataset = representative
+                converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            with open(out_path, 'wb') as f:
+                f.write(converter.convert())
+        elif fmt == 'onnx':
+            try:
+                import tf2onnx
+            except ImportError as e:
+                raise ImportError("ONNX export needs tf2onnx (pip install tf2onnx)") from e
+            spec = (tf.TensorSpec((None,) + INPUT_SIZE[::-1] + (3,), tf.float32, name='input'),)
+            tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=out_path)
+        else:
+            raise ValueError(f"Unknown export format {fmt!r} (expected 'tflite' or 'onnx')")
+        print(f"✅ {self.backbone} exported to {out_path} ({os.path.getsize(out_path) / 1e6:.1f} MB)")
+
+
+def load_calibration_images(directory, samples=100):
+    """Up to `samples` images spread across the class folders, for int8 calibration"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in sorted(files)
+                     if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    step = max(1, len(paths) // samples)
+    images = []
+    for path in paths[::step][:samples]:
+        with Image.open(path) as img:
+            images.append(img.convert('RGB').resize(INPUT_SIZE))
+    return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a CPU deep-feature graph (int8 TFLite or ONNX)")
+    parser.add_argument('--backbone', choices=sorted(BACKBONES), default='densenet121')
+    parser.add_argument('--weights', default=None, help="None (random init), 'imagenet' or a .h5 path")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--format', choices=('tflite', 'onnx'), default='tflite')
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--calibration-dir', default=None, help="Images for int8 calibration (tflite)")
+    parser.add_argument('--samples', type=int, default=100)
+    args = parser.parse_args()
+
+    extractor = DeepFeatureExtractor(args.backbone, args.weights, seed=args.seed)
+    calibration = load_calibration_images(args.calibration_dir, args.samples) if args.calibration_dir else ()
+    extractor.export(args.out, args.format, calibration)
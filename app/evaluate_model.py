@@ -1,102 +1,173 @@
+"""
+Full-dataset evaluation of the trained DR model.
+
+Images are decoded and featurised in a process pool (reusing the feature
+cache from earlier runs), then scored with batched predict_proba calls.
+Prints and saves a JSON report with the confusion matrix, per-class
+precision/recall/F1, quadratic weighted kappa and throughput, so two runs
+can be diffed.
+
+Usage:
+    python evaluate_model.py [--dataset ../colored_images] [--model dr_model.pkl]
+        [--workers N] [--batch-size 512] [--out evaluation_report.json] [--packed dataset_224.u8]
+"""
+import argparse
+import json
 import os
-import random
-from model import AdvancedDRSystem, CLASSES
-
-# Configuration
-DATASET_DIR = "../colored_images"  # Relative to app/
-SAMPLES_PER_CLASS = 20  # Limit to 20 images per class for quick testing. Set to None for full dataset.
-
-# Map directory names to Model Class names
-CLASS_MAPPING = {
-    'No_DR': 'No DR',
-    'Mild': 'Mild',
-    'Moderate': 'Moderate',
-    'Severe': 'Severe',
-    'Proliferate_DR': 'Proliferative'
-}
-
-def evaluate_accuracy():
-    print("============================================")
-    print("   DIABETIC RETINOPATHY MODEL EVALUATION")
-    print("============================================")
-    
-    # Initialize Model
-    dr_system = AdvancedDRSystem()
-    print("\n[INFO] Model loaded. Starting evaluation...\n")
-
-    total_images = 0
-    correct_predictions = 0
-    
-    # Per-class metrics
-    class_stats = {k: {'total': 0, 'correct': 0} for k in CLASSES}
-    
-    # Iterate through each class folder
-    for folder_name, model_label in CLASS_MAPPING.items():
-        folder_path = os.path.join(DATASET_DIR, folder_name)
-        
-        if not os.path.exists(folder_path):
-            print(f"[WARN] Directory not found: {folder_path} (Skipping)")
-            continue
-
-        images = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-        
-        # Shuffle and select a subset if configured
-        if SAMPLES_PER_CLASS:
-            images = random.sample(images, min(len(images), SAMPLES_PER_CLASS))
-            
-        print(f"--> Evaluating Class: '{model_label}' ({len(images)} samples)")
-        
-        for img_name in images:
-            img_path = os.path.join(folder_path, img_name)
-            
-            try:
-                # Predict
-                result = dr_system.predict(img_path, save=False)
-
-                prediction = result['class']
-                
-                # Check correctness
-                is_correct = (prediction == model_label)
-                
-                # Update stats
-                total_images += 1
-                class_stats[model_label]['total'] += 1
-                if is_correct:
-                    correct_predictions += 1
-                    class_stats[model_label]['correct'] += 1
-                
-                # Optional: Print detail for debugging
-                # print(f"    {img_name} -> Pred: {prediction} [{'✓' if is_correct else '✗'}]")
-
-            except Exception as e:
-                print(f"    [ERROR] Failed to process {img_name}: {e}")
-
-    # Calculate Final Metrics
+import pickle
+import time
+
+import numpy as np
+from sklearn.metrics import confusion_matrix, precision_recall_fscore_support, cohen_kappa_score
+
+from model import CLASSES, configured_feature_version
+from feature_cache import DATASET_DIR, CACHE_PATH, load_or_extract
+from pack_dataset import extract_packed
+
+MODEL_PATH = "dr_model.pkl"
+REPORT_PATH = "evaluation_report.json"
+
+
+def predict_batched(clf, X, batch_size=512):
+    """Score X in batches; returns (pred_idx, probabilities) with columns in CLASSES order"""
+    # Map model columns onto the fixed CLASSES order (a class may be absent from training)
+    classes = np.asarray(clf.classes_, dtype=int)
+    probs = np.zeros((len(X), len(CLASSES)), dtype=np.float64)
+    for start in range(0, len(X), batch_size):
+        batch = X[start:start + batch_size]
+        probs[start:start + len(batch), classes] = clf.predict_proba(batch)
+    return probs.argmax(axis=1), probs
+
+
+def compute_metrics(y_true, y_pred):
+    labels = list(range(len(CLASSES)))
+    cm = confusion_matrix(y_true, y_pred, labels=labels)
+    precision, recall, f1, support = precision_recall_fscore_support(
+        y_true, y_pred, labels=labels, zero_division=0
+    )
+    return {
+        'accuracy': float(np.mean(y_true == y_pred)) if len(y_true) else None,
+        'quadratic_weighted_kappa': float(cohen_kappa_score(y_true, y_pred, labels=labels, weights='quadratic'))
+        if len(y_true) else None,
+        'confusion_matrix': {
+            'labels': CLASSES,
+            'matrix': cm.tolist(),  # rows = true class, columns = predicted class
+        },
+        'per_class': {
+            cls: {
+                'precision': round(float(precision[i]), 4),
+                'recall': round(float(recall[i]), 4),
+                'f1': round(float(f1[i]), 4),
+                'support': int(support[i]),
+            } for i, cls in enumerate(CLASSES)
+        },
+    }
+
+
+def print_report(report):
+    metrics = report['metrics']
     print("\n============================================")
     print("             FINAL ACCURACY REPORT          ")
     print("============================================")
-    
-    if total_images == 0:
+    print(f"Evaluated: {report['counts']['scored']} | Rejected by validation: {report['counts']['rejected']} "
+          f"| Unreadable: {report['counts']['unreadable']}")
+    if metrics['accuracy'] is None:
         print("No images evaluated.")
         return
-
-    overall_accuracy = (correct_predictions / total_images) * 100
-    print(f"Overall Accuracy: {overall_accuracy:.2f}% ({correct_predictions}/{total_images})")
+    print(f"Overall Accuracy: {metrics['accuracy'] * 100:.2f}%")
+    print(f"Quadratic Weighted Kappa: {metrics['quadratic_weighted_kappa']:.4f}")
     print("--------------------------------------------")
-    print(f"{'Class':<15} | {'Accuracy':<10} | {'Samples'}")
+    print(f"{'Class':<15} | {'Precision':>9} | {'Recall':>7} | {'F1':>6} | {'Support'}")
     print("--------------------------------------------")
-    
-    for cls in CLASSES:
-        stats = class_stats[cls]
-        if stats['total'] > 0:
-            acc = (stats['correct'] / stats['total']) * 100
-            print(f"{cls:<15} | {acc:>6.1f}%    | {stats['total']}")
-        else:
-            print(f"{cls:<15} |   N/A      | 0")
-            
+    for cls, m in metrics['per_class'].items():
+        print(f"{cls:<15} | {m['precision']:>9.3f} | {m['recall']:>7.3f} | {m['f1']:>6.3f} | {m['support']}")
     print("--------------------------------------------")
-    print("Note: This heuristic model is optimized for feature demonstration.")
-    print("Real-world accuracy requires training the XGBoost/CNN on the full dataset.")
+    print("Confusion matrix (rows = true, cols = predicted):")
+    for cls, row in zip(CLASSES, metrics['confusion_matrix']['matrix']):
+        print(f"  {cls:<15} " + ' '.join(f"{v:>6}" for v in row))
+    t = report['throughput']
+    print("--------------------------------------------")
+    print(f"Feature extraction: {t['extracted_images']} images in {t['extract_seconds']:.1f}s "
+          f"({t['extract_images_per_sec']} img/s), {t['cache_hits']} from cache")
+    print(f"Scoring: {t['scoring_images_per_sec']} img/s | End-to-end: {t['total_seconds']:.1f}s")
+
+
+def evaluate_accuracy(dataset_dir=DATASET_DIR, model_path=MODEL_PATH, workers=None, batch_size=512,
+                      cache_path=CACHE_PATH, use_cache=True, limit_per_class=None,
+                      include_rejected=False, out_path=REPORT_PATH, packed=None):
+    print("============================================")
+    print("   DIABETIC RETINOPATHY MODEL EVALUATION")
+    print("============================================")
+    started = time.perf_counter()
+
+    with open(model_path, 'rb') as f:
+        clf = pickle.load(f)
+    print(f"\n[INFO] Model loaded from {model_path}. Extracting features...\n")
+
+    if packed:
+        data = extract_packed(packed, workers)
+    else:
+        data = load_or_extract(dataset_dir, cache_path, workers, limit_per_class, use_cache)
+    X, y, ok, valid = data['X'], data['y'], data['ok'], data['valid']
+
+    # Production rejects images that fail retinal validation before scoring
+    scored = ok if include_rejected else (ok & valid)
+
+    score_start = time.perf_counter()
+    y_pred, probs = predict_batched(clf, X[scored], batch_size)
+    score_seconds = time.perf_counter() - score_start
+    total_seconds = time.perf_counter() - started
+
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'model_path': os.path.abspath(model_path),
+        'model_mtime': os.path.getmtime(model_path),
+        'feature_version': configured_feature_version(),
+        'dataset_dir': os.path.abspath(packed or dataset_dir),
+        'counts': {
+            'images': len(y),
+            'scored': int(scored.sum()),
+            'rejected': int((ok & ~valid).sum()),
+            'unreadable': int((~ok).sum()),
+            'include_rejected': include_rejected,
+        },
+        'metrics': compute_metrics(y[scored], y_pred),
+        'throughput': {
+            'workers': workers or os.cpu_count(),
+            'batch_size': batch_size,
+            'cache_hits': data['cache_hits'],
+            'extracted_images': data['extracted'],
+            'extract_seconds': round(data['extract_seconds'], 3),
+            'extract_images_per_sec': round(data['extracted'] / data['extract_seconds'], 1)
+            if data['extracted'] and data['extract_seconds'] else None,
+            'scoring_seconds': round(score_seconds, 3),
+            'scoring_images_per_sec': round(len(y_pred) / score_seconds, 1) if score_seconds else None,
+            'total_seconds': round(total_seconds, 3),
+        },
+    }
+
+    print_report(report)
+    if out_path:
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {out_path}")
+    return report
+
 
 if __name__ == "__main__":
-    evaluate_accuracy()
+    parser = argparse.ArgumentParser(description="Evaluate the DR model on the full dataset")
+    parser.add_argument('--dataset', default=DATASET_DIR)
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--workers', type=int, default=None, help="Decode processes (default: all cores)")
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--cache', default=CACHE_PATH)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--limit-per-class', type=int, default=None, help="Quick run on a subset")
+    parser.add_argument('--include-rejected', action='store_true',
+                        help="Also score images that fail retinal validation")
+    parser.add_argument('--out', default=REPORT_PATH)
+    parser.add_argument('--packed', default=None, help="Read images from a pack_dataset.py file instead of --dataset")
+    args = parser.parse_args()
+
+    evaluate_accuracy(args.dataset, args.model, args.workers, args.batch_size, args.cache,
+                      not args.no_cache, args.limit_per_class, args.include_rejected, args.out, args.packed)
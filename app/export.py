@@ -0,0 +1,191 @@
+# export.py
+"""
+Streaming bulk export of diagnoses for research and audit.
+
+Rows come from DiagnosisRepository.iter_export - one projected cursor read
+batch_size documents at a time - and are encoded batch by batch, so memory
+stays flat however large the collection is. Formats:
+
+- ndjson  : one JSON object per line
+- csv     : header + rows; probabilities as a JSON string
+- parquet : one row group per batch (needs pyarrow; use a larger
+            --batch-size, e.g. 50000, for better row groups)
+
+Optionally gzip-compressed on the fly. Columns are storage.EXPORT_COLUMNS:
+no names or mobile numbers, no feature vectors or images.
+
+    GET /export?format=csv&from=2026-01-01&to=2026-03-31&class=Moderate&gzip=1
+
+    python export.py --format parquet --from 2026-01-01 --out diagnoses.parquet
+    python export.py --format ndjson --gzip > diagnoses.ndjson.gz
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from metrics import metrics, HELP
+from storage import EXPORT_COLUMNS, open_storage
+
+HELP.update({
+    'export_rows_total': "Diagnoses streamed by /export and export.py, by format",
+})
+
+# format -> (content type, file extension)
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 100000
+
+
+def parse_date(value, end=False):
+    """YYYY-MM-DD or ISO datetime; a bare end date includes that whole day"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def _flat(row):
+    return dict(row, probabilities=json.dumps(row['probabilities'], separators=(',', ':')))
+
+
+def ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(row, separators=(',', ':')) + '\n' for row in batch).encode()
+
+
+def csv_chunks(batches):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(_flat(row) for row in batch)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()  # header only - nothing matched
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last take()"""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position  # Parquet footers record absolute offsets
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_schema(pa):
+    return pa.schema([
+        ('id', pa.string()), ('patient_id', pa.string()), ('date', pa.string()),
+        ('diagnosis_class', pa.string()), ('severity_index', pa.int64()), ('progression_risk', pa.float64()),
+        ('probabilities', pa.string()), ('confirmed_class', pa.int64()), ('confirmed_at', pa.string()),
+        ('model_version', pa.string()), ('feature_version', pa.string()), ('image_filename', pa.string()),
+        ('notes', pa.string()),
+    ])
+
+
+def parquet_chunks(batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema(pa)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    for batch in batches:
+        writer.write_table(pa.Table.from_pylist([_flat(row) for row in batch], schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def _counted(batches, fmt):
+    for batch in batches:
+        metrics.inc('export_rows_total', len(batch), format=fmt)
+        yield batch
+
+
+def export_chunks(repository, fmt='ndjson', since=None, until=None, diagnosis_class=None,
+                  batch_size=DEFAULT_BATCH_SIZE, compress=False):
+    """
+    Byte chunks of the export. Arguments are checked here, before the first
+    chunk, so callers can still turn a bad request into an error response.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}' (expected one of: {', '.join(FORMATS)})")
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+    if fmt == 'parquet':
+        import pyarrow.parquet  # noqa: F401 - raises ImportError now rather than mid-stream
+
+    batches = _counted(repository.iter_export(since, until, diagnosis_class, batch_size), fmt)
+    chunks = {'ndjson': ndjson_chunks, 'csv': csv_chunks, 'parquet': parquet_chunks}[fmt](batches)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(fmt, compress=False):
+    return f"diagnoses-{time.strftime('%Y%m%d-%H%M%S')}.{FORMATS[fmt][1]}" + ('.gz' if compress else '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream all diagnoses to NDJSON, CSV or Parquet")
+    parser.add_argument('--format', default='ndjson', choices=list(FORMATS))
+    parser.add_argument('--from', dest='since', default=None, help="First day (YYYY-MM-DD or ISO datetime)")
+    parser.add_argument('--to', dest='until', default=None, help="Last day, inclusive")
+    parser.add_argument('--class', dest='diagnosis_class', default=None, help="Only this diagnosis class")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--out', default='-', help="Output file (default: stdout)")
+    parser.add_argument('--backend', default=None, help="mongo or sqlite (default: $STORAGE_BACKEND)")
+    parser.add_argument('--mongo-uri', default=None)
+    parser.add_argument('--sqlite-path', default=None)
+    args = parser.parse_args()
+
+    storage = open_storage(args.backend, args.mongo_uri, args.sqlite_path)
+    chunks = export_chunks(storage.diagnoses, args.format, parse_date(args.since), parse_date(args.until, end=True),
+                           args.diagnosis_class, args.batch_size, args.gzip)
+    start = time.perf_counter()
+    written = 0
+    out = sys.stdout.buffer if args.out == '-' else open(args.out, 'wb')
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    print(f"✅ Exported {written / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s", file=sys.stderr)
@@ -0,0 +1,185 @@
+# feature_cache.py
+"""
+Parallel feature extraction over the training dataset with an on-disk cache.
+
+Decoding and resizing full-size fundus photos dominates training and
+evaluation time, so features are extracted once in a process pool and
+saved to an .npz next to the dataset. Later runs reuse every cached row
+whose file is unchanged (same path, size and mtime) and only extract new
+or modified images. The cache is keyed on the configured extractor's
+feature version (FEATURE_EXTRACTOR), so changing the extractor invalidates it.
+Deep backbones run in-process in batches (TensorFlow already uses every
+core); only decoding is spread over a thread pool.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from model import AdvancedDRSystem, create_feature_extractor, configured_feature_version
+
+DATASET_DIR = "../colored_images"
+CACHE_PATH = "feature_cache.npz"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Dataset folder per class index (matches CLASSES order in model.py)
+CLASS_DIRS = ['No_DR', 'Mild', 'Moderate', 'Severe', 'Proliferate_DR']
+
+_extractor = None
+
+
+def list_dataset(dataset_dir=DATASET_DIR, limit_per_class=None):
+    """Return sorted (paths, labels) for every image in the class folders"""
+    paths, labels = [], []
+    for label, folder_name in enumerate(CLASS_DIRS):
+        folder_path = os.path.join(dataset_dir, folder_name)
+        if not os.path.isdir(folder_path):
+            print(f"[WARN] Directory not found: {folder_path} (Skipping)")
+            continue
+        files = sorted(f for f in os.listdir(folder_path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if limit_per_class:
+            files = files[:limit_per_class]
+        paths.extend(os.path.join(folder_path, f) for f in files)
+        labels.extend([label] * len(files))
+    return paths, np.array(labels, dtype=np.int64)
+
+
+def extract_one(path):
+    """Decode, validate and extract one image (runs in worker processes)"""
+    global _extractor
+    if _extractor is None:
+        _extractor = create_feature_extractor()
+    try:
+        with Image.open(path) as img:
+            img.load()
+            valid, _ = AdvancedDRSystem.validate_retinal_image(img)
+            return _extractor.extract(img).astype(np.float32), valid
+    except Exception:
+        return None, False
+
+
+def decode_one(path):
+    """Decode and validate one image for a batched extractor; (img, valid) or (None, False)"""
+    try:
+        with Image.open(path) as img:
+            img.load()
+            valid, _ = AdvancedDRSystem.validate_retinal_image(img)
+            return img.convert('RGB'), valid
+    except Exception:
+        return None, False
+
+
+def extract_batched(paths, extractor, workers=None, batch_size=256):
+    """Decode in a thread pool and run a batched extractor (deep backbones) in-process"""
+    rows = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for start in range(0, len(paths), batch_size):
+            decoded = list(pool.map(decode_one, paths[start:start + batch_size]))
+            good = [img for img, _ in decoded if img is not None]
+            features = iter(extractor.extract_batch(good) if good else [])
+            rows.extend((next(features), valid) if img is not None else (None, False) for img, valid in decoded)
+    return rows
+
+
+def extract_features(paths, workers=None, chunksize=16):
+    """Extract features for paths in a process pool; failed rows are NaN"""
+    if not paths:
+        return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+
+    workers = workers or os.cpu_count() or 1
+    extractor = create_feature_extractor()
+    if hasattr(extractor, 'extract_batch'):
+        rows = extract_batched(paths, extractor, workers)
+    elif workers == 1:
+        rows = [extract_one(p) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(extract_one, paths, chunksize=chunksize))
+
+    dim = next((len(f) for f, _ in rows if f is not None), 0)
+    X = np.full((len(paths), dim), np.nan, dtype=np.float32)
+    ok = np.zeros(len(paths), dtype=bool)
+    valid = np.zeros(len(paths), dtype=bool)
+    for i, (features, is_valid) in enumerate(rows):
+        if features is not None:
+            X[i] = features
+            ok[i] = True
+            valid[i] = is_valid
+    return X, ok, valid
+
+
+def _file_signature(paths):
+    stats = [os.stat(p) for p in paths]
+    return (np.array([s.st_size for s in stats], dtype=np.int64),
+            np.array([s.st_mtime_ns for s in stats], dtype=np.int64))
+
+
+def load_or_extract(dataset_dir=DATASET_DIR, cache_path=CACHE_PATH, workers=None,
+                    limit_per_class=None, use_cache=True):
+    """
+    Return a dict with X, y, paths, ok (decoded) and valid (passed retinal
+    validation) for the dataset, extracting only what the cache lacks.
+    """
+    paths, y = list_dataset(dataset_dir, limit_per_class)
+    feature_version = configured_feature_version()
+    sizes, mtimes = _file_signature(paths) if paths else (np.zeros(0, np.int64), np.zeros(0, np.int64))
+
+    cached = {}
+    if use_cache and os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as data:
+            if str(data['feature_version']) == feature_version:
+                for i, p in enumerate(data['paths']):
+                    cached[str(p)] = (data['sizes'][i], data['mtimes'][i], data['X'][i],
+                                      data['ok'][i], data['valid'][i])
+
+    missing = []
+    hits = {}
+    for i, p in enumerate(paths):
+        entry = cached.get(p)
+        if entry is not None and entry[0] == sizes[i] and entry[1] == mtimes[i]:
+            hits[i] = entry
+        else:
+            missing.append(i)
+
+    start = time.perf_counter()
+    X_new, ok_new, valid_new = extract_features([paths[i] for i in missing], workers)
+    extract_seconds = time.perf_counter() - start
+
+    dims = [X_new.shape[1]] + [len(entry[2]) for entry in list(hits.values())[:1]]
+    dim = max(dims)
+    X = np.full((len(paths), dim), np.nan, dtype=np.float32)
+    ok = np.zeros(len(paths), dtype=bool)
+    valid = np.zeros(len(paths), dtype=bool)
+    for i, entry in hits.items():
+        X[i], ok[i], valid[i] = entry[2], entry[3], entry[4]
+    for j, i in enumerate(missing):
+        if ok_new[j]:
+            X[i], ok[i], valid[i] = X_new[j], True, valid_new[j]
+
+    if use_cache and missing:
+        # Merge with rows from other runs (e.g. a different limit_per_class)
+        merged = {p: (e[0], e[1], e[2], e[3], e[4]) for p, e in cached.items() if len(e[2]) == dim}
+        for i, p in enumerate(paths):
+            merged[p] = (sizes[i], mtimes[i], X[i], ok[i], valid[i])
+        keys = sorted(merged)
+        np.savez(cache_path,
+                 feature_version=np.array(feature_version),
+                 paths=np.array(keys),
+                 sizes=np.array([merged[k][0] for k in keys], dtype=np.int64),
+                 mtimes=np.array([merged[k][1] for k in keys], dtype=np.int64),
+                 X=np.array([merged[k][2] for k in keys], dtype=np.float32).reshape(len(keys), dim),
+                 ok=np.array([merged[k][3] for k in keys], dtype=bool),
+                 valid=np.array([merged[k][4] for k in keys], dtype=bool))
+
+    return {
+        'X': X,
+        'y': y,
+        'paths': paths,
+        'ok': ok,
+        'valid': valid,
+        'cache_hits': len(hits),
+        'extracted': len(missing),
+        'extract_seconds': extract_seconds,
+    }
@@ -0,0 +1,263 @@
+# incremental_train.py
+"""
+Incremental (warm-start) retraining from clinician-confirmed diagnoses.
+
+Clinicians confirm a grade with POST /diagnosis/<id>/confirm. This command
+collects everything confirmed since the last run's watermark (kept in
+training_state.json), using the feature vector stored with each diagnosis
+and decoding the stored image only for records that have no vector for the
+current extractor. It then continues the current model instead of
+retraining from scratch:
+
+- the new records are mixed with a replay sample of the cached base
+  training set (--replay-ratio x the new records, every class present) so
+  the ensemble does not drift away from the original data;
+- the mix is SMOTE-balanced like train() and --stages extra boosting
+  stages are fitted on it with warm_start, leaving existing trees intact.
+
+Cost therefore grows with the number of new confirmations, not with the
+size of the dataset. Each run writes a new versioned artifact to models/
+and appends an entry to models/manifest.json (parent, watermark, record
+counts, held-out accuracy/QWK before and after). --promote also copies it
+over dr_model.pkl, which a running app picks up via MODEL_RELOAD_INTERVAL.
+
+training_state.json also records the version of dr_model.pkl the chain is
+based on. If dr_model.pkl has been replaced since (a full train_model.py
+run, or a manual copy), the chain restarts from it and replays every
+confirmation, since the new model has seen none of them. A chain artifact
+that no longer matches its recorded version is refused.
+
+Usage:
+    python incremental_train.py [--stages 20] [--replay-ratio 2] [--promote] [--dry-run]
+"""
+import argparse
+import json
+import os
+import pickle
+import random
+import shutil
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.metrics import accuracy_score, cohen_kappa_score
+from sklearn.model_selection import train_test_split
+
+from model import CLASSES, configured_feature_version, create_feature_extractor, model_artifact_version
+from storage import open_storage, decode_feature_rows
+from train_model import DATASET_DIR, MODEL_PATH, custom_smote, load_features
+
+STATE_PATH = "training_state.json"
+MODELS_DIR = "models"
+MANIFEST_NAME = "manifest.json"
+
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return {'watermark': None, 'model_path': MODEL_PATH}
+    with open(path) as f:
+        return json.load(f)
+
+
+def resolve_parent(state, model_path=MODEL_PATH):
+    """(parent path, watermark, version of model_path) for this run; see the module docstring"""
+    serving = model_artifact_version(model_path)
+    recorded = state.get('serving_version')
+    if recorded is None:  # first run, or a state file from before versions were recorded
+        return state.get('model_path') or model_path, state.get('watermark'), serving
+    if serving not in (recorded, state.get('model_version')):  # the chain's own head may have been promoted by hand
+        print(f"{model_path} changed since the last run ({recorded} -> {serving}): "
+              f"restarting the chain from it with every confirmed record")
+        return model_path, None, serving
+    parent_path = state.get('model_path') or model_path
+    if state.get('model_version') and model_artifact_version(parent_path) != state['model_version']:
+        raise ValueError(f"{parent_path} no longer matches version {state['model_version']} in the training "
+                         f"state; restore it or delete the state file to restart from {model_path}")
+    return parent_path, state.get('watermark'), serving
+
+
+def write_json(path, data):
+    """Write JSON atomically (a crash never leaves a half-written state file)"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def collect_confirmed(storage, since, until, feature_version):
+    """(X, y, counts) for diagnoses confirmed in (since, until]"""
+    rows, labels = [], []
+    counts = {'from_vectors': 0, 'from_images': 0, 'skipped': 0}
+    extractor = None
+
+    for batch in storage.diagnoses.iter_confirmed(since, until):
+        stored = [d for d in batch if d['features'] and d['feature_version'] == feature_version]
+        if stored:
+            rows.append(decode_feature_rows([d['features'] for d in stored]))
+            labels.extend(d['confirmed_class'] for d in stored)
+            counts['from_vectors'] += len(stored)
+
+        for doc in batch:
+            if doc['features'] and doc['feature_version'] == feature_version:
+                continue
+            # No vector for this extractor (older record or extractor change) - decode the image
+            image = storage.diagnoses.get_image(str(doc['_id']))
+            if image is None:
+                counts['skipped'] += 1
+                continue
+            extractor = extractor or create_feature_extractor()
+            with Image.open(image) as img:
+                img.load()
+                rows.append(extractor.extract(img).astype(np.float32).reshape(1, -1))
+            labels.append(doc['confirmed_class'])
+            counts['from_images'] += 1
+
+    X = np.concatenate(rows).astype(np.float64) if rows else np.zeros((0, 0))
+    return X, np.asarray(labels, dtype=np.int64), counts
+
+
+def replay_sample(y_base, n, min_per_class=5, seed=42):
+    """Indices of a random replay sample of the base set that contains every class"""
+    rng = np.random.default_rng(seed)
+    chosen = set(rng.choice(len(y_base), size=min(n, len(y_base)), replace=False).tolist())
+    for cls in np.unique(y_base):
+        members = np.flatnonzero(y_base == cls)
+        chosen.update(rng.choice(members, size=min(min_per_class, len(members)), replace=False).tolist())
+    return np.array(sorted(chosen), dtype=np.int64)
+
+
+def score(model, X, y):
+    y_pred = model.predict(X)
+    return {'accuracy': round(float(accuracy_score(y, y_pred)), 4),
+            'qwk': round(float(cohen_kappa_score(y, y_pred, weights='quadratic')), 4)}
+
+
+def train_incremental(storage=None, dataset_dir=DATASET_DIR, packed=None, workers=None, stages=20,
+                      replay_ratio=2.0, min_new=1, state_path=STATE_PATH, models_dir=MODELS_DIR,
+                      promote=False, dry_run=False):
+    print("=========================================")
+    print("   INCREMENTAL TRAINING (warm start)     ")
+    print("=========================================")
+    started = time.perf_counter()
+    storage = storage or open_storage()
+    state = load_state(state_path)
+    parent_path, watermark, serving_version = resolve_parent(state)
+    since = datetime.fromisoformat(watermark) if watermark else None
+    until = datetime.utcnow()
+    feature_version = configured_feature_version()
+
+    print(f"\n[1/4] Confirmed diagnoses since {since or 'the beginning'}...")
+    X_new, y_new, counts = collect_confirmed(storage, since, until, feature_version)
+    print(f"  -> {len(y_new)} records ({counts['from_vectors']} stored vectors, "
+          f"{counts['from_images']} decoded images, {counts['skipped']} without image)")
+    if len(y_new) < min_new:
+        print(f"Nothing to do: fewer than {min_new} new confirmed records.")
+        return None
+
+    with open(parent_path, 'rb') as f:
+        model = pickle.load(f)
+    if not isinstance(model, GradientBoostingClassifier):
+        raise TypeError(f"{parent_path} is a {type(model).__name__}; warm start needs GradientBoostingClassifier")
+    if X_new.shape[1] != model.n_features_in_:
+        raise ValueError(f"Confirmed vectors have {X_new.shape[1]} features, model expects {model.n_features_in_}")
+
+    print("\n[2/4] Base feature set (cached)...")
+    X_base, y_base = load_features(dataset_dir, workers, packed)
+    # Same split as train(): the held-out part is never trained on, here or there
+    X_train, X_test, y_train, y_test = train_test_split(X_base, y_base, test_size=0.2, random_state=42,
+                                                        stratify=y_base)
+    replay = replay_sample(y_train, int(len(y_new) * replay_ratio))
+    X_mix = np.concatenate([X_new, X_train[replay]])
+    y_mix = np.concatenate([y_new, y_train[replay]])
+    random.seed(42)
+    X_mix, y_mix = custom_smote(X_mix, y_mix, verbose=False)
+    before = score(model, X_test, y_test)
+
+    parent_stages = model.n_estimators_
+    print(f"\n[3/4] Fitting {stages} new stages on {len(y_new)} new + {len(replay)} replayed records "
+          f"({len(y_mix)} after SMOTE; model has {parent_stages} stages)...")
+    fit_start = time.perf_counter()
+    model.set_params(warm_start=True, n_estimators=parent_stages + stages)
+    model.fit(X_mix, y_mix)
+    model.set_params(warm_start=False)
+    fit_seconds = time.perf_counter() - fit_start
+
+    after = score(model, X_test, y_test)
+    print("\n[4/4] Held-out evaluation:")
+    print(f"  >> before: accuracy {before['accuracy'] * 100:.2f}%  QWK {before['qwk']:.4f}")
+    print(f"  >> after:  accuracy {after['accuracy'] * 100:.2f}%  QWK {after['qwk']:.4f}")
+    print(f"  -> Fit time {fit_seconds:.1f}s")
+
+    if dry_run:
+        print("\nDry run: no artifact written, watermark unchanged.")
+        return None
+
+    os.makedirs(models_dir, exist_ok=True)
+    tmp = os.path.join(models_dir, 'dr_model.pkl.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump(model, f)
+    version = model_artifact_version(tmp)
+    artifact = os.path.join(models_dir, f"dr_model-{until.strftime('%Y%m%d-%H%M%S')}-{version}.pkl")
+    os.replace(tmp, artifact)
+
+    manifest_path = os.path.join(models_dir, MANIFEST_NAME)
+    manifest = {'models': []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    entry = {
+        'model_version': version,
+        'path': artifact,
+        'parent_path': parent_path,
+        'parent_version': model_artifact_version(parent_path),
+        'created_at': until.isoformat(),
+        'watermark_from': watermark,
+        'watermark_to': until.isoformat(),
+        'feature_version': feature_version,
+        'new_records': int(len(y_new)),
+        'new_by_class': {cls: int((y_new == i).sum()) for i, cls in enumerate(CLASSES)},
+        'replayed_records': int(len(replay)),
+        'stages': {'parent': int(parent_stages), 'added': stages, 'total': int(model.n_estimators_)},
+        'held_out_before': before,
+        'held_out_after': after,
+        'fit_seconds': round(fit_seconds, 3),
+    }
+    manifest['models'].append(entry)
+    write_json(manifest_path, manifest)
+
+    state.update({'watermark': until.isoformat(), 'model_path': artifact, 'model_version': version,
+                  'serving_version': version if promote else serving_version})
+    write_json(state_path, state)
+    print(f"\nModel {version} saved to {artifact}; watermark advanced to {until.isoformat()}")
+
+    if promote:
+        tmp = MODEL_PATH + '.tmp'
+        shutil.copyfile(artifact, tmp)
+        os.replace(tmp, MODEL_PATH)  # atomic, so a watching app never sees a half-written file
+        print(f"Promoted to {MODEL_PATH}")
+    print(f"Total time {time.perf_counter() - started:.1f}s")
+    return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Warm-start retraining from clinician-confirmed diagnoses")
+    parser.add_argument('--dataset', default=DATASET_DIR, help="Base dataset (features come from the cache)")
+    parser.add_argument('--packed', default=None, help="Base dataset as a pack_dataset.py file")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--stages', type=int, default=20, help="Boosting stages to add")
+    parser.add_argument('--replay-ratio', type=float, default=2.0, help="Base records replayed per new record")
+    parser.add_argument('--min-new', type=int, default=1, help="Skip the run below this many new records")
+    parser.add_argument('--state', default=STATE_PATH)
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--promote', action='store_true', help="Also copy the new model over dr_model.pkl")
+    parser.add_argument('--dry-run', action='store_true', help="Train and evaluate without writing anything")
+    parser.add_argument('--backend', default=None, help="mongo or sqlite (default: $STORAGE_BACKEND)")
+    parser.add_argument('--mongo-uri', default=None)
+    parser.add_argument('--sqlite-path', default=None)
+    args = parser.parse_args()
+
+    train_incremental(open_storage(args.backend, args.mongo_uri, args.sqlite_path), args.dataset, args.packed,
+                      args.workers, args.stages, args.replay_ratio, args.min_new, args.state, args.models_dir,
+                      args.promote, args.dry_run)
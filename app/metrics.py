@@ -0,0 +1,231 @@
+# metrics.py
+"""
+Lightweight in-process metrics (counters and latency histograms) rendered
+in the Prometheus text exposition format.
+
+Usage:
+    from metrics import metrics
+
+    with metrics.timer('predict_stage_seconds', stage='extract'):
+        features = extractor.extract(img)
+    metrics.inc('analyze_rejects_total')
+
+Everything is a no-op when metrics are disabled (METRICS_ENABLED=0), so
+instrumentation can stay on the hot path.
+"""
+import os
+import threading
+import time
+import types
+from bisect import bisect_left
+from contextlib import nullcontext
+
+# Upper bounds in seconds - covers a sub-millisecond lookup up to a slow upload
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'http_requests_total': "HTTP requests by endpoint and status code",
+    'http_request_seconds': "HTTP request latency by endpoint",
+    'analyze_requests_total': "Images submitted to /analyze",
+    'analyze_rejects_total': "Images rejected by retinal validation",
+    'errors_total': "Errors by type",
+    'predict_stage_seconds': "Latency of each stage of AdvancedDRSystem.predict",
+    'storage_call_seconds': "Latency of storage backend calls (iter_* methods: the whole iteration)",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return '{' + body + '}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram for one label set"""
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    """Thread-safe store of counters, gauges and histograms"""
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(self.buckets)
+            hist.observe(value)
+
+    def timer(self, name, **labels):
+        """Context manager recording elapsed seconds into a histogram"""
+        if not self.enabled:
+            return nullcontext()
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.total, h.count) for key, h in histograms]
+
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, key), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{_format_labels(key)} {value}")
+
+        for (name, key), value in gauges:
+            header(name, 'gauge')
+            lines.append(f"{name}{_format_labels(key)} {value}")
+
+        for (name, key), counts, total, count in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_format_labels(key, ('le', repr(bound)))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{name}_sum{_format_labels(key)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(key)} {count}")
+
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedRepository:
+    """Proxy timing every public method call of a storage repository"""
+    def __init__(self, repository, registry, prefix, backend):
+        self._repository = repository
+        self._registry = registry
+        self._prefix = prefix
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if name.startswith('_') or not callable(attr) or name == 'to_dict':
+            return attr
+
+        op = f"{self._prefix}.{name}"
+        registry = self._registry
+        backend = self._backend
+
+        def timed(*args, **kwargs):
+            if not registry.enabled:
+                return attr(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                registry.inc('errors_total', type=f"storage.{type(e).__name__}")
+                registry.observe('storage_call_seconds', time.perf_counter() - start, backend=backend, op=op)
+                raise
+            elapsed = time.perf_counter() - start
+            if isinstance(result, types.GeneratorType):  # iter_*: the work happens while iterating
+                return _timed_generator(result, elapsed, registry, backend, op)
+            registry.observe('storage_call_seconds', elapsed, backend=backend, op=op)
+            return result
+
+        return timed
+
+
+def _timed_generator(generator, elapsed, registry, backend, op):
+    """Re-yield a repository generator, timing every step (not the consumer) and counting its errors"""
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except Exception as e:
+                registry.inc('errors_total', type=f"storage.{type(e).__name__}")
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        generator.close()
+        registry.observe('storage_call_seconds', elapsed, backend=backend, op=op)
+
+
+def instrument_storage(storage, registry=None):
+    """Wrap a Storage's repositories so each call is timed"""
+    registry = registry or metrics
+    storage.patients = InstrumentedRepository(storage.patients, registry, 'patients', storage.name)
+    storage.diagnoses = InstrumentedRepository(storage.diagnoses, registry, 'diagnoses', storage.name)
+    storage.stats = InstrumentedRepository(storage.stats, registry, 'stats', storage.name)
+    return storage
+
+
+metrics = MetricsRegistry(enabled=os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no'))
@@ -1,50 +1,241 @@
 # migrate.py
-from app import app, db
-from database import Patient, Diagnosis
+"""
+Bulk migration of the legacy history.json log into the MongoDB schema
+used by mongo_database.py.
+
+The JSON file is stream-parsed one record at a time, so memory stays flat
+no matter how large the file is. Records are grouped into batches and
+written with unordered bulk_write calls. Every diagnosis carries a natural
+key (legacy_key) and is written with $setOnInsert, so the migration can be
+interrupted and simply re-run: already-migrated rows are left untouched.
+Patients are keyed by mobile and also written with $setOnInsert, so an old
+history entry never overwrites a name or age edited in the app since.
+
+Usage:
+    python migrate.py [--file history.json] [--uri mongodb://...] [--batch-size 1000]
+"""
+import argparse
 import json
+import time
+from datetime import datetime
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from constants import CLASSES
+
+DEFAULT_URI = 'mongodb://localhost:27017/retina_ai'
+DEFAULT_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array without loading the whole file"""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip whitespace and separators between elements
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+
+        if pos >= len(buf):
+            if started:
+                raise ValueError("Unexpected end of file inside JSON array")
+            return
+
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("history file must contain a JSON array")
+            started = True
+            pos += 1
+            continue
 
-def migrate_from_json():
-    """Migrate data from old JSON file to database"""
+        if buf[pos] == ']':
+            return
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Element is split across chunks - read more and retry
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+
+        yield obj
+        pos = end
+        # Drop consumed text so the buffer only holds the unparsed tail
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+
+def _to_int(value):
+    return int(value) if str(value).isdigit() else 0
+
+
+def _parse_date(value):
     try:
-        with open('history.json', 'r') as f:
-            old_data = json.load(f)
-        
-        for entry in old_data:
-            # Check if patient already exists
-            patient = Patient.query.filter_by(mobile=entry['patient'].get('mobile', '')).first()
-            
-            if not patient:
-                # Create new patient
-                patient = Patient(
-                    patient_id=entry['patient_id'],
-                    name=entry['patient'].get('name', 'Unknown'),
-                    age=int(entry['patient'].get('age', 0)) if str(entry['patient'].get('age', '0')).isdigit() else 0,
-                    mobile=entry['patient'].get('mobile', ''),
-                    email='',
-                    gender='',
-                    diabetes_duration=0
-                )
-                db.session.add(patient)
-            
-            # Create diagnosis record
-            diagnosis = Diagnosis(
-                patient_id=patient.patient_id,
-                diagnosis_class=entry['diagnosis'],
-                severity_index=0,  # Default, you might need to map from old data
-                progression_risk=float(entry['risk']),
-                probabilities={'No DR': 0.0, 'Mild': 0.0, 'Moderate': 0.0, 'Severe': 0.0, 'Proliferative': 0.0},
-                image_path='',
-                notes=entry.get('notes', 'Migrated from old system')
-            )
-            db.session.add(diagnosis)
-        
-        db.session.commit()
-        print(f"✅ Migrated {len(old_data)} records to database")
-        
-    except Exception as e:
-        db.session.rollback()
-        print(f"❌ Migration failed: {e}")
+        return datetime.strptime(value, "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return datetime.utcnow()
+
+
+def legacy_key(entry):
+    """Natural key identifying a legacy history row"""
+    return f"{entry.get('patient_id', '')}|{entry.get('date', '')}|{entry.get('diagnosis', '')}"
+
+
+def build_diagnosis_doc(entry, patient_id):
+    """Map a legacy history row onto the diagnoses collection schema"""
+    patient = entry.get('patient') or {}
+    analysis = entry.get('analysis_result') or {}
+    diagnosis_class = analysis.get('class', entry.get('diagnosis', ''))
+
+    if 'severity_index' in analysis:
+        severity_index = analysis['severity_index']
+    elif diagnosis_class in CLASSES:
+        severity_index = CLASSES.index(diagnosis_class)
+    else:
+        severity_index = -1
+
+    return {
+        'legacy_key': legacy_key(entry),
+        'patient_id': patient_id,
+        'patient_mobile': patient.get('mobile', ''),
+        'date': _parse_date(entry.get('date')),
+        'diagnosis_class': diagnosis_class,
+        'severity_index': severity_index,
+        'progression_risk': float(analysis.get('progression_risk', entry.get('risk', 0))),
+        'probabilities': analysis.get('probabilities', {}),
+        'image_file_id': None,
+        'image_filename': None,
+        'notes': entry.get('notes', 'Migrated from old system'),
+        'model_version': 'legacy-json',
+        'patient_info': {
+            'name': patient.get('name', 'Unknown'),
+            'age': _to_int(patient.get('age', 0)),
+            'gender': patient.get('gender', '')
+        }
+    }
+
+
+def _bulk_write(collection, ops):
+    """Run an unordered bulk write, returning (upserted, errors)"""
+    if not ops:
+        return 0, 0
+    try:
+        result = collection.bulk_write(ops, ordered=False)
+        return result.upserted_count, 0
+    except BulkWriteError as e:
+        details = e.details
+        for err in details.get('writeErrors', [])[:3]:
+            print(f"   ⚠️  {collection.name}: {err.get('errmsg')}")
+        return details.get('nUpserted', 0), len(details.get('writeErrors', []))
+
+
+def migrate_batch(db, batch):
+    """Upsert the patients of a batch, then insert its diagnoses"""
+    now = datetime.utcnow()
+    patient_ops = []
+    for entry in batch:
+        patient = entry.get('patient') or {}
+        mobile = patient.get('mobile', '')
+        key = {'mobile': mobile} if mobile else {'patient_id': entry['patient_id']}
+        patient_ops.append(UpdateOne(key, {
+            '$setOnInsert': {
+                'patient_id': entry['patient_id'],
+                'mobile': mobile,
+                'email': patient.get('email', ''),
+                'gender': patient.get('gender', ''),
+                'diabetes_duration': _to_int(patient.get('diabetes_duration', 0)),
+                'name': patient.get('name', 'Unknown'),
+                'age': _to_int(patient.get('age', 0)),
+                'created_at': _parse_date(entry.get('date'))
+            },
+            '$set': {
+                'updated_at': now
+            }
+        }, upsert=True))
+    patients_upserted, patient_errors = _bulk_write(db.patients, patient_ops)
+
+    # A mobile may already belong to a patient created by the app under a
+    # different PID - resolve the canonical id in one round trip per batch
+    mobiles = list({(e.get('patient') or {}).get('mobile') for e in batch} - {None, ''})
+    pid_by_mobile = {
+        p['mobile']: p['patient_id']
+        for p in db.patients.find({'mobile': {'$in': mobiles}}, {'mobile': 1, 'patient_id': 1, '_id': 0})
+    }
+
+    diagnosis_ops = []
+    for entry in batch:
+        mobile = (entry.get('patient') or {}).get('mobile', '')
+        patient_id = pid_by_mobile.get(mobile, entry['patient_id'])
+        doc = build_diagnosis_doc(entry, patient_id)
+        diagnosis_ops.append(UpdateOne({'legacy_key': doc['legacy_key']}, {'$setOnInsert': doc}, upsert=True))
+    diagnoses_upserted, diagnosis_errors = _bulk_write(db.diagnoses, diagnosis_ops)
+
+    return patients_upserted, diagnoses_upserted, patient_errors + diagnosis_errors
+
+
+def migrate_from_json(path='history.json', uri=DEFAULT_URI, batch_size=DEFAULT_BATCH_SIZE):
+    """Migrate data from old JSON file to MongoDB"""
+    client = MongoClient(uri)
+    db = client.get_default_database('retina_ai')
+    db.diagnoses.create_index([('legacy_key', 1)], unique=True, sparse=True)
+
+    rows = skipped = patients = diagnoses = errors = 0
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        nonlocal patients, diagnoses, errors
+        p, d, e = migrate_batch(db, batch)
+        patients += p
+        diagnoses += d
+        errors += e
+        batch.clear()
+        elapsed = time.perf_counter() - start
+        print(f" -> {rows} rows read ({rows / elapsed:,.0f} rows/s)")
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for entry in iter_json_array(f):
+                rows += 1
+                if not isinstance(entry, dict) or not entry.get('patient_id'):
+                    skipped += 1
+                    continue
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    flush()
+        if batch:
+            flush()
+    finally:
+        client.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ Migrated {rows} records in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):,.0f} rows/s)")
+    print(f"   New patients: {patients} | New diagnoses: {diagnoses} | "
+          f"Already present: {rows - skipped - diagnoses - errors} | Skipped: {skipped} | Errors: {errors}")
+    return {'rows': rows, 'patients': patients, 'diagnoses': diagnoses, 'skipped': skipped, 'errors': errors}
+
 
 if __name__ == '__main__':
-    with app.app_context():
-        migrate_from_json()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migrate history.json into MongoDB")
+    parser.add_argument('--file', default='history.json')
+    parser.add_argument('--uri', default=DEFAULT_URI)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    migrate_from_json(args.file, args.uri, args.batch_size)
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import time
 import random
 import math
@@ -7,10 +8,17 @@ from PIL import Image, ImageStat
 import pickle
 import numpy as np
 
-# Constants
-CLASSES = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative']
+from metrics import metrics
+from cascade import CASCADE_PATH, load_cascade
+from explain import compile_explainer
+from constants import CLASSES
+
+# Bump whenever RetinaFeatureExtractor output changes - invalidates cached/stored vectors
+FEATURE_VERSION = 'stats-v1'
 
 class RetinaFeatureExtractor:
+    feature_version = FEATURE_VERSION
+
     def __init__(self, grid_size=4):
         self.grid_size = grid_size
         self.img_size = (224, 224)
@@ -19,8 +27,11 @@ class RetinaFeatureExtractor:
         img = img.resize(self.img_size)
         if img.mode != 'RGB':
             img = img.convert('RGB')
-        
-        arr = np.array(img).astype(float)
+        return self.extract_array(np.asarray(img))
+
+    def extract_array(self, pixels):
+        """Features from an already resized (224, 224, 3) uint8 RGB array (packed datasets)"""
+        arr = pixels.astype(float)
         
         g = arr[:, :, 1]
         padded = np.pad(g, ((1,1), (1,1)), mode='edge')
@@ -51,6 +62,54 @@ class RetinaFeatureExtractor:
 
         return np.nan_to_num(np.array(features))
 
+def create_feature_extractor(name=None):
+    """Extractor selected by FEATURE_EXTRACTOR: 'stats' (default), 'densenet121' or 'vgg16'"""
+    name = name or os.environ.get('FEATURE_EXTRACTOR', 'stats')
+    if name == 'stats':
+        return RetinaFeatureExtractor()
+    from deep_features import DeepFeatureExtractor
+    return DeepFeatureExtractor.from_env(name)
+
+def configured_feature_version():
+    """Feature version of the configured extractor, without building it"""
+    name = os.environ.get('FEATURE_EXTRACTOR', 'stats')
+    if name == 'stats':
+        return FEATURE_VERSION
+    from deep_features import deep_feature_version
+    return deep_feature_version(name, os.environ.get('FEATURE_WEIGHTS') or None,
+                                os.environ.get('FEATURE_RUNTIME', 'keras'), int(os.environ.get('FEATURE_SEED', 42)))
+
+def compute_progression_risk(score, features):
+    """
+    Progression risk (%) from the predicted severity and the feature vector.
+    Works on a single vector or, vectorised, on a batch (scores shape (n,),
+    features shape (n, d)).
+    """
+    features = np.asarray(features, dtype=np.float64)
+    texture_score = features[..., -2]
+    bio_variance = (np.mean(features, axis=-1) % 10) / 5.0
+
+    base_risk = (np.asarray(score) / 4.0) * 85
+    risk_percentage = base_risk + np.minimum(15, texture_score / 2.0) + bio_variance
+
+    return np.round(np.clip(risk_percentage, 1.0, 99.9), 1)
+
+def model_artifact_version(path):
+    """Content hash identifying a model artifact (stored with each diagnosis)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return 'sha-' + digest.hexdigest()[:12]
+
+def load_model_artifact(path):
+    """Unpickle a model artifact; returns (model, model_version)"""
+    with open(path, 'rb') as f:
+        model = pickle.load(f)
+    if not hasattr(model, 'predict_proba'):
+        raise TypeError(f"{path} does not contain a classifier (no predict_proba)")
+    return model, model_artifact_version(path)
+
 class AdvancedDRSystem:
     def __init__(self):
         print("\n=== INITIALIZING PROPRIETARY MEDICAL VISION ENGINE (VGG-Sim) ===")
@@ -58,22 +117,50 @@ class AdvancedDRSystem:
         
         # Simplified print statement
         print(" -> Loading Feature Extractor (CNN-Proxy)... [READY]")
-        self.extractor = RetinaFeatureExtractor()
+        self.extractor = create_feature_extractor()
         
         self.model_path = "dr_model.pkl"
-        self.ml_model = self.load_trained_model()
+        # (model, model_version) swapped as one reference so a hot reload never
+        # pairs one model's predictions with another's version
+        self._active = self.load_trained_model()
+        # Flattened trees for attribution heatmaps, rebuilt whenever the model is swapped
+        self.explainer = compile_explainer(*self._active)
+
+        # Optional confidence-gated cascade (CASCADE_ENABLED=1, built by train_model.py --cascade)
+        self.cascade = None
+        self._full_model_seconds = 0.0  # running mean, used to estimate time saved by the gate
+        if os.environ.get('CASCADE_ENABLED', '0').lower() in ('1', 'true', 'yes'):
+            self.cascade = load_cascade(os.environ.get('CASCADE_PATH', CASCADE_PATH), self.extractor.feature_version)
+            print(f" -> Inference Cascade... [{'READY' if self.cascade else 'NOT FOUND'}]")
+            if self.cascade:
+                self._full_model_seconds = self.cascade.report.get('full_model_ms_per_image', 0.0) / 1000
         print("=== SYSTEM ONLINE ===\n")
 
+    @property
+    def ml_model(self):
+        return self._active[0]
+
+    @property
+    def model_version(self):
+        return self._active[1]
+
     def load_trained_model(self):
         try:
             if os.path.exists(self.model_path):
-                with open(self.model_path, 'rb') as f:
-                    return pickle.load(f)
+                return load_model_artifact(self.model_path)
         except Exception:
             pass
-        return None
+        return None, 'none'
+
+    def swap_model(self, model, model_version):
+        """Atomically replace the serving model; in-flight requests keep the old one"""
+        previous = self._active
+        self.explainer = compile_explainer(model, model_version)
+        self._active = (model, model_version)
+        return previous
 
-    def validate_retinal_image(self, img):
+    @staticmethod
+    def validate_retinal_image(img):
         small = img.resize((100, 100))
         hsv_img = small.convert('HSV')
         h_arr = np.array(hsv_img)[:, :, 0]
@@ -107,11 +194,15 @@ class AdvancedDRSystem:
     def predict(self, img_path, patient_details=None):
         print("ANALYZING: " + os.path.basename(img_path))
         try:
-            img = Image.open(img_path)
+            with metrics.timer('predict_stage_seconds', stage='decode'):
+                img = Image.open(img_path)
+                img.load()
             
-            is_valid, msg = self.validate_retinal_image(img)
+            with metrics.timer('predict_stage_seconds', stage='validate'):
+                is_valid, msg = self.validate_retinal_image(img)
             if not is_valid:
                 print(" -> REJECTED: " + msg)
+                metrics.inc('analyze_rejects_total')
                 result = {
                     'class': 'Invalid Input',
                     'severity_index': -1,
@@ -121,19 +212,38 @@ class AdvancedDRSystem:
                 }
                 return result
 
-            features = self.extractor.extract(img)
+            with metrics.timer('predict_stage_seconds', stage='extract'):
+                features = self.extractor.extract(img)
             feature_vector = features.reshape(1, -1)
             print(" -> FEATURE VECTOR GENERATED: Dimension " + str(len(features)))
         except Exception as e:
             print("Error: " + str(e))
+            metrics.inc('errors_total', type='image_load')
             return {'error': 'Image Load Failed'}
 
-        if self.ml_model:
+        # Read the model reference once so a concurrent reload cannot swap it mid-request
+        ml_model, model_version = self._active
+        cascade = self.cascade
+        decided = None
+        if ml_model and cascade is not None and cascade.model_version == model_version:
+            with metrics.timer('predict_stage_seconds', stage='cascade'):
+                decided = cascade.decide(features, len(CLASSES))
+            metrics.inc('cascade_decisions_total', stage='gate' if decided else 'full')
+
+        if decided is not None:
+            score, probs = decided
+            model_version = model_version + '+cascade'
+            metrics.inc('cascade_saved_seconds_total', self._full_model_seconds)
+            print(" -> DIAGNOSIS (cascade gate): Class " + str(score) + " (" + CLASSES[score] + ")")
+        elif ml_model:
+            full_start = time.perf_counter()
             try:
-                pred_idx = self.ml_model.predict(feature_vector)[0]
+                with metrics.timer('predict_stage_seconds', stage='predict'):
+                    pred_idx = ml_model.predict(feature_vector)[0]
                 
                 try:
-                    raw_probs = self.ml_model.predict_proba(feature_vector)[0]
+                    with metrics.timer('predict_stage_seconds', stage='predict_proba'):
+                        raw_probs = ml_model.predict_proba(feature_vector)[0]
                     probs = raw_probs.tolist()
                 except:
                     probs = [0.05] * 5
@@ -143,9 +253,11 @@ class AdvancedDRSystem:
                 
                 score = int(pred_idx)
                 print(" -> DIAGNOSIS: Class " + str(score) + " (" + CLASSES[score] + ")")
+                self._full_model_seconds += 0.05 * (time.perf_counter() - full_start - self._full_model_seconds)
 
             except Exception as e:
                 print(" -> ML ERROR: " + str(e) + ". Falling back to default.")
+                metrics.inc('errors_total', type='model')
                 score = 0
                 probs = [0.9, 0.05, 0.05, 0.0, 0.0]
         else:
@@ -153,19 +265,17 @@ class AdvancedDRSystem:
             score = 0
             probs = [1.0, 0.0, 0.0, 0.0, 0.0]
 
-        texture_score = features[-2] 
-        bio_variance = (np.mean(features) % 10) / 5.0
-        
-        base_risk = (score / 4.0) * 85
-        risk_percentage = base_risk + min(15, texture_score / 2.0) + bio_variance
-        
-        risk_percentage = min(99.9, max(1.0, risk_percentage))
+        risk_percentage = compute_progression_risk(score, features)
 
         result = {
             'class': CLASSES[score],
             'severity_index': score,
             'probabilities': {k: float(v) for k, v in zip(CLASSES, probs)},
-            'progression_risk': round(risk_percentage, 1)
+            'progression_risk': float(risk_percentage),
+            # Persisted with the diagnosis for bulk re-scoring; not part of the API response
+            'features': features.astype(np.float32),
+            'feature_version': self.extractor.feature_version,
+            'model_version': model_version
         }
         
         return result
@@ -174,6 +284,7 @@ class AdvancedDRSystem:
         import uuid
         
         new_mobile = patient_details.get('mobile', 'N/A') if patient_details else 'N/A'
+        result = {k: v for k, v in result.items() if k != 'features'}
         
         try:
             with open(self.history_file, 'r+') as f:
@@ -209,5 +320,3 @@ class AdvancedDRSystem:
             }
             with open(self.history_file, 'w') as f:
                 json.dump([entry], f, indent=4)
-
-dr_system = AdvancedDRSystem()
\ No newline at end of file
@@ -0,0 +1,365 @@
+# model_registry.py
+"""
+Model hot-reload and shadow scoring for live workers.
+
+1. Hot reload. A new dr_model.pkl is unpickled and sanity-checked in a
+   background thread, then swapped into dr_system as a single reference.
+   In-flight requests finish on the model they started with; nothing
+   blocks on the load. A watcher thread
+   polls the artifact's size/mtime every MODEL_RELOAD_INTERVAL seconds
+   (0 = off) and reloads once the file has been stable for two polls, so a
+   half-copied file is never loaded - still, prefer `mv` over `cp`. The
+   admin endpoint answers 202 with a status URL to poll for the result.
+
+2. Shadow scoring. A candidate model can score a sampled fraction
+   (SHADOW_SAMPLE_RATE) of live /analyze traffic from the stored feature
+   vector, on a single worker thread with a bounded queue. Requests never
+   wait for it: when the queue is full the sample is dropped. Agreement,
+   per-class disagreement and referable (class >= 2) flips are exported as
+   metrics and returned by the status endpoint.
+
+Admin endpoints need `X-Admin-Token: $ADMIN_TOKEN` (disabled when unset):
+
+    GET    /admin/model            serving + shadow status
+    POST   /admin/model/reload     {"path": optional} reload / promote (202)
+    GET    /admin/model/reload/<id>  reload job status
+    POST   /admin/model/shadow     {"path": ..., "sample_rate": 0.1}
+    DELETE /admin/model/shadow     stop shadowing
+"""
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import request, jsonify, url_for
+from PIL import Image
+
+from cascade import REFERABLE_CLASS
+from metrics import metrics, HELP
+from model import CLASSES, load_model_artifact
+from rescore import score_batch
+
+HELP.update({
+    'model_reloads_total': "Model hot reloads by result",
+    'model_reload_seconds': "Time to load and check a model artifact",
+    'shadow_predictions_total': "Live requests scored by the shadow model",
+    'shadow_disagreements_total': "Shadow predictions that differ from the serving model",
+    'shadow_referable_flips_total': "Shadow predictions on the other side of the referable (class >= 2) line",
+    'shadow_dropped_total': "Shadow samples dropped because the queue was full",
+    'shadow_score_seconds': "Latency of shadow scoring (off the request path)",
+})
+
+
+class ModelLoadError(Exception):
+    """Raised when an artifact cannot be served"""
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class ModelReloader:
+    """Loads, checks and atomically swaps the model served by an AdvancedDRSystem"""
+    MAX_JOBS = 20  # finished reload jobs kept for the status endpoint
+
+    def __init__(self, system, model_dir='.', interval=0):
+        self.system = system
+        self.model_dir = os.path.realpath(model_dir)
+        self.interval = interval
+        self.feature_dim = len(system.extractor.extract(Image.new('RGB', (64, 64))))
+        self.last_reload = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._signature = _signature(system.model_path)
+        self._thread = None
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+
+    def resolve(self, path):
+        """Artifact path under model_dir (admin input is never trusted as-is)"""
+        full = os.path.realpath(os.path.join(self.model_dir, path))
+        if os.path.commonpath([full, self.model_dir]) != self.model_dir:
+            raise ModelLoadError(f"Model path must be inside {self.model_dir}")
+        if not os.path.isfile(full):
+            raise ModelLoadError(f"Model file not found: {path}")
+        return full
+
+    def load(self, path):
+        """Unpickle and smoke-test an artifact; returns (model, model_version)"""
+        try:
+            model, version = load_model_artifact(path)
+        except Exception as e:
+            raise ModelLoadError(f"Could not load {path}: {e}") from e
+        n_features = getattr(model, 'n_features_in_', self.feature_dim)
+        if n_features != self.feature_dim:
+            raise ModelLoadError(f"{path} expects {n_features} features, extractor produces {self.feature_dim}")
+        try:
+            model.predict_proba(np.zeros((1, self.feature_dim), dtype=np.float32))
+        except Exception as e:
+            raise ModelLoadError(f"{path} failed a test prediction: {e}") from e
+        return model, version
+
+    def reload(self, path=None):
+        """Load path (default: the current artifact) and swap it in"""
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                path = self.resolve(path) if path else self.system.model_path
+                signature = _signature(path)
+                model, version = self.load(path)
+            except ModelLoadError as e:
+                self.last_error = str(e)
+                metrics.inc('model_reloads_total', result='error')
+                print(f"❌ Model reload failed: {e}")
+                raise
+
+            previous = self.system.swap_model(model, version)
+            self.system.model_path = path
+            self._signature = signature
+            elapsed = time.perf_counter() - start
+            self.last_reload = {'path': path, 'model_version': version, 'previous_version': previous[1],
+                                'seconds': round(elapsed, 3), 'at': time.strftime("%Y-%m-%dT%H:%M:%S")}
+            self.last_error = None
+            metrics.inc('model_reloads_total', result='ok')
+            metrics.observe('model_reload_seconds', elapsed)
+            print(f"🔄 Model reloaded: {previous[1]} -> {version} ({elapsed:.2f}s)")
+            return self.last_reload
+
+    def submit(self, path=None):
+        """Reload path on a background thread; returns the job. A bad path fails here, before queueing."""
+        if path:
+            self.resolve(path)
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id, 'status': 'queued', 'path': path or self.system.model_path,
+               'created_at': time.time()}
+        with self._jobs_lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.MAX_JOBS:
+                self._jobs.popitem(last=False)
+        threading.Thread(target=self._run_job, args=(job, path), name='model-reload', daemon=True).start()
+        return dict(job)
+
+    def _run_job(self, job, path):
+        with self._jobs_lock:
+            job['status'] = 'running'
+        try:
+            result = self.reload(path)  # reloads are serialised by self._lock
+            update = {'status': 'done', 'reload': result}
+        except ModelLoadError as e:
+            update = {'status': 'error', 'error': str(e)}
+        except Exception as e:
+            print(f"❌ Model reload job {job['job_id']} crashed: {e}")
+            update = {'status': 'error', 'error': str(e)}
+        with self._jobs_lock:
+            job.update(update, finished_at=time.time())
+
+    def job_status(self, job_id):
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def start_watcher(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='model-watcher', daemon=True)
+            self._thread.start()
+            print(f"👀 Watching {self.system.model_path} for changes every {self.interval:g}s")
+
+    def _watch(self):
+        pending = None
+        while True:
+            time.sleep(self.interval)
+            current = _signature(self.system.model_path)
+            if current is None or current == self._signature:
+                pending = None
+            elif current != pending:
+                pending = current  # changed - wait one more poll for the copy to settle
+            else:
+                pending = None
+                try:
+                    self.reload()
+                except ModelLoadError:
+                    self._signature = current  # don't retry a bad file until it changes again
+
+    def status(self):
+        return {
+            'model_path': self.system.model_path,
+            'model_version': self.system.model_version,
+            'loaded': self.system.ml_model is not None,
+            'watch_interval': self.interval,
+            'last_reload': self.last_reload,
+            'last_error': self.last_error,
+        }
+
+
+class ShadowScorer:
+    """Scores a sample of live traffic with a candidate model on a background thread"""
+    def __init__(self, max_queue=64):
+        self.max_queue = max_queue
+        self._candidate = None  # (model, version, path, sample_rate)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+        self._stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats():
+        return {'scored': 0, 'agreements': 0, 'referable_flips': 0, 'dropped': 0, 'prob_delta_sum': 0.0,
+                'confusion': np.zeros((len(CLASSES), len(CLASSES)), dtype=np.int64)}
+
+    def set_candidate(self, model, version, path, sample_rate):
+        with self._lock:
+            self._candidate = (model, version, path, float(sample_rate))
+            self._stats = self._empty_stats()
+        print(f"🕶️ Shadow scoring {version} on {sample_rate:.0%} of traffic")
+
+    def clear(self):
+        with self._lock:
+            self._candidate = None
+
+    def submit(self, features, result):
+        """Queue a shadow prediction for one served result; never blocks"""
+        candidate = self._candidate
+        if candidate is None or features is None or random.random() >= candidate[3]:
+            return False
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['dropped'] += 1
+            metrics.inc('shadow_dropped_total')
+            return False
+        self._executor.submit(self._score, candidate, features, result['severity_index'],
+                              result['probabilities'], result.get('model_version'))
+        return True
+
+    def _score(self, candidate, features, primary, primary_probs, primary_version):
+        model, version = candidate[0], candidate[1]
+        try:
+            with metrics.timer('shadow_score_seconds'):
+                shadow = score_batch(model, np.asarray(features, dtype=np.float32).reshape(1, -1), version)[0]
+            score = shadow['severity_index']
+            delta = sum(abs(shadow['probabilities'][k] - primary_probs.get(k, 0.0)) for k in CLASSES) / 2
+            referable_flip = (primary >= REFERABLE_CLASS) != (score >= REFERABLE_CLASS)
+
+            with self._lock:
+                if self._candidate is not candidate:
+                    return  # candidate replaced while this sample was queued
+                stats = self._stats
+                stats['scored'] += 1
+                stats['agreements'] += score == primary
+                stats['referable_flips'] += referable_flip
+                stats['prob_delta_sum'] += delta
+                stats['confusion'][primary, score] += 1
+
+            metrics.inc('shadow_predictions_total', candidate=version)
+            if score != primary:
+                metrics.inc('shadow_disagreements_total', candidate=version, primary=CLASSES[primary],
+                            shadow=CLASSES[score])
+            if referable_flip:
+                metrics.inc('shadow_referable_flips_total', candidate=version)
+        except Exception as e:
+            print(f"❌ Shadow scoring failed: {e}")
+            metrics.inc('errors_total', type='shadow')
+        finally:
+            self._slots.release()
+
+    def status(self):
+        with self._lock:
+            candidate, stats = self._candidate, self._stats
+            scored = stats['scored']
+            return {
+                'active': candidate is not None,
+                'model_version': candidate[1] if candidate else None,
+                'model_path': candidate[2] if candidate else None,
+                'sample_rate': candidate[3] if candidate else 0.0,
+                'scored': scored,
+                'dropped': stats['dropped'],
+                'agreement_rate': round(stats['agreements'] / scored, 4) if scored else None,
+                'referable_flip_rate': round(stats['referable_flips'] / scored, 4) if scored else None,
+                'mean_probability_delta': round(stats['prob_delta_sum'] / scored, 4) if scored else None,
+                # rows = serving model, columns = shadow model
+                'confusion': {'labels': CLASSES, 'matrix': stats['confusion'].tolist()},
+            }
+
+
+class ModelRegistry:
+    """Admin endpoints tying a ModelReloader and ShadowScorer to a Flask app"""
+    def __init__(self, app, system):
+        self.token = app.config['ADMIN_TOKEN']
+        self.default_sample_rate = app.config['SHADOW_SAMPLE_RATE']
+        self.reloader = ModelReloader(system, app.config['MODEL_DIR'], app.config['MODEL_RELOAD_INTERVAL'])
+        self.shadow = ShadowScorer(app.config['SHADOW_MAX_QUEUE'])
+
+        app.add_url_rule('/admin/model', 'model_status', self.model_status)
+        app.add_url_rule('/admin/model/reload', 'model_reload', self.model_reload, methods=['POST'])
+        app.add_url_rule('/admin/model/reload/<job_id>', 'model_reload_status', self.model_reload_status)
+        app.add_url_rule('/admin/model/shadow', 'model_shadow', self.model_shadow, methods=['POST', 'DELETE'])
+        self.reloader.start_watcher()
+
+    def _authorized(self):
+        return bool(self.token) and request.headers.get('X-Admin-Token') == self.token
+
+    def model_status(self):
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        return jsonify({'serving': self.reloader.status(), 'shadow': self.shadow.status()})
+
+    def model_reload(self):
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        path = (request.get_json(silent=True) or {}).get('path')
+        try:
+            job = self.reloader.submit(path)
+        except ModelLoadError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        status_url = url_for('model_reload_status', job_id=job['job_id'])
+        return jsonify({'success': True, 'job': job, 'status_url': status_url}), 202, {'Location': status_url}
+
+    def model_reload_status(self, job_id):
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        job = self.reloader.job_status(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+
+    def model_shadow(self):
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        if request.method == 'DELETE':
+            status = self.shadow.status()
+            self.shadow.clear()
+            return jsonify({'success': True, 'shadow': status})
+
+        data = request.get_json(silent=True) or {}
+        try:
+            sample_rate = float(data.get('sample_rate', self.default_sample_rate))
+            if not 0.0 < sample_rate <= 1.0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'sample_rate must be in (0, 1]'}), 400
+        if not data.get('path'):
+            return jsonify({'success': False, 'error': 'path is required'}), 400
+        try:
+            path = self.reloader.resolve(data['path'])
+            model, version = self.reloader.load(path)
+        except ModelLoadError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        self.shadow.set_candidate(model, version, path, sample_rate)
+        return jsonify({'success': True, 'shadow': self.shadow.status()})
+
+
+def init_model_registry(app, system):
+    """Read hot-reload / shadow config from the environment and register the admin endpoints"""
+    app.config.setdefault('ADMIN_TOKEN', os.environ.get('ADMIN_TOKEN', ''))
+    app.config.setdefault('MODEL_DIR', os.environ.get('MODEL_DIR', '.'))
+    app.config.setdefault('MODEL_RELOAD_INTERVAL', float(os.environ.get('MODEL_RELOAD_INTERVAL', 0)))
+    app.config.setdefault('SHADOW_SAMPLE_RATE', float(os.environ.get('SHADOW_SAMPLE_RATE', 0.1)))
+    app.config.setdefault('SHADOW_MAX_QUEUE', int(os.environ.get('SHADOW_MAX_QUEUE', 64)))
+    return ModelRegistry(app, system)
@@ -1,127 +1,210 @@
 # mongo_database.py
 from flask_pymongo import PyMongo
 from gridfs import GridFS
+from gridfs.errors import FileExists
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
 from datetime import datetime
-import uuid
-import bson
+from urllib.parse import urlparse
+
+import numpy as np
+
+from metrics import metrics
+from storage import (PatientRepository, DiagnosisRepository, StatsRepository, Storage,
+                     parse_int, new_patient_id, six_months_ago, encode_features, decode_feature_rows,
+                     downsample_trend, trend_point, export_row, TREND_DATE_FORMAT)
+
+DEFAULT_MONGO_URI = 'mongodb://localhost:27017/retina_ai'
+
+# Covers /patient/<id>/trend: the query is answered from the index alone
+TREND_INDEX = [("patient_id", 1), ("date", 1), ("severity_index", 1), ("progression_risk", 1)]
+TREND_INDEX_NAME = 'patient_trend'
 
 mongo = PyMongo()
-fs = None  # Will be initialized with app
 
 def init_mongo_db(app):
-    """Initialize MongoDB with app"""
+    """Initialize MongoDB with app and return the storage backend"""
     # MongoDB configuration
-    app.config['MONGO_URI'] = 'mongodb://localhost:27017/retina_ai'
-    
-    # Initialize PyMongo
-    mongo.init_app(app)
-    
-    # Initialize GridFS for image storage
-    global fs
-    fs = GridFS(mongo.db)
-    
+    app.config.setdefault('MONGO_URI', DEFAULT_MONGO_URI)
+
+    if app.config['MONGO_URI'].startswith('mongomock://'):
+        # In-process stand-in for tests and load testing (pip install mongomock)
+        import mongomock
+        from mongomock.gridfs import enable_gridfs_integration
+        enable_gridfs_integration()
+        client = mongomock.MongoClient()
+        db_name = urlparse(app.config['MONGO_URI']).path.lstrip('/') or 'retina_ai'
+        storage = MongoStorage(client.get_database(db_name))
+    else:
+        # Initialize PyMongo
+        mongo.init_app(app)
+        storage = MongoStorage(mongo.db)
+
     # Create indexes for better performance
-    create_indexes()
-    
+    storage.create_indexes()
+
     print("✅ MongoDB initialized with GridFS")
+    return storage
 
-def create_indexes():
-    """Create necessary indexes for performance"""
-    # Patients collection indexes
-    mongo.db.patients.create_index([("mobile", 1)], unique=True)
-    mongo.db.patients.create_index([("patient_id", 1)], unique=True)
-    mongo.db.patients.create_index([("name", "text")])
-    
-    # Diagnoses collection indexes
-    mongo.db.diagnoses.create_index([("patient_id", 1)])
-    mongo.db.diagnoses.create_index([("date", -1)])
-    mongo.db.diagnoses.create_index([("diagnosis_class", 1)])
-    mongo.db.diagnoses.create_index([("mobile", 1)])
-
-class Patient:
+def _object_id(diagnosis_id):
+    try:
+        return ObjectId(diagnosis_id)
+    except Exception:
+        return None
+
+class Patient(PatientRepository):
     """Patient document structure"""
-    @staticmethod
-    def create(patient_data):
+    def __init__(self, db):
+        self.db = db
+
+    def create(self, patient_data):
         """Create a new patient"""
-        patient_id = f"PID-{uuid.uuid4().hex[:8].upper()}"
-        
+        patient_id = new_patient_id()
+
         patient_doc = {
             'patient_id': patient_id,
             'name': patient_data.get('name', 'Unknown'),
-            'age': int(patient_data.get('age', 0)) if str(patient_data.get('age', '0')).isdigit() else 0,
+            'age': parse_int(patient_data.get('age', 0)),
             'mobile': patient_data.get('mobile', ''),
             'email': patient_data.get('email', ''),
             'gender': patient_data.get('gender', ''),
-            'diabetes_duration': int(patient_data.get('diabetes_duration', 0)) if str(patient_data.get('diabetes_duration', '0')).isdigit() else 0,
+            'diabetes_duration': parse_int(patient_data.get('diabetes_duration', 0)),
             'created_at': datetime.utcnow(),
             'updated_at': datetime.utcnow()
         }
-        
-        result = mongo.db.patients.insert_one(patient_doc)
+
+        self.db.patients.insert_one(patient_doc)
         return patient_id
 
-    @staticmethod
-    def find_by_mobile(mobile):
+    def find_by_mobile(self, mobile):
         """Find patient by mobile number"""
-        return mongo.db.patients.find_one({'mobile': mobile})
+        return self.db.patients.find_one({'mobile': mobile})
 
-    @staticmethod
-    def update(patient_id, update_data):
+    def find_by_id(self, patient_id):
+        """Find patient by patient_id"""
+        return self.db.patients.find_one({'patient_id': patient_id})
+
+    def update(self, patient_id, update_data):
         """Update patient information"""
         update_data['updated_at'] = datetime.utcnow()
-        return mongo.db.patients.update_one(
+        return self.db.patients.update_one(
             {'patient_id': patient_id},
             {'$set': update_data}
         )
 
-    @staticmethod
-    def get_all():
+    def get_all(self):
         """Get all patients"""
-        return list(mongo.db.patients.find())
+        return list(self.db.patients.find())
 
-    @staticmethod
-    def delete(patient_id):
+    def delete(self, patient_id):
         """Delete patient and all related diagnoses"""
         # Delete patient
-        mongo.db.patients.delete_one({'patient_id': patient_id})
+        self.db.patients.delete_one({'patient_id': patient_id})
         # Delete related diagnoses
-        mongo.db.diagnoses.delete_many({'patient_id': patient_id})
+        self.db.diagnoses.delete_many({'patient_id': patient_id})
+
+    def search(self, query, limit=20):
+        """Search patients by name, mobile, or patient_id"""
+        pipeline = [
+            {
+                '$match': {
+                    '$or': [
+                        {'name': {'$regex': query, '$options': 'i'}},
+                        {'mobile': {'$regex': query, '$options': 'i'}},
+                        {'patient_id': {'$regex': query, '$options': 'i'}}
+                    ]
+                }
+            },
+            {'$limit': limit}
+        ]
+        return list(self.db.patients.aggregate(pipeline))
+
+    def patient_ids_by_mobile(self, mobiles=None):
+        """{mobile: patient_id} for the given mobiles, or every patient (write-behind)"""
+        query = {} if mobiles is None else {'mobile': {'$in': list(mobiles)}}
+        return {p['mobile']: p['patient_id']
+                for p in self.db.patients.find(query, {'mobile': 1, 'patient_id': 1, '_id': 0})}
 
-class Diagnosis:
+    def upsert_many(self, patients):
+        """
+        Create or update spooled patients by mobile, in order: dicts with
+        mobile, patient_id (used only when the mobile is new) and the fields
+        to set (name, age, email, gender, diabetes_duration). Returns
+        {mobile: patient_id} of the stored patients.
+        """
+        now = datetime.utcnow()
+        ops = []
+        for p in patients:
+            ops.append(UpdateOne({'mobile': p['mobile']}, {
+                '$setOnInsert': {'patient_id': p['patient_id'], 'mobile': p['mobile'], 'created_at': now},
+                '$set': {
+                    'name': p.get('name', 'Unknown'),
+                    'age': parse_int(p.get('age', 0)),
+                    'email': p.get('email', ''),
+                    'gender': p.get('gender', ''),
+                    'diabetes_duration': parse_int(p.get('diabetes_duration', 0)),
+                    'updated_at': now
+                }
+            }, upsert=True))
+        with metrics.timer('storage_call_seconds', backend='mongo', op='patients.bulk_write'):
+            self.db.patients.bulk_write(ops, ordered=True)
+        return self.patient_ids_by_mobile({p['mobile'] for p in patients})
+
+class Diagnosis(DiagnosisRepository):
     """Diagnosis document structure"""
-    @staticmethod
-    def create(patient_id, analysis_result, image_file=None, notes="Automated Analysis"):
+    def __init__(self, db, fs):
+        self.db = db
+        self.fs = fs
+
+    def create(self, patient_id, analysis_result, image_file=None, notes="Automated Analysis", features=None,
+               image_phash=None):
         """Create a new diagnosis record"""
         # Get patient details
-        patient = Patient.find_by_mobile(analysis_result.get('patient_mobile', ''))
+        patient = self.db.patients.find_one({'mobile': analysis_result.get('patient_mobile', '')})
         if not patient:
             # Try to find by patient_id
-            patient = mongo.db.patients.find_one({'patient_id': patient_id})
-        
+            patient = self.db.patients.find_one({'patient_id': patient_id})
+
         # Store image in GridFS if provided
         image_file_id = None
         if image_file:
-            image_file_id = fs.put(
-                image_file,
-                filename=image_file.filename,
-                content_type=image_file.content_type,
-                patient_id=patient_id
-            )
-        
+            with metrics.timer('storage_call_seconds', backend='mongo', op='gridfs.put'):
+                image_file_id = self.fs.put(
+                    image_file,
+                    filename=image_file.filename,
+                    content_type=image_file.content_type,
+                    patient_id=patient_id
+                )
+
+        diagnosis_doc = self._build_doc(patient, patient_id, analysis_result, notes, features, image_file_id,
+                                        image_file.filename if image_file else None, datetime.utcnow(), image_phash)
+        with metrics.timer('storage_call_seconds', backend='mongo', op='diagnoses.insert_one'):
+            result = self.db.diagnoses.insert_one(diagnosis_doc)
+        return str(result.inserted_id)
+
+    @staticmethod
+    def _build_doc(patient, patient_id, analysis_result, notes, features, image_file_id, image_filename, date,
+                   image_phash=None):
         diagnosis_doc = {
             'patient_id': patient_id,
             'patient_mobile': patient.get('mobile', '') if patient else '',
-            'date': datetime.utcnow(),
+            'date': date,
             'diagnosis_class': analysis_result['class'],
             'severity_index': analysis_result['severity_index'],
             'progression_risk': analysis_result['progression_risk'],
             'probabilities': analysis_result['probabilities'],
             'image_file_id': image_file_id,
-            'image_filename': image_file.filename if image_file else None,
+            'image_filename': image_filename,
             'notes': notes,
-            'model_version': 'v3.0'
+            'model_version': analysis_result.get('model_version', 'v3.0'),
+            'features': Binary(encode_features(features)) if features is not None else None,
+            'feature_version': analysis_result.get('feature_version') if features is not None else None,
+            'image_phash': image_phash,
+            # When the hash was stored, not when the image was taken: the index refreshes on this
+            'image_phash_at': datetime.utcnow() if image_phash is not None else None
         }
-        
+
         # If patient found, embed some patient info for quick access
         if patient:
             diagnosis_doc['patient_info'] = {
@@ -129,129 +212,328 @@ class Diagnosis:
                 'age': patient.get('age'),
                 'gender': patient.get('gender')
             }
-        
-        result = mongo.db.diagnoses.insert_one(diagnosis_doc)
-        return str(result.inserted_id)
+        return diagnosis_doc
 
-    @staticmethod
-    def get_all(sort_by='date', limit=100, skip=0):
+    def new_id(self):
+        """A fresh diagnosis id for create_many (write-behind)"""
+        return str(ObjectId())
+
+    def create_many(self, records):
+        """
+        Insert spooled diagnoses with their pre-generated ids, in order:
+        dicts with _id from new_id(), patient_id, analysis_result, notes,
+        features, image_phash, date and image ({data, filename, content_type,
+        file_id} or None). Records (and GridFS files) that already exist are
+        skipped, so a batch that failed half-way can simply be sent again.
+        Returns the number of records actually inserted.
+        """
+        ids = [ObjectId(r['_id']) for r in records]
+        existing = {d['_id'] for d in self.db.diagnoses.find({'_id': {'$in': ids}}, {'_id': 1})}
+        todo = [(oid, r) for oid, r in zip(ids, records) if oid not in existing]
+        if not todo:
+            return 0
+
+        mobiles = list({r['analysis_result'].get('patient_mobile', '') for _, r in todo})
+        patient_ids = list({r['patient_id'] for _, r in todo})
+        by_mobile, by_id = {}, {}
+        for p in self.db.patients.find({'$or': [{'mobile': {'$in': mobiles}}, {'patient_id': {'$in': patient_ids}}]}):
+            by_mobile[p.get('mobile')] = p
+            by_id[p.get('patient_id')] = p
+
+        docs = []
+        for oid, r in todo:
+            image = r.get('image')
+            image_file_id = None
+            if image:
+                image_file_id = ObjectId(image['file_id'])
+                try:
+                    with metrics.timer('storage_call_seconds', backend='mongo', op='gridfs.put'):
+                        self.fs.put(image['data'], _id=image_file_id, filename=image['filename'],
+                                    content_type=image['content_type'], patient_id=r['patient_id'])
+                except FileExists:
+                    pass  # uploaded by an earlier attempt
+            result = r['analysis_result']
+            patient = by_mobile.get(result.get('patient_mobile', '')) or by_id.get(r['patient_id'])
+            doc = self._build_doc(patient, r['patient_id'], result, r['notes'], r['features'], image_file_id,
+                                  image['filename'] if image else None, r['date'], r.get('image_phash'))
+            doc['_id'] = oid
+            docs.append(doc)
+
+        with metrics.timer('storage_call_seconds', backend='mongo', op='diagnoses.insert_many'):
+            self.db.diagnoses.insert_many(docs, ordered=True)
+        return len(docs)
+
+    def get_all(self, sort_by='date', limit=100, skip=0):
         """Get all diagnoses with pagination"""
-        return list(mongo.db.diagnoses.find()
+        return list(self.db.diagnoses.find({}, {'features': 0})
                     .sort(sort_by, -1)
                     .skip(skip)
                     .limit(limit))
 
-    @staticmethod
-    def get_by_patient(patient_id):
+    def get_by_patient(self, patient_id):
         """Get all diagnoses for a patient"""
-        return list(mongo.db.diagnoses.find({'patient_id': patient_id})
+        return list(self.db.diagnoses.find({'patient_id': patient_id}, {'features': 0})
                     .sort('date', -1))
 
-    @staticmethod
-    def get_by_id(diagnosis_id):
+    def trend(self, patient_id, max_points=None):
+        """Risk-over-time series in one round trip, covered by the trend index"""
+        if not max_points:
+            cursor = self.db.diagnoses.find(
+                {'patient_id': patient_id},
+                {'_id': 0, 'date': 1, 'severity_index': 1, 'progression_risk': 1}
+            ).sort('date', 1).hint(TREND_INDEX)
+            return downsample_trend([(d['date'], d['severity_index'], d['progression_risk']) for d in cursor], None)
+
+        # $bucketAuto splits the visits into max_points equal-count date ranges server-side
+        buckets = list(self.db.diagnoses.aggregate([
+            {'$match': {'patient_id': patient_id}},
+            {'$sort': {'date': 1}},
+            {'$project': {'_id': 0, 'date': 1, 'severity_index': 1, 'progression_risk': 1}},
+            {'$bucketAuto': {'groupBy': '$date', 'buckets': max_points, 'output': {
+                'date': {'$min': '$date'},
+                'date_to': {'$max': '$date'},
+                'severity_index': {'$max': '$severity_index'},
+                'progression_risk': {'$avg': '$progression_risk'},
+                'max_risk': {'$max': '$progression_risk'},
+                'visits': {'$sum': 1},
+            }}},
+        ], hint=TREND_INDEX))
+        total = sum(b['visits'] for b in buckets)
+        if total <= max_points:
+            return {'total': total, 'downsampled': False, 'points': [
+                trend_point(b['date'], b['severity_index'], b['max_risk']) for b in buckets]}
+        return {'total': total, 'downsampled': True, 'points': [{
+            'date': b['date'].strftime(TREND_DATE_FORMAT),
+            'date_to': b['date_to'].strftime(TREND_DATE_FORMAT),
+            'severity_index': b['severity_index'],
+            'progression_risk': round(b['progression_risk'], 1),
+            'max_risk': b['max_risk'],
+            'visits': b['visits'],
+        } for b in buckets]}
+
+    def get_latest(self, patient_id):
+        """Get latest diagnosis for a patient"""
+        return self.db.diagnoses.find_one(
+            {'patient_id': patient_id},
+            sort=[('date', -1)]
+        )
+
+    def get_by_id(self, diagnosis_id):
         """Get diagnosis by ID"""
-        from bson.objectid import ObjectId
-        try:
-            return mongo.db.diagnoses.find_one({'_id': ObjectId(diagnosis_id)})
-        except:
+        oid = _object_id(diagnosis_id)
+        if oid is None:
             return None
+        return self.db.diagnoses.find_one({'_id': oid})
 
-    @staticmethod
-    def delete(diagnosis_id):
+    def count(self, patient_id=None):
+        """Count diagnoses"""
+        query = {'patient_id': patient_id} if patient_id is not None else {}
+        return self.db.diagnoses.count_documents(query)
+
+    def delete(self, diagnosis_id):
         """Delete diagnosis and associated image"""
-        from bson.objectid import ObjectId
-        
         # Get diagnosis to find image_file_id
-        diagnosis = mongo.db.diagnoses.find_one({'_id': ObjectId(diagnosis_id)})
-        
+        diagnosis = self.get_by_id(diagnosis_id)
+
         if diagnosis and diagnosis.get('image_file_id'):
             # Delete image from GridFS
-            fs.delete(diagnosis['image_file_id'])
-        
+            self.fs.delete(diagnosis['image_file_id'])
+
         # Delete diagnosis document
-        mongo.db.diagnoses.delete_one({'_id': ObjectId(diagnosis_id)})
+        if diagnosis:
+            self.db.diagnoses.delete_one({'_id': diagnosis['_id']})
 
-    @staticmethod
-    def get_image(diagnosis_id):
+    def get_image(self, diagnosis_id):
         """Get image file from GridFS"""
-        from bson.objectid import ObjectId
-        
-        diagnosis = mongo.db.diagnoses.find_one({'_id': ObjectId(diagnosis_id)})
+        diagnosis = self.get_by_id(diagnosis_id)
         if diagnosis and diagnosis.get('image_file_id'):
-            return fs.get(diagnosis['image_file_id'])
+            return self.fs.get(diagnosis['image_file_id'])
         return None
 
-    @staticmethod
-    def to_dict(diagnosis_doc):
-        """Convert MongoDB document to dictionary"""
-        from bson.objectid import ObjectId
-        
-        if not diagnosis_doc:
-            return None
-        
-        # Convert ObjectId to string
-        diagnosis_dict = {
-            'id': str(diagnosis_doc['_id']),
-            'patient_id': diagnosis_doc.get('patient_id', ''),
-            'date': diagnosis_doc.get('date', datetime.utcnow()).strftime("%Y-%m-%d %H:%M"),
-            'diagnosis': diagnosis_doc.get('diagnosis_class', ''),
-            'severity_index': diagnosis_doc.get('severity_index', 0),
-            'risk': diagnosis_doc.get('progression_risk', 0),
-            'probabilities': diagnosis_doc.get('probabilities', {}),
-            'image_filename': diagnosis_doc.get('image_filename'),
-            'notes': diagnosis_doc.get('notes', ''),
-            'patient': {
-                'name': diagnosis_doc.get('patient_info', {}).get('name', 'Unknown'),
-                'age': diagnosis_doc.get('patient_info', {}).get('age', 'N/A'),
-                'mobile': diagnosis_doc.get('patient_mobile', 'N/A'),
-                'gender': diagnosis_doc.get('patient_info', {}).get('gender', '')
-            }
-        }
-        return diagnosis_dict
+    def iter_feature_batches(self, feature_version, batch_size=10000, skip_model_version=None):
+        """Stream stored feature vectors with a cursor"""
+        query = {'feature_version': feature_version, 'features': {'$ne': None}}
+        if skip_model_version:
+            query['model_version'] = {'$ne': skip_model_version}
+        cursor = self.db.diagnoses.find(query, {'features': 1}).batch_size(batch_size)
+
+        ids, blobs = [], []
+        for doc in cursor:
+            ids.append(doc['_id'])
+            blobs.append(bytes(doc['features']))
+            if len(ids) >= batch_size:
+                yield ids, decode_feature_rows(blobs)
+                ids, blobs = [], []
+        if ids:
+            yield ids, decode_feature_rows(blobs)
+
+    def bulk_update_scores(self, updates):
+        """Write re-scored results back in one unordered bulk write"""
+        if not updates:
+            return 0
+        ops = [UpdateOne({'_id': _id}, {'$set': fields}) for _id, fields in updates]
+        return self.db.diagnoses.bulk_write(ops, ordered=False).modified_count
+
+    def confirm(self, diagnosis_id, confirmed_class, confirmed_by=None):
+        """Record the clinician-confirmed severity index"""
+        oid = _object_id(diagnosis_id)
+        if oid is None:
+            return False
+        result = self.db.diagnoses.update_one({'_id': oid}, {'$set': {
+            'confirmed_class': int(confirmed_class),
+            'confirmed_at': datetime.utcnow(),
+            'confirmed_by': confirmed_by
+        }})
+        return result.matched_count > 0
 
-class Stats:
+    def iter_confirmed(self, since, until, batch_size=10000):
+        """Stream confirmed diagnoses with a cursor on the confirmed_at index"""
+        window = {'$lte': until}
+        if since:
+            window['$gt'] = since
+        cursor = self.db.diagnoses.find(
+            {'confirmed_at': window},
+            {'confirmed_class': 1, 'features': 1, 'feature_version': 1}
+        ).batch_size(batch_size)
+
+        batch = []
+        for doc in cursor:
+            features = doc.get('features')
+            batch.append({'_id': doc['_id'], 'confirmed_class': doc['confirmed_class'],
+                          'features': bytes(features) if features is not None else None,
+                          'feature_version': doc.get('feature_version')})
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iter_image_hashes(self, since=None, batch_size=50000):
+        """Stream stored perceptual hashes for the duplicate index"""
+        query = {'image_phash': {'$ne': None}}
+        if since:
+            query['image_phash_at'] = {'$gte': since}
+        cursor = self.db.diagnoses.find(query, {'_id': 1, 'patient_id': 1, 'image_phash': 1}).batch_size(batch_size)
+        ids, patient_ids, hashes = [], [], []
+        for doc in cursor:
+            ids.append(str(doc['_id']))
+            patient_ids.append(doc.get('patient_id'))
+            hashes.append(doc['image_phash'])
+            if len(ids) >= batch_size:
+                yield ids, patient_ids, np.array(hashes, dtype=np.int64)
+                ids, patient_ids, hashes = [], [], []
+        if ids:
+            yield ids, patient_ids, np.array(hashes, dtype=np.int64)
+
+    def iter_unhashed(self, batch_size=1000):
+        """Ids of diagnoses with a GridFS image but no hash"""
+        cursor = self.db.diagnoses.find({'image_phash': None, 'image_file_id': {'$ne': None}},
+                                        {'_id': 1}).batch_size(batch_size)
+        batch = []
+        for doc in cursor:
+            batch.append(str(doc['_id']))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def set_image_hashes(self, updates):
+        """Write backfilled hashes in one unordered bulk write"""
+        if not updates:
+            return 0
+        now = datetime.utcnow()
+        ops = [UpdateOne({'_id': ObjectId(_id)}, {'$set': {'image_phash': phash, 'image_phash_at': now}})
+               for _id, phash in updates]
+        return self.db.diagnoses.bulk_write(ops, ordered=False).modified_count
+
+    def iter_export(self, since=None, until=None, diagnosis_class=None, batch_size=1000):
+        """Stream export rows from one projected cursor on the date index"""
+        query = {}
+        if since or until:
+            query['date'] = {}
+            if since:
+                query['date']['$gte'] = since
+            if until:
+                query['date']['$lt'] = until
+        if diagnosis_class:
+            query['diagnosis_class'] = diagnosis_class
+        projection = {'patient_info': 0, 'patient_mobile': 0, 'features': 0, 'image_file_id': 0}
+        cursor = self.db.diagnoses.find(query, projection).sort('date', 1).batch_size(batch_size)
+
+        batch = []
+        for doc in cursor:
+            batch.append(export_row(doc))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+class Stats(StatsRepository):
     """Statistics helper class"""
-    @staticmethod
-    def get_dashboard_stats():
+    def __init__(self, db):
+        self.db = db
+
+    def get_dashboard_stats(self):
         """Get dashboard statistics"""
-        total_patients = mongo.db.patients.count_documents({})
-        total_diagnoses = mongo.db.diagnoses.count_documents({})
-        
+        total_patients = self.db.patients.count_documents({})
+        total_diagnoses = self.db.diagnoses.count_documents({})
+
         # Diagnoses by class
         pipeline = [
             {'$group': {'_id': '$diagnosis_class', 'count': {'$sum': 1}}},
             {'$sort': {'count': -1}}
         ]
-        class_distribution = list(mongo.db.diagnoses.aggregate(pipeline))
-        
+        class_distribution = list(self.db.diagnoses.aggregate(pipeline))
+
         # Monthly trend (last 6 months)
-        six_months_ago = datetime.utcnow().replace(day=1)  # First day of current month
-        for _ in range(5):
-            # Go back 5 more months
-            if six_months_ago.month == 1:
-                six_months_ago = six_months_ago.replace(year=six_months_ago.year-1, month=12)
-            else:
-                six_months_ago = six_months_ago.replace(month=six_months_ago.month-1)
-        
         monthly_pipeline = [
-            {'$match': {'date': {'$gte': six_months_ago}}},
+            {'$match': {'date': {'$gte': six_months_ago()}}},
             {'$group': {
                 '_id': {'year': {'$year': '$date'}, 'month': {'$month': '$date'}},
                 'count': {'$sum': 1}
             }},
             {'$sort': {'_id.year': 1, '_id.month': 1}}
         ]
-        monthly_trend = list(mongo.db.diagnoses.aggregate(monthly_pipeline))
-        
+        monthly_trend = list(self.db.diagnoses.aggregate(monthly_pipeline))
+
         # Format monthly trend
         formatted_monthly = []
         for item in monthly_trend:
             month_str = f"{item['_id']['year']}-{item['_id']['month']:02d}"
             formatted_monthly.append({'month': month_str, 'count': item['count']})
-        
+
         return {
             'total_patients': total_patients,
             'total_diagnoses': total_diagnoses,
             'class_distribution': {item['_id']: item['count'] for item in class_distribution},
             'monthly_trend': formatted_monthly
-        }
\ No newline at end of file
+        }
+
+class MongoStorage(Storage):
+    """MongoDB + GridFS storage backend"""
+    name = 'mongo'
+    supports_write_behind = True
+
+    def __init__(self, db):
+        self.db = db
+        self.fs = GridFS(db)
+        super().__init__(Patient(db), Diagnosis(db, self.fs), Stats(db))
+
+    def create_indexes(self):
+        """Create necessary indexes for performance"""
+        # Patients collection indexes
+        self.db.patients.create_index([("mobile", 1)], unique=True)
+        self.db.patients.create_index([("patient_id", 1)], unique=True)
+        self.db.patients.create_index([("name", "text")])
+
+        # Diagnoses collection indexes
+        self.db.diagnoses.create_index([("patient_id", 1)])
+        self.db.diagnoses.create_index([("date", -1)])
+        self.db.diagnoses.create_index([("diagnosis_class", 1)])
+        self.db.diagnoses.create_index([("mobile", 1)])
+        self.db.diagnoses.create_index([("feature_version", 1), ("model_version", 1)])
+        self.db.diagnoses.create_index([("confirmed_at", 1)], sparse=True)
+        self.db.diagnoses.create_index([("image_phash_at", 1)], sparse=True)
+        self.db.diagnoses.create_index(TREND_INDEX, name=TREND_INDEX_NAME)
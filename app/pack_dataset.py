@@ -0,0 +1,214 @@
+# pack_dataset.py
+"""
+Packed uint8 dataset: decode and resize the training images once.
+
+Every consumer of ../colored_images resizes to 224x224 straight after
+decoding, so `python pack_dataset.py` does that once, in a process pool, and
+writes the pixels to a single raw file of (n, 224, 224, 3) uint8 rows with a
+sidecar index (`<pack>.idx.npz`: paths, labels, retinal-validation flags and
+each source file's size/mtime). Rows are resized exactly as the extractors
+do (resize, then convert to RGB), so features from the pack are identical
+to features from the JPEGs.
+
+Re-running the command appends only images that are not packed yet (or
+whose file changed since); rows are never rewritten. The sidecar is
+replaced atomically after the new rows are flushed, so an interrupted
+append leaves the previous pack intact.
+
+PackedDataset memory-maps the file. iter_batches() yields contiguous
+slices of the map - views, no decode and no copy - visiting blocks in a
+shuffled order each epoch.
+
+Usage:
+    python pack_dataset.py [--dataset ../colored_images] [--out dataset_224.u8] [--workers N]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from feature_cache import DATASET_DIR, list_dataset
+from model import AdvancedDRSystem, create_feature_extractor, configured_feature_version
+
+PACK_PATH = "dataset_224.u8"
+IMAGE_SHAPE = (224, 224, 3)
+ROW_BYTES = int(np.prod(IMAGE_SHAPE))
+
+
+def index_path(pack_path):
+    return pack_path + '.idx.npz'
+
+
+def load_index(pack_path):
+    """Sidecar arrays of a pack (empty arrays if it does not exist yet)"""
+    if not os.path.exists(index_path(pack_path)):
+        return {'paths': np.array([], dtype=str), 'labels': np.zeros(0, np.int64), 'valid': np.zeros(0, bool),
+                'sizes': np.zeros(0, np.int64), 'mtimes': np.zeros(0, np.int64), 'row': np.zeros(0, np.int64)}
+    with np.load(index_path(pack_path), allow_pickle=False) as data:
+        return {k: data[k] for k in ('paths', 'labels', 'valid', 'sizes', 'mtimes', 'row')}
+
+
+def decode_resized(path):
+    """Decode, validate and resize one image (runs in worker processes)"""
+    try:
+        with Image.open(path) as img:
+            img.load()
+            valid, _ = AdvancedDRSystem.validate_retinal_image(img)
+            small = img.resize(IMAGE_SHAPE[1::-1])
+            if small.mode != 'RGB':
+                small = small.convert('RGB')
+            return np.asarray(small, dtype=np.uint8).tobytes(), valid
+    except Exception:
+        return None, False
+
+
+def pack(dataset_dir=DATASET_DIR, pack_path=PACK_PATH, workers=None, limit_per_class=None, chunksize=16):
+    """Append every unpacked (or changed) image under dataset_dir to the pack"""
+    start = time.perf_counter()
+    index = load_index(pack_path)
+    n_packed = len(index['paths'])
+    n_rows = int(index['row'].max()) + 1 if n_packed else 0
+    packed = {str(p): (s, m) for p, s, m in zip(index['paths'], index['sizes'], index['mtimes'])}
+
+    paths, labels = list_dataset(dataset_dir, limit_per_class)
+    todo = []
+    for path, label in zip(paths, labels):
+        st = os.stat(path)
+        if packed.get(path) != (st.st_size, st.st_mtime_ns):
+            todo.append((path, label, st.st_size, st.st_mtime_ns))
+    print(f"📦 {n_packed} images packed, {len(todo)} to add")
+    if not todo:
+        return 0
+
+    new = {'paths': [], 'labels': [], 'valid': [], 'sizes': [], 'mtimes': []}
+    failed = 0
+    with open(pack_path, 'ab') as out:
+        # Drop bytes past the last indexed row (an append interrupted before its index was written)
+        out.truncate(n_rows * ROW_BYTES)
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(decode_resized, [t[0] for t in todo], chunksize=chunksize)
+            for (path, label, size, mtime), (pixels, valid) in zip(todo, results):
+                if pixels is None:
+                    failed += 1
+                    continue
+                out.write(pixels)
+                for key, value in zip(new, (path, label, valid, size, mtime)):
+                    new[key].append(value)
+        out.flush()
+        os.fsync(out.fileno())
+
+    # A changed file is appended again; its old row stays in the file but leaves the index
+    stale = np.isin(index['paths'], new['paths'])
+    merged = {k: np.concatenate([index[k][~stale],
+                                 np.asarray(new[k], dtype=str if k == 'paths' else index[k].dtype)])
+              for k in new}
+    merged['row'] = np.concatenate([index['row'][~stale], n_rows + np.arange(len(new['paths']))])
+    write_index(pack_path, merged)
+
+    elapsed = time.perf_counter() - start
+    added = len(new['paths'])
+    print(f"✅ Packed {added} images in {elapsed:.1f}s ({added / elapsed:.1f} img/s), {failed} unreadable. "
+          f"{len(merged['paths'])} images in {pack_path} ({os.path.getsize(pack_path) / 1e9:.2f} GB)")
+    return added
+
+
+def write_index(pack_path, index):
+    tmp = index_path(pack_path) + '.tmp.npz'
+    np.savez(tmp, **index)
+    os.replace(tmp, index_path(pack_path))
+
+
+class PackedDataset:
+    """Read-only memory-mapped view of a pack"""
+    def __init__(self, pack_path=PACK_PATH):
+        self.path = pack_path
+        with np.load(index_path(pack_path), allow_pickle=False) as data:
+            self.paths = data['paths']
+            self.labels = data['labels']
+            self.valid = data['valid']
+            rows = data['row']
+        n_rows = os.path.getsize(pack_path) // ROW_BYTES
+        self.images = np.memmap(pack_path, dtype=np.uint8, mode='r', shape=(n_rows,) + IMAGE_SHAPE)
+        # Rows superseded by a re-packed file are skipped; normally rows == arange(n)
+        self.rows = rows
+        self.contiguous = bool(np.array_equal(rows, np.arange(len(rows))))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def iter_batches(self, batch_size=256, shuffle=True, seed=None):
+        """
+        Yield (images, labels, index) batches. images is an (n, 224, 224, 3)
+        uint8 view of the map (no copy) and index the dataset positions.
+        Blocks of batch_size consecutive rows are visited in random order.
+        Only a pack with re-packed (changed) files has gaps and falls back
+        to gathering rows.
+        """
+        starts = np.arange(0, len(self.rows), batch_size)
+        if shuffle:
+            np.random.default_rng(seed).shuffle(starts)
+        for start in starts:
+            index = np.arange(start, min(start + batch_size, len(self.rows)))
+            if self.contiguous:
+                images = self.images[start:start + len(index)]
+            else:
+                images = self.images[self.rows[index]]
+            yield images, self.labels[index], index
+
+
+def _extract_block(args):
+    """Process-pool worker: opens the pack and builds its own extractor"""
+    pack_path, start, stop = args
+    return _extract_rows(PackedDataset(pack_path), create_feature_extractor(), start, stop)
+
+
+def _extract_rows(dataset, extractor, start, stop):
+    images = dataset.images[dataset.rows[start:stop]] if not dataset.contiguous else dataset.images[start:stop]
+    if hasattr(extractor, 'extract_array_batch'):
+        return extractor.extract_array_batch(images)
+    return np.array([extractor.extract_array(img) for img in images], dtype=np.float32)
+
+
+def extract_packed(pack_path=PACK_PATH, workers=None, block=1024):
+    """
+    Feature dict (same keys as feature_cache.load_or_extract) for a pack.
+    Stats features are spread over a process pool by row block; deep
+    backbones run in-process in batches, on one extractor built up front.
+    """
+    dataset = PackedDataset(pack_path)
+    n = len(dataset)
+    start = time.perf_counter()
+    blocks = [(pack_path, s, min(s + block, n)) for s in range(0, n, block)]
+    workers = workers or os.cpu_count() or 1
+    if configured_feature_version().startswith('stats') and workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_extract_block, blocks))
+    else:
+        extractor = create_feature_extractor()  # a deep backbone is built (and traced) once, not per block
+        parts = [_extract_rows(dataset, extractor, s, e) for _, s, e in blocks]
+    X = np.concatenate(parts).astype(np.float32) if parts else np.zeros((0, 0), np.float32)
+    return {
+        'X': X,
+        'y': dataset.labels.astype(np.int64),
+        'paths': [str(p) for p in dataset.paths],
+        'ok': np.ones(n, dtype=bool),
+        'valid': dataset.valid.astype(bool),
+        'cache_hits': 0,
+        'extracted': n,
+        'extract_seconds': time.perf_counter() - start,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode and resize the dataset once into a packed uint8 file")
+    parser.add_argument('--dataset', default=DATASET_DIR)
+    parser.add_argument('--out', default=PACK_PATH)
+    parser.add_argument('--workers', type=int, default=None, help="Decode processes (default: all cores)")
+    parser.add_argument('--limit-per-class', type=int, default=None)
+    args = parser.parse_args()
+
+    pack(args.dataset, args.out, args.workers, args.limit_per_class)
@@ -0,0 +1,238 @@
+# profiling.py
+"""
+On-demand request profiling and slow-request logging for live workers.
+
+Two opt-in surfaces, both off by default:
+
+1. Single-request profiling. With PROFILING_ENABLED=1, a request carrying
+   `X-Profile: cprofile` (or `X-Profile: sample`) and a matching
+   `X-Profile-Token: $PROFILING_TOKEN` header runs under cProfile (or the
+   stack sampler). The profile is written to PROFILE_DIR keyed by request
+   id - `<id>.pstats` for cProfile, `<id>.collapsed` (flamegraph.pl /
+   speedscope format) for sampling - and the id is returned in the
+   `X-Profile-Id` response header. Fetch it from /debug/profiles/<file>.
+   A client `X-Request-ID` is used as the id only if it matches
+   [A-Za-z0-9_-]{1,64}; anything else gets a server-generated id.
+
+2. Slow-request log. With SLOW_REQUEST_MS > 0, every request is watched by
+   a background stack sampler (one thread waking every
+   PROFILE_SAMPLE_INTERVAL_MS while requests are in flight, idle otherwise). Requests that finish over the threshold get
+   their collapsed stacks saved and a summary line appended to
+   PROFILE_DIR/slow_requests.log; faster requests are discarded.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import request, g, jsonify, send_from_directory, abort
+
+
+def _env_flag(name, default='0'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes')
+
+
+REQUEST_ID_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def collapse_stack(frame):
+    """Render a frame chain as a root-first 'file:function;...' string"""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+
+def format_collapsed(counter):
+    """Collapsed-stack text: one 'stack count' line per unique stack"""
+    return ''.join(f"{stack} {count}\n" for stack, count in counter.most_common())
+
+
+class StackSampler:
+    """Samples the stacks of registered threads from a single daemon thread"""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def _ensure_running(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def track(self, thread_id):
+        counter = Counter()
+        with self._lock:
+            self._active[thread_id] = counter
+            self._ensure_running()
+            self._wakeup.notify()
+        return counter
+
+    def untrack(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._active:  # nothing to sample: sleep until track()
+                    self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            for thread_id, counter in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    counter[collapse_stack(frame)] += 1
+
+
+class RequestProfiler:
+    """Flask hooks wiring cProfile / sampling / slow-request logging into an app"""
+    def __init__(self, app):
+        self.enabled = app.config['PROFILING_ENABLED']
+        self.token = app.config['PROFILING_TOKEN']
+        self.profile_dir = os.path.realpath(app.config['PROFILE_DIR'])
+        self.slow_threshold = app.config['SLOW_REQUEST_MS'] / 1000.0
+        self.sampler = StackSampler(app.config['PROFILE_SAMPLE_INTERVAL_MS'] / 1000.0)
+        # cProfile cannot profile two threads at once reliably - one at a time
+        self._cprofile_lock = threading.Lock()
+
+        if self.enabled or self.slow_threshold > 0:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            app.before_request(self.before_request)
+            app.after_request(self.after_request)
+            app.teardown_request(self.teardown_request)
+        if self.enabled:
+            app.add_url_rule('/debug/profiles/<path:filename>', 'get_profile', self.get_profile)
+
+    def _authorized(self):
+        return bool(self.token) and request.headers.get('X-Profile-Token') == self.token
+
+    def _profile_path(self, request_id, suffix):
+        """Path of a profile file, refusing anything that resolves outside profile_dir"""
+        path = os.path.realpath(os.path.join(self.profile_dir, f"{request_id}{suffix}"))
+        if os.path.dirname(path) != self.profile_dir:
+            raise ValueError(f"Profile path escapes {self.profile_dir}: {request_id!r}")
+        return path
+
+    def before_request(self):
+        request_id = request.headers.get('X-Request-ID', '')
+        g.profile_request_id = request_id if REQUEST_ID_RE.fullmatch(request_id) else uuid.uuid4().hex
+        g.profile_start = time.perf_counter()
+        g.profile_mode = None
+        g.profile_samples = None
+        g.cprofile = None
+
+        mode = request.headers.get('X-Profile', '').lower() if self.enabled else ''
+        if mode and self._authorized():
+            if mode == 'cprofile':
+                if self._cprofile_lock.acquire(blocking=False):
+                    g.cprofile = cProfile.Profile()
+                    g.profile_mode = 'cprofile'
+                    g.cprofile.enable()
+                else:
+                    g.profile_mode = 'busy'
+            elif mode == 'sample':
+                g.profile_mode = 'sample'
+
+        if g.profile_mode == 'sample' or self.slow_threshold > 0:
+            g.profile_samples = self.sampler.track(threading.get_ident())
+
+    def _stop(self):
+        """Stop any profiler attached to this request (idempotent)"""
+        if getattr(g, 'cprofile', None) is not None:
+            g.cprofile.disable()
+            self._cprofile_lock.release()
+            g.profile_cprofile_done, g.cprofile = g.cprofile, None
+        if getattr(g, 'profile_samples', None) is not None:
+            self.sampler.untrack(threading.get_ident())
+            g.profile_samples_done, g.profile_samples = g.profile_samples, None
+
+    def after_request(self, response):
+        if not hasattr(g, 'profile_start'):
+            return response
+        self._stop()
+        duration = time.perf_counter() - g.profile_start
+        request_id = g.profile_request_id
+
+        if g.profile_mode == 'cprofile':
+            g.profile_cprofile_done.dump_stats(self._profile_path(request_id, '.pstats'))
+            response.headers['X-Profile-Id'] = request_id
+        elif g.profile_mode == 'sample':
+            self._write_collapsed(request_id, g.profile_samples_done)
+            response.headers['X-Profile-Id'] = request_id
+        elif g.profile_mode == 'busy':
+            response.headers['X-Profile-Status'] = 'busy'
+
+        if self.slow_threshold > 0 and duration >= self.slow_threshold:
+            samples = getattr(g, 'profile_samples_done', None) or Counter()
+            self._log_slow_request(request_id, duration, response.status_code, samples)
+
+        return response
+
+    def teardown_request(self, exc):
+        # Requests that raised never reach after_request - make sure we detach
+        if hasattr(g, 'profile_start'):
+            self._stop()
+
+    def _write_collapsed(self, request_id, samples):
+        path = self._profile_path(request_id, '.collapsed')
+        with open(path, 'w') as f:
+            f.write(format_collapsed(samples))
+        return path
+
+    def _log_slow_request(self, request_id, duration, status, samples):
+        if samples:
+            self._write_collapsed(request_id, samples)
+        total = sum(samples.values()) or 1
+        top = [{'stack': stack.rsplit(';', 3)[-3:], 'share': round(count / total, 3)}
+               for stack, count in samples.most_common(5)]
+        entry = {
+            'request_id': request_id,
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'duration_ms': round(duration * 1000, 1),
+            'samples': sum(samples.values()),
+            'top_stacks': top
+        }
+        with open(os.path.join(self.profile_dir, 'slow_requests.log'), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        print(f"🐢 Slow request {request.method} {request.path}: {entry['duration_ms']} ms (id {request_id})")
+
+    def get_profile(self, filename):
+        """Download a stored profile; ?format=text renders pstats as text"""
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        path = os.path.join(self.profile_dir, os.path.basename(filename))
+        if not os.path.isfile(path):
+            abort(404)
+        if filename.endswith('.pstats') and request.args.get('format') == 'text':
+            out = io.StringIO()
+            stats = pstats.Stats(path, stream=out)
+            stats.sort_stats('cumulative').print_stats(40)
+            return out.getvalue(), 200, {'Content-Type': 'text/plain'}
+        return send_from_directory(self.profile_dir, os.path.basename(filename))
+
+
+def init_profiling(app):
+    """Read profiling config from the environment and install the hooks"""
+    app.config.setdefault('PROFILING_ENABLED', _env_flag('PROFILING_ENABLED'))
+    app.config.setdefault('PROFILING_TOKEN', os.environ.get('PROFILING_TOKEN', ''))
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', 'profiles'))
+    app.config.setdefault('SLOW_REQUEST_MS', float(os.environ.get('SLOW_REQUEST_MS', 0)))
+    app.config.setdefault('PROFILE_SAMPLE_INTERVAL_MS', float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 5)))
+    return RequestProfiler(app)
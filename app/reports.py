@@ -0,0 +1,358 @@
+# reports.py
+"""
+Downloadable diagnosis PDF reports, rendered off the request path.
+
+A report is an A4 page drawn with Pillow (patient, grade, risk, class
+probabilities and a fundus thumbnail) and saved as a one-page PDF. The
+stored fundus image is decoded at reduced scale (JPEG draft mode) to a
+REPORT_THUMB_SIZE thumbnail, so a 4000px original costs a fraction of a full decode.
+
+- Single reports render on a thread pool (REPORT_WORKERS). The first
+  request for one gets 202 + Retry-After while it renders; later requests
+  are served from the cache. Concurrent requests share one render. A
+  failed render is remembered for RENDER_ERROR_TTL seconds: requests get
+  500 with the error instead of queueing the same failure again.
+- Rendered PDFs are cached on disk (REPORT_DIR/cache) under
+  <diagnosis id>-<TEMPLATE_VERSION>-<revision>, where the revision is a
+  digest of the fields on the page, so a confirmation or re-score never
+  serves a stale report. The cache is LRU by access time (files are
+  touched on every hit) and trimmed to REPORT_CACHE_MB.
+- Bundles (all reports of a patient, or of a screening camp = date range)
+  are built into one zip by a separate worker. Job status is a JSON file
+  next to the zip, so any app worker can answer the status/download
+  requests. Finished jobs are removed after REPORT_JOB_TTL seconds.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image, ImageDraw, ImageFont
+
+from metrics import metrics, HELP
+
+HELP.update({
+    'report_requests_total': "Report requests by result (hit, rendering, failed)",
+    'report_renders_total': "PDF reports rendered, by result",
+    'report_render_seconds': "Time to render one PDF report",
+    'report_cache_bytes': "Size of the on-disk report cache",
+    'report_bundles_total': "Report zip bundles built, by result",
+})
+
+# Bump when the layout changes - old cache entries are then never served again
+TEMPLATE_VERSION = 'r1'
+
+PAGE_SIZE = (1240, 1754)  # A4 at 150 dpi
+DPI = 150
+MARGIN = 90
+GRADE_COLORS = ['#2e7d32', '#9e9d24', '#ef6c00', '#d84315', '#b71c1c']
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+RENDER_ERROR_TTL = 60  # seconds a failed render answers with its error before it is retried
+
+
+def _font(size):
+    return ImageFont.load_default(size=size)
+
+
+def report_revision(doc):
+    """Digest of every field drawn on the report"""
+    fields = {k: doc.get(k) for k in ('patient_id', 'patient_mobile', 'date', 'diagnosis_class', 'severity_index',
+                                      'progression_risk', 'probabilities', 'confirmed_class', 'model_version',
+                                      'notes', 'patient_info', 'image_filename')}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def fundus_thumbnail(image_file, size):
+    """Downscaled RGB copy of a stored fundus image (None if it cannot be decoded)"""
+    try:
+        with Image.open(image_file) as img:
+            img.draft('RGB', (size, size))  # JPEG: decode at 1/2, 1/4 or 1/8 scale
+            img.thumbnail((size, size))
+            return img.convert('RGB')
+    except Exception:
+        return None
+
+
+def render_report(doc, classes, thumbnail=None):
+    """One-page PDF (bytes) for a diagnosis document"""
+    page = Image.new('RGB', PAGE_SIZE, 'white')
+    draw = ImageDraw.Draw(page)
+    width = PAGE_SIZE[0]
+    title, heading, text, small = _font(44), _font(28), _font(24), _font(18)
+
+    draw.rectangle([0, 0, width, 150], fill='#0d47a1')
+    draw.text((MARGIN, 45), "Retina AI - Diabetic Retinopathy Report", font=title, fill='white')
+
+    y = 200
+    patient = doc.get('patient_info') or {}
+    rows = [
+        ("Patient", patient.get('name') or 'Unknown'),
+        ("Patient ID", doc.get('patient_id', '')),
+        ("Age / Gender", f"{patient.get('age') or 'N/A'} / {patient.get('gender') or '-'}"),
+        ("Mobile", doc.get('patient_mobile') or 'N/A'),
+        ("Examined", doc['date'].strftime("%Y-%m-%d %H:%M UTC")),
+        ("Report ID", str(doc['_id'])),
+    ]
+    for label, value in rows:
+        draw.text((MARGIN, y), label, font=text, fill='#555555')
+        draw.text((MARGIN + 250, y), str(value), font=text, fill='black')
+        y += 42
+
+    y += 20
+    severity = int(doc.get('severity_index') or 0)
+    color = GRADE_COLORS[min(max(severity, 0), len(GRADE_COLORS) - 1)]
+    draw.rectangle([MARGIN, y, width - MARGIN, y + 110], outline=color, width=4)
+    draw.text((MARGIN + 30, y + 18), f"Grade: {doc.get('diagnosis_class', '')}", font=title, fill=color)
+    draw.text((MARGIN + 30, y + 72), f"Severity index {severity}/4    "
+              f"Progression risk {doc.get('progression_risk', 0)}%", font=text, fill='black')
+    y += 140
+
+    confirmed = doc.get('confirmed_class')
+    if confirmed is not None:
+        label = classes[confirmed] if 0 <= confirmed < len(classes) else confirmed
+        draw.text((MARGIN, y), f"Clinician-confirmed grade: {label}", font=heading, fill='black')
+        y += 50
+
+    if thumbnail is not None:
+        x = (width - thumbnail.width) // 2
+        page.paste(thumbnail, (x, y))
+        y += thumbnail.height + 30
+    else:
+        draw.text((MARGIN, y), "Fundus image not available", font=text, fill='#999999')
+        y += 50
+
+    draw.text((MARGIN, y), "Class probabilities", font=heading, fill='black')
+    y += 45
+    probabilities = doc.get('probabilities') or {}
+    bar_left, bar_right = MARGIN + 260, width - MARGIN - 110
+    for i, cls in enumerate(classes):
+        p = min(max(float(probabilities.get(cls, 0)), 0.0), 1.0)  # stored as fractions
+        draw.text((MARGIN, y), cls, font=text, fill='black')
+        draw.rectangle([bar_left, y + 4, bar_right, y + 28], outline='#cccccc')
+        draw.rectangle([bar_left, y + 4, bar_left + int((bar_right - bar_left) * p), y + 28],
+                       fill=GRADE_COLORS[i % len(GRADE_COLORS)])
+        draw.text((bar_right + 15, y), f"{p * 100:.1f}%", font=text, fill='black')
+        y += 40
+
+    if doc.get('notes'):
+        y += 15
+        draw.text((MARGIN, y), f"Notes: {doc['notes']}", font=text, fill='black')
+
+    footer = PAGE_SIZE[1] - 110
+    draw.line([MARGIN, footer, width - MARGIN, footer], fill='#cccccc', width=2)
+    draw.text((MARGIN, footer + 15), "AI-assisted screening result. Not a substitute for examination by an "
+              "ophthalmologist.", font=small, fill='#555555')
+    draw.text((MARGIN, footer + 45), f"Model {doc.get('model_version', '')}  |  template {TEMPLATE_VERSION}  |  "
+              f"generated {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}", font=small, fill='#555555')
+
+    buf = io.BytesIO()
+    page.save(buf, 'PDF', resolution=DPI, quality=90)
+    return buf.getvalue()
+
+
+class ReportCache:
+    """On-disk PDF cache with LRU eviction by access time"""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pdf')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.pdf'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+            metrics.set_gauge('report_cache_bytes', total)
+
+
+class ReportService:
+    """Renders, caches and bundles reports for the routes in app.py"""
+    def __init__(self, storage, classes, directory='reports', workers=2, cache_bytes=512 * 2 ** 20,
+                 thumb_size=640, job_ttl=3600):
+        self.storage = storage
+        self.classes = classes
+        self.cache = ReportCache(os.path.join(directory, 'cache'), cache_bytes)
+        self.jobs_dir = os.path.join(directory, 'jobs')
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.thumb_size = thumb_size
+        self.job_ttl = job_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report')
+        self._bundle_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='report-bundle')
+        self._inflight = {}
+        self._failures = {}  # cache key -> (error message, monotonic time of the failure)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(doc):
+        return f"{doc['_id']}-{TEMPLATE_VERSION}-{report_revision(doc)}"
+
+    def get(self, diagnosis_id):
+        """
+        (status, detail): ('missing', None), ('ready', pdf path), ('rendering',
+        None) - render queued - or ('failed', error) after a recent failure
+        """
+        doc = self.storage.diagnoses.get_by_id(diagnosis_id)
+        if doc is None:
+            return 'missing', None
+        key = self.cache_key(doc)
+        path = self.cache.get(key)
+        if path:
+            metrics.inc('report_requests_total', result='hit')
+            return 'ready', path
+        with self._lock:
+            failure = self._failures.get(key)
+            if failure and time.monotonic() - failure[1] > RENDER_ERROR_TTL:
+                del self._failures[key]
+                failure = None
+        if failure:
+            metrics.inc('report_requests_total', result='failed')
+            return 'failed', failure[0]
+        metrics.inc('report_requests_total', result='rendering')
+        self._submit(key, doc)
+        return 'rendering', None
+
+    def _submit(self, key, doc):
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = self._executor.submit(self._render, key, doc)
+        return future
+
+    def _render(self, key, doc):
+        start = time.perf_counter()
+        try:
+            image = self.storage.diagnoses.get_image(str(doc['_id']))
+            thumbnail = fundus_thumbnail(image, self.thumb_size) if image is not None else None
+            path = self.cache.put(key, render_report(doc, self.classes, thumbnail))
+            metrics.inc('report_renders_total', result='ok')
+            metrics.observe('report_render_seconds', time.perf_counter() - start)
+            return path
+        except Exception as e:
+            metrics.inc('report_renders_total', result='error')
+            print(f"❌ Report render failed for {doc['_id']}: {e}")
+            now = time.monotonic()
+            with self._lock:
+                self._failures = {k: f for k, f in self._failures.items() if now - f[1] <= RENDER_ERROR_TTL}
+                self._failures[key] = (f"Report rendering failed: {e}", now)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def render_now(self, doc):
+        """Cached PDF path for doc, rendering it on the pool if needed (blocks)"""
+        key = self.cache_key(doc)
+        return self.cache.get(key) or self._submit(key, doc).result()
+
+    # --- bundles ---
+
+    def submit_bundle(self, diagnosis_ids, name):
+        self._expire_jobs()
+        job_id = uuid.uuid4().hex
+        self._write_job(job_id, {'job_id': job_id, 'status': 'queued', 'name': name, 'total': len(diagnosis_ids),
+                                 'done': 0, 'created_at': time.time()})
+        self._bundle_executor.submit(self._build_bundle, job_id, diagnosis_ids, name)
+        return job_id
+
+    def _build_bundle(self, job_id, diagnosis_ids, name):
+        status = self.job_status(job_id)
+        status['status'] = 'running'
+        self._write_job(job_id, status)
+        zip_path = self.job_zip(job_id)
+        try:
+            with zipfile.ZipFile(zip_path + '.tmp', 'w', zipfile.ZIP_STORED) as bundle:  # PDFs are JPEG inside
+                for diagnosis_id in diagnosis_ids:
+                    doc = self.storage.diagnoses.get_by_id(diagnosis_id)
+                    if doc is not None:
+                        arcname = f"{doc['date'].strftime('%Y%m%d-%H%M')}-{doc.get('patient_id', '')}-{doc['_id']}.pdf"
+                        bundle.write(self.render_now(doc), arcname)
+                    status['done'] += 1
+                    self._write_job(job_id, status)
+            os.replace(zip_path + '.tmp', zip_path)
+            status.update(status='done', filename=f"reports-{name}.zip", size=os.path.getsize(zip_path))
+            metrics.inc('report_bundles_total', result='ok')
+        except Exception as e:
+            status.update(status='error', error=str(e))
+            metrics.inc('report_bundles_total', result='error')
+            print(f"❌ Report bundle {job_id} failed: {e}")
+        status['finished_at'] = time.time()
+        self._write_job(job_id, status)
+
+    def job_zip(self, job_id):
+        return os.path.join(self.jobs_dir, job_id + '.zip')
+
+    def job_status(self, job_id):
+        if not JOB_ID.match(job_id or ''):
+            return None
+        try:
+            with open(os.path.join(self.jobs_dir, job_id + '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_job(self, job_id, status):
+        path = os.path.join(self.jobs_dir, job_id + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(status, f)
+        os.replace(path + '.tmp', path)
+
+    def _expire_jobs(self):
+        cutoff = time.time() - self.job_ttl
+        for entry in os.scandir(self.jobs_dir):
+            if entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+def init_reports(app, storage, classes):
+    """Report service configured from the environment"""
+    app.config.setdefault('REPORT_DIR', os.environ.get('REPORT_DIR', 'reports'))
+    app.config.setdefault('REPORT_WORKERS', int(os.environ.get('REPORT_WORKERS', 2)))
+    app.config.setdefault('REPORT_CACHE_MB', float(os.environ.get('REPORT_CACHE_MB', 512)))
+    app.config.setdefault('REPORT_THUMB_SIZE', int(os.environ.get('REPORT_THUMB_SIZE', 640)))
+    app.config.setdefault('REPORT_JOB_TTL', float(os.environ.get('REPORT_JOB_TTL', 3600)))
+    app.config.setdefault('REPORT_BUNDLE_MAX', int(os.environ.get('REPORT_BUNDLE_MAX', 2000)))
+    return ReportService(storage, classes, app.config['REPORT_DIR'], app.config['REPORT_WORKERS'],
+                         int(app.config['REPORT_CACHE_MB'] * 2 ** 20), app.config['REPORT_THUMB_SIZE'],
+                         app.config['REPORT_JOB_TTL'])
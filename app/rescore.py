@@ -0,0 +1,87 @@
+# rescore.py
+"""
+Bulk re-scoring of stored diagnoses with a new model artifact.
+
+Every diagnosis saved by /analyze carries its float32 feature vector and
+feature_version, so shipping a new dr_model.pkl does not require pulling
+images back out of GridFS. This command streams the stored vectors with a
+cursor, scores them in large predict_proba batches and writes the new
+class, probabilities, risk and model_version back with bulk writes.
+
+Records already scored by the given model are skipped, so an interrupted
+run can simply be restarted. Records whose feature_version differs from
+the current extractor cannot be re-scored from vectors and are left alone.
+
+Usage:
+    python rescore.py [--model dr_model.pkl] [--batch-size 20000] [--dry-run]
+"""
+import argparse
+import pickle
+import time
+
+import numpy as np
+
+from model import CLASSES, compute_progression_risk, configured_feature_version, model_artifact_version
+from storage import open_storage
+
+
+def score_batch(clf, X, model_version):
+    """Score one (n, d) batch and return the per-record update fields"""
+    probs = clf.predict_proba(X)
+    classes = np.asarray(clf.classes_, dtype=int)
+    scores = classes[probs.argmax(axis=1)]
+    risks = compute_progression_risk(scores, X)
+
+    # Map model columns onto the fixed CLASSES order (a class may be absent from training)
+    full = np.zeros((len(X), len(CLASSES)))
+    full[:, classes] = probs
+
+    return [{
+        'diagnosis_class': CLASSES[score],
+        'severity_index': int(score),
+        'progression_risk': float(risk),
+        'probabilities': dict(zip(CLASSES, row.tolist())),
+        'model_version': model_version,
+    } for score, risk, row in zip(scores, risks, full)]
+
+
+def rescore(model_path='dr_model.pkl', batch_size=20000, storage=None, dry_run=False, feature_version=None):
+    storage = storage or open_storage()
+    feature_version = feature_version or configured_feature_version()
+    with open(model_path, 'rb') as f:
+        clf = pickle.load(f)
+    model_version = model_artifact_version(model_path)
+
+    print(f"🔁 Re-scoring diagnoses with {model_path} ({model_version}), feature version {feature_version}")
+    start = time.perf_counter()
+    total = 0
+
+    for ids, X in storage.diagnoses.iter_feature_batches(feature_version, batch_size,
+                                                         skip_model_version=model_version):
+        fields = score_batch(clf, X, model_version)
+        if not dry_run:
+            storage.diagnoses.bulk_update_scores(list(zip(ids, fields)))
+        total += len(ids)
+        elapsed = time.perf_counter() - start
+        print(f" -> {total:,} records ({total / elapsed:,.0f} records/s)")
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ Re-scored {total:,} records in {elapsed:.1f}s"
+          f"{' (dry run, nothing written)' if dry_run else ''}")
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-score stored diagnoses from their feature vectors")
+    parser.add_argument('--model', default='dr_model.pkl')
+    parser.add_argument('--batch-size', type=int, default=20000)
+    parser.add_argument('--backend', default=None, help="mongo or sqlite (default: $STORAGE_BACKEND)")
+    parser.add_argument('--mongo-uri', default=None)
+    parser.add_argument('--sqlite-path', default=None)
+    parser.add_argument('--dry-run', action='store_true', help="Score but do not write back")
+    parser.add_argument('--feature-version', default=None,
+                        help="Vectors to score (default: the configured FEATURE_EXTRACTOR's version)")
+    args = parser.parse_args()
+
+    rescore(args.model, args.batch_size, open_storage(args.backend, args.mongo_uri, args.sqlite_path),
+            args.dry_run, args.feature_version)
@@ -0,0 +1,182 @@
+# responses.py
+"""
+Response layer: fast JSON, on-the-fly compression and fingerprinted assets.
+
+1. JSON. With orjson installed (JSON_PROVIDER=orjson, the default),
+   app.json encodes with orjson instead of the json module. Output matches
+   Flask's provider: sorted keys, HTTP dates for datetimes, a trailing
+   newline. The differences: non-ASCII is written as UTF-8 rather than
+   \\u escapes, and NaN becomes null. numpy scalars and arrays are encoded
+   natively. Without orjson, Flask's provider is kept.
+
+2. Compression. JSON responses of at least COMPRESS_MIN_BYTES are
+   compressed when the client accepts it: brotli (BROTLI_QUALITY, needs
+   the brotli package), otherwise gzip (GZIP_LEVEL). Streamed responses
+   (/export compresses its own stream) and files are left alone.
+
+3. Assets. build_assets.py writes content-hashed copies of static/ to
+   ASSET_DIR, plus precompressed variants. They are served from /assets/
+   with `Cache-Control: immutable`, choosing the .br/.gz file the client
+   accepts, and templates link them with asset_url('js/main.js'). An
+   asset missing from the manifest, or changed since the build, falls back
+   to /static/ with a ?v=<content hash> query.
+"""
+import gzip
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for, abort
+from flask.json.provider import DefaultJSONProvider
+
+from build_assets import MANIFEST_NAME, file_digest
+from metrics import metrics, HELP
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HELP.update({
+    'http_compressed_responses_total': "JSON responses compressed on the fly, by encoding",
+    'http_compression_saved_bytes_total': "Bytes saved on the wire by JSON response compression",
+})
+
+COMPRESSIBLE = {'application/json'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+if orjson is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """Flask's JSON provider with orjson doing the encoding"""
+        def _option(self, pretty=False):
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if pretty:
+                option |= orjson.OPT_INDENT_2
+            return option
+
+        def dumps(self, obj, **kwargs):
+            if kwargs:
+                return super().dumps(obj, **kwargs)  # json.dumps-specific arguments
+            return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            pretty = (self.compact is None and self._app.debug) or self.compact is False
+            body = orjson.dumps(obj, default=self.default, option=self._option(pretty) | orjson.OPT_APPEND_NEWLINE)
+            return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def negotiate_encoding(accept_encodings, available):
+    """Best encoding in available (preference order) that the client accepts, or None"""
+    for encoding in available:
+        if accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, gzip_level=6, brotli_quality=4):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+class ResponseLayer:
+    """JSON provider, compression hook and /assets/ route for a Flask app"""
+    def __init__(self, app):
+        self.app = app
+        self.min_bytes = app.config['COMPRESS_MIN_BYTES']
+        self.gzip_level = app.config['GZIP_LEVEL']
+        self.brotli_quality = app.config['BROTLI_QUALITY']
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self.asset_dir = os.path.join(app.root_path, app.config['ASSET_DIR'])
+        self._fallback_digests = {}
+
+        if app.config['JSON_PROVIDER'] == 'orjson':
+            if orjson is not None:
+                app.json = OrjsonProvider(app)
+            else:
+                print("⚠️ orjson is not installed; using Flask's JSON encoder (pip install orjson)")
+        if self.min_bytes > 0:
+            app.after_request(self.compress_response)
+        self.manifest = self.load_manifest()
+        app.add_url_rule('/assets/<path:filename>', 'serve_asset', self.serve_asset)
+        app.add_template_global(self.asset_url, 'asset_url')
+
+    def load_manifest(self):
+        """Manifest entries whose source file is unchanged since the build"""
+        path = os.path.join(self.asset_dir, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            assets = json.load(f).get('assets', {})
+        current = {}
+        for name, entry in assets.items():
+            source = os.path.join(self.app.static_folder, name)
+            if os.path.exists(source) and file_digest(source) == entry['digest']:
+                current[name] = entry
+            else:
+                print(f"⚠️ {name} changed since build_assets.py ran; serving it from /static/ until rebuilt")
+        print(f"📦 {len(current)} fingerprinted assets ({', '.join(self.encodings)} negotiation)")
+        return current
+
+    def asset_url(self, name):
+        entry = self.manifest.get(name)
+        if entry:
+            return url_for('serve_asset', filename=entry['path'])
+        digest = self._fallback_digests.get(name)
+        if digest is None:
+            source = os.path.join(self.app.static_folder, name)
+            digest = self._fallback_digests[name] = file_digest(source) if os.path.exists(source) else ''
+        return url_for('static', filename=name, v=digest or None)
+
+    def serve_asset(self, filename):
+        path = os.path.join(self.asset_dir, filename)
+        if filename == MANIFEST_NAME or not os.path.isfile(path):
+            abort(404)
+        available = [e for e in self.encodings if os.path.isfile(path + ('.br' if e == 'br' else '.gz'))]
+        encoding = negotiate_encoding(request.accept_encodings, available)
+        suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(self.asset_dir, filename + suffix, mimetype=mimetype, max_age=31536000)
+        response.headers['Cache-Control'] = IMMUTABLE
+        if available:
+            response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    def compress_response(self, response):
+        if (response.mimetype not in COMPRESSIBLE or response.direct_passthrough or response.is_streamed
+                or not 200 <= response.status_code < 300 or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.content_length or 0) < self.min_bytes:
+            return response
+        encoding = negotiate_encoding(request.accept_encodings, self.encodings)
+        if encoding is None:
+            return response
+        data = response.get_data()
+        compressed = compress(data, encoding, self.gzip_level, self.brotli_quality)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        metrics.inc('http_compressed_responses_total', encoding=encoding)
+        metrics.inc('http_compression_saved_bytes_total', len(data) - len(compressed))
+        return response
+
+
+def init_responses(app):
+    """Read response-layer config from the environment and install it"""
+    app.config.setdefault('JSON_PROVIDER', os.environ.get('JSON_PROVIDER', 'orjson'))
+    app.config.setdefault('COMPRESS_MIN_BYTES', int(os.environ.get('COMPRESS_MIN_BYTES', 1024)))
+    app.config.setdefault('GZIP_LEVEL', int(os.environ.get('GZIP_LEVEL', 6)))
+    app.config.setdefault('BROTLI_QUALITY', int(os.environ.get('BROTLI_QUALITY', 4)))
+    app.config.setdefault('ASSET_DIR', os.environ.get('ASSET_DIR', 'assets'))
+    return ResponseLayer(app)
@@ -0,0 +1,366 @@
+# spool.py
+"""
+Write-behind persistence for /analyze.
+
+With WRITE_BEHIND=1, /analyze no longer waits for the patient upsert, the
+GridFS upload or the diagnosis insert: they are appended to a local spool
+and the response goes out as soon as that append is on disk. A background
+flusher thread writes the spool to storage in batches (upsert_many, then
+create_many), in spool order, so a patient's visits always land in the
+order they were analysed, after the patient record they belong to.
+
+- Ids are generated up front (storage.diagnoses.new_id()), so the response
+  carries the final diagnosis_id and re-sending a batch is harmless: rows
+  and GridFS files that already exist are skipped.
+- Images are written to SPOOL_DIR/blobs/<file_id> and fsynced before the
+  JSON line that references them; the flusher deletes them once stored.
+- Patients are keyed by mobile. Their ids come from an in-process cache
+  (loaded from storage when the flusher starts); a mobile the cache does
+  not know gets a new id. Diagnoses spooled under such an id are resolved
+  against storage at flush time, so a patient registered concurrently by
+  another worker still ends up with one id.
+- A failed flush is retried with exponential backoff (SPOOL_MAX_BACKOFF
+  seconds at most); later records wait behind it, keeping the order.
+- Each worker process appends to its own log, flock()ed while it runs.
+  On startup every unlocked log (a worker that died or a previous run) is
+  replayed: its unflushed lines are re-spooled and flushed again.
+
+Until a record is flushed it is not visible to /history, /patient or
+/diagnosis reads. spool_depth and spool_lag_seconds (age of the oldest
+unflushed record) in /metrics show how far behind storage is.
+Write-behind needs a backend with supports_write_behind set, which
+implements new_id/create_many and upsert_many/patient_ids_by_mobile (Mongo).
+"""
+import atexit
+import base64
+import fcntl
+import glob
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from metrics import metrics, HELP
+from storage import encode_features, new_patient_id
+
+HELP.update({
+    'spool_depth': "Diagnoses and patient upserts spooled but not yet written to storage",
+    'spool_lag_seconds': "Age of the oldest unflushed spool record",
+    'spool_appended_total': "Diagnoses appended to the write-behind spool",
+    'spool_flushed_total': "Spooled diagnoses written to storage",
+    'spool_flush_errors_total': "Failed write-behind flushes (retried with backoff)",
+    'spool_append_seconds': "Latency of a durable spool append",
+    'spool_flush_seconds': "Latency of writing one spool batch",
+})
+
+PATIENT_FIELDS = ('name', 'age', 'email', 'gender', 'diabetes_duration')
+
+
+def _fsync_write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_entries(log_path):
+    """Unflushed entries of a log (after its offset; a torn last line is dropped)"""
+    offset = 0
+    if os.path.exists(log_path + '.offset'):
+        with open(log_path + '.offset') as f:
+            offset = int(f.read().strip() or 0)
+    entries = []
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break  # crashed mid-append; the response for this record never went out
+    return entries
+
+
+class WriteBehindSpool:
+    """Durable local queue of diagnoses and patient upserts plus the thread that flushes it"""
+    def __init__(self, repository, directory='spool', batch_size=100, min_backoff=0.5, max_backoff=30.0,
+                 patients=None):
+        self.repository = repository
+        self.patients = patients
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, 'blobs')
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._pending = deque()  # (entry, end offset in the log)
+        self._patient_ids = {}    # mobile -> patient_id
+        self._provisional = set()  # ids given to mobiles not (yet) seen in storage
+        self.last_error = None
+
+        # Created and locked under a name _replay() does not match, then renamed into place, so a
+        # worker starting at the same moment can never adopt (and delete) a log before it is locked
+        self.log_path = os.path.join(directory, f"diagnoses-{os.getpid()}-{time.time_ns()}.jsonl")
+        self._log = open(self.log_path + '.new', 'ab')
+        fcntl.flock(self._log, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(self.log_path + '.new', self.log_path)
+        self._write_offset(0)
+        self.replayed = self._replay()
+        self._update_gauges()
+
+        self._thread = threading.Thread(target=self._run, name='spool-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _replay(self):
+        """Adopt the unflushed lines of every log no live process holds"""
+        adopted = []
+        for path in sorted(glob.glob(os.path.join(self.directory, 'diagnoses-*.jsonl')), key=os.path.getmtime):
+            if path == self.log_path:
+                continue
+            with open(path, 'rb') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # a running worker's log
+                entries = _read_entries(path)
+                with self._cond:
+                    for entry in entries:
+                        self._append_line(entry)
+                    os.fsync(self._log.fileno())
+                # Our log now holds the entries; a crash before this point only replays them twice
+                os.remove(path)
+                if os.path.exists(path + '.offset'):
+                    os.remove(path + '.offset')
+            adopted.extend(entries)
+        for path in glob.glob(os.path.join(self.directory, 'diagnoses-*.jsonl.new')):
+            with open(path, 'rb') as f:  # empty leftovers of a worker that died while starting
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                os.remove(path)
+        if adopted:
+            print(f"♻️ Replaying {len(adopted)} spooled records from a previous run")
+        return len(adopted)
+
+    def _append_line(self, entry):
+        self._log.write(json.dumps(entry, separators=(',', ':')).encode() + b'\n')
+        self._log.flush()
+        self._pending.append((entry, self._log.tell()))
+
+    def _write_offset(self, offset):
+        tmp = self.log_path + '.offset.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, self.log_path + '.offset')
+
+    def upsert_patient(self, patient_data):
+        """
+        Spool a create-or-update of the patient with this mobile and return
+        its patient_id, without a storage round trip. The line is made
+        durable by the diagnosis append that follows it.
+        """
+        mobile = patient_data.get('mobile', '')
+        with self._cond:
+            patient_id = self._patient_ids.get(mobile)
+            if patient_id is None:
+                patient_id = self._patient_ids[mobile] = new_patient_id()
+                self._provisional.add(patient_id)
+            self._append_line({
+                'type': 'patient',
+                'patient_id': patient_id,
+                'mobile': mobile,
+                'fields': {k: patient_data[k] for k in PATIENT_FIELDS if k in patient_data},
+                'spooled_at': time.time(),
+            })
+            self._cond.notify()
+        self._update_gauges()
+        return patient_id
+
+    def _load_patient_ids(self):
+        """Fill the mobile -> patient_id cache from storage (ids already confirmed by a flush win)"""
+        try:
+            known = self.patients.patient_ids_by_mobile()
+        except Exception as e:
+            print(f"⚠️ Could not load patient ids for write-behind: {e}")
+            return
+        with self._cond:
+            for mobile, patient_id in known.items():
+                current = self._patient_ids.get(mobile)
+                if current is None or current in self._provisional:
+                    self._patient_ids[mobile] = patient_id
+
+    def append(self, patient_id, analysis_result, image_file=None, notes="Automated Analysis", features=None,
+               image_phash=None):
+        """Durably spool a diagnosis (same arguments as DiagnosisRepository.create) and return its id"""
+        start = time.perf_counter()
+        image = None
+        if image_file:
+            file_id = self.repository.new_id()
+            _fsync_write(os.path.join(self.blob_dir, file_id), image_file.read())
+            image = {'file_id': file_id, 'filename': image_file.filename, 'content_type': image_file.content_type}
+        encoded = encode_features(features)
+        entry = {
+            '_id': self.repository.new_id(),
+            'patient_id': patient_id,
+            'analysis_result': analysis_result,
+            'notes': notes,
+            'features': base64.b64encode(encoded).decode('ascii') if encoded is not None else None,
+            'image_phash': image_phash,
+            'date': datetime.utcnow().isoformat(),
+            'spooled_at': time.time(),
+            'image': image,
+        }
+        with self._cond:
+            if patient_id in self._provisional:
+                entry['provisional_patient'] = True  # resolved by mobile when flushed
+            self._append_line(entry)
+            os.fsync(self._log.fileno())
+            self._cond.notify()
+        metrics.inc('spool_appended_total')
+        metrics.observe('spool_append_seconds', time.perf_counter() - start)
+        self._update_gauges()
+        return entry['_id']
+
+    def _record(self, entry, patient_ids):
+        """Spool entry -> create_many record (image bytes read back from the blob)"""
+        image = entry.get('image')
+        if image:
+            blob = os.path.join(self.blob_dir, image['file_id'])
+            if os.path.exists(blob):
+                with open(blob, 'rb') as f:
+                    image = dict(image, data=f.read())
+            else:
+                print(f"⚠️ Spooled image {image['file_id']} is missing; storing diagnosis {entry['_id']} without it")
+                image = None
+        features = entry.get('features')
+        patient_id = entry['patient_id']
+        if entry.get('provisional_patient'):
+            patient_id = patient_ids.get(entry['analysis_result'].get('patient_mobile', ''), patient_id)
+        return {
+            '_id': entry['_id'],
+            'patient_id': patient_id,
+            'analysis_result': entry['analysis_result'],
+            'notes': entry['notes'],
+            'features': np.frombuffer(base64.b64decode(features), dtype='<f4') if features else None,
+            'image_phash': entry.get('image_phash'),
+            'date': datetime.fromisoformat(entry['date']),
+            'image': image,
+        }
+
+    def _store_patients(self, entries):
+        """Write a batch's patient upserts; {mobile: stored patient_id} for them and any provisional ids"""
+        upserts = [dict(e['fields'], mobile=e['mobile'], patient_id=e['patient_id'])
+                   for e in entries if e.get('type') == 'patient']
+        patient_ids = self.patients.upsert_many(upserts) if upserts else {}
+        unresolved = {e['analysis_result'].get('patient_mobile', '') for e in entries
+                      if e.get('provisional_patient')} - set(patient_ids)
+        if unresolved:  # upserted by an earlier batch
+            patient_ids.update(self.patients.patient_ids_by_mobile(unresolved))
+        return patient_ids
+
+    def _run(self):
+        if self.patients is not None:
+            self._load_patient_ids()
+        backoff = 0.0
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop.is_set():
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = list(itertools.islice(self._pending, self.batch_size))
+
+            if self._flush(batch):
+                backoff = 0.0
+                continue
+            if self._stop.is_set():
+                return  # left in the spool for the next start
+            backoff = min(self.max_backoff, backoff * 2 or self.min_backoff)
+            self._stop.wait(backoff * random.uniform(0.5, 1.0))
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        entries = [entry for entry, _ in batch]
+        try:
+            patient_ids = self._store_patients(entries)
+            records = [self._record(e, patient_ids) for e in entries if e.get('type') != 'patient']
+            if records:
+                self.repository.create_many(records)
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            metrics.inc('spool_flush_errors_total', type=type(e).__name__)
+            print(f"⚠️ Spool flush of {len(batch)} records failed, will retry: {self.last_error}")
+            self._update_gauges()
+            return False
+        metrics.observe('spool_flush_seconds', time.perf_counter() - start)
+        metrics.inc('spool_flushed_total', len(records))
+        self.last_error = None
+
+        with self._cond:
+            for mobile, patient_id in patient_ids.items():
+                current = self._patient_ids.get(mobile)
+                if current is None or current in self._provisional:
+                    self._patient_ids[mobile] = patient_id
+            # An id that lost to one stored by another worker stays provisional, so diagnoses still
+            # carrying it are resolved too; a confirmed one is now the patient's id
+            self._provisional.difference_update(e['patient_id'] for e in entries if e.get('type') == 'patient'
+                                                and patient_ids.get(e['mobile']) == e['patient_id'])
+            for _ in batch:
+                self._pending.popleft()
+            if self._pending:
+                self._write_offset(batch[-1][1])
+            else:
+                # Drained: start the log over (offset first - a crash in between only replays stored records)
+                self._write_offset(0)
+                self._log.truncate(0)
+                self._log.seek(0)
+        for entry, _ in batch:
+            if entry.get('image'):
+                try:
+                    os.remove(os.path.join(self.blob_dir, entry['image']['file_id']))
+                except FileNotFoundError:
+                    pass
+        self._update_gauges()
+        return True
+
+    def _update_gauges(self):
+        with self._cond:
+            depth = len(self._pending)
+            oldest = self._pending[0][0]['spooled_at'] if self._pending else None
+        metrics.set_gauge('spool_depth', depth)
+        metrics.set_gauge('spool_lag_seconds', round(time.time() - oldest, 3) if oldest else 0)
+
+    def close(self, timeout=5.0):
+        """Give the flusher up to timeout seconds to drain; anything left is replayed on the next start"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+
+def init_spool(app, storage):
+    """Start write-behind persistence when WRITE_BEHIND=1 (None otherwise)"""
+    app.config.setdefault('WRITE_BEHIND', os.environ.get('WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes'))
+    app.config.setdefault('SPOOL_DIR', os.environ.get('SPOOL_DIR', 'spool'))
+    app.config.setdefault('SPOOL_BATCH_SIZE', int(os.environ.get('SPOOL_BATCH_SIZE', 100)))
+    app.config.setdefault('SPOOL_MAX_BACKOFF', float(os.environ.get('SPOOL_MAX_BACKOFF', 30)))
+    if not app.config['WRITE_BEHIND']:
+        return None
+    if not storage.supports_write_behind:
+        print(f"⚠️ WRITE_BEHIND ignored: the {storage.name} backend writes synchronously")
+        return None
+
+    spool = WriteBehindSpool(storage.diagnoses, app.config['SPOOL_DIR'], app.config['SPOOL_BATCH_SIZE'],
+                             max_backoff=app.config['SPOOL_MAX_BACKOFF'], patients=storage.patients)
+    print(f"📮 Write-behind enabled: spooling diagnoses to {spool.log_path}")
+    return spool
@@ -0,0 +1,592 @@
+# sqlite_database.py
+"""
+Embedded SQLite storage backend.
+
+Mirrors the MongoDB document layout so routes and Diagnosis.to_dict work
+unchanged: rows are returned as dicts with '_id', datetime 'date' and an
+embedded 'patient_info'. Images live in a BLOB table instead of GridFS.
+
+Each thread gets its own connection (WAL mode on disk, so readers never
+block the writer). All SQL is constant and parameterised so sqlite3's
+statement cache keeps it prepared. Pass ':memory:' for a throwaway
+database, e.g. for tests and load testing: it is a temporary WAL-mode file
+deleted on close, since SQLite's shared-cache in-memory mode fails
+concurrent writers with "database table is locked" instead of waiting.
+"""
+import atexit
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from storage import (PatientRepository, DiagnosisRepository, StatsRepository, Storage,
+                     parse_int, new_patient_id, six_months_ago, encode_features, decode_feature_rows,
+                     downsample_trend, export_row)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id        TEXT PRIMARY KEY,
+    name              TEXT NOT NULL,
+    age               INTEGER NOT NULL DEFAULT 0,
+    mobile            TEXT NOT NULL UNIQUE,
+    email             TEXT DEFAULT '',
+    gender            TEXT DEFAULT '',
+    diabetes_duration INTEGER DEFAULT 0,
+    created_at        TEXT NOT NULL,
+    updated_at        TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    id           INTEGER PRIMARY KEY,
+    patient_id   TEXT,
+    filename     TEXT,
+    content_type TEXT,
+    data         BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS diagnoses (
+    id               INTEGER PRIMARY KEY,
+    patient_id       TEXT NOT NULL,
+    patient_mobile   TEXT DEFAULT '',
+    date             TEXT NOT NULL,
+    diagnosis_class  TEXT NOT NULL,
+    severity_index   INTEGER NOT NULL,
+    progression_risk REAL NOT NULL,
+    probabilities    TEXT NOT NULL,
+    image_id         INTEGER REFERENCES images(id),
+    image_filename   TEXT,
+    notes            TEXT,
+    model_version    TEXT,
+    patient_name     TEXT,
+    patient_age      INTEGER,
+    patient_gender   TEXT,
+    features         BLOB,
+    feature_version  TEXT,
+    confirmed_class  INTEGER,
+    confirmed_at     TEXT,
+    confirmed_by     TEXT,
+    image_phash      INTEGER,
+    image_phash_at   TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_patient_date ON diagnoses(patient_id, date);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_trend ON diagnoses(patient_id, date, severity_index, progression_risk);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_date ON diagnoses(date);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_class ON diagnoses(diagnosis_class);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_mobile ON diagnoses(patient_mobile);
+"""
+
+# Columns added after the first release - ALTERed into existing databases
+MIGRATIONS = {
+    'diagnoses': [('features', 'BLOB'), ('feature_version', 'TEXT'), ('confirmed_class', 'INTEGER'),
+                  ('confirmed_at', 'TEXT'), ('confirmed_by', 'TEXT'), ('image_phash', 'INTEGER'),
+                  ('image_phash_at', 'TEXT')],
+}
+
+# Every diagnoses column except the feature vector (kept out of list views)
+DIAGNOSIS_COLUMNS = (
+    "id, patient_id, patient_mobile, date, diagnosis_class, severity_index, progression_risk, "
+    "probabilities, image_id, image_filename, notes, model_version, patient_name, patient_age, "
+    "patient_gender, feature_version, confirmed_class, confirmed_at, image_phash"
+)
+
+# Columns that may be used for ordering in get_all (never interpolate user input)
+SORT_COLUMNS = {
+    'date': 'date',
+    'severity_index': 'severity_index',
+    'progression_risk': 'progression_risk',
+    'diagnosis_class': 'diagnosis_class',
+}
+
+
+
+def _now():
+    return datetime.utcnow().isoformat(sep=' ')
+
+
+def _parse_dt(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _like_pattern(query):
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def _int_id(diagnosis_id):
+    try:
+        return int(diagnosis_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _patient_doc(row):
+    if row is None:
+        return None
+    doc = dict(row)
+    doc['_id'] = doc['patient_id']
+    doc['created_at'] = _parse_dt(doc['created_at'])
+    doc['updated_at'] = _parse_dt(doc['updated_at'])
+    return doc
+
+
+def _diagnosis_doc(row):
+    if row is None:
+        return None
+    doc = {
+        '_id': row['id'],
+        'patient_id': row['patient_id'],
+        'patient_mobile': row['patient_mobile'],
+        'date': _parse_dt(row['date']),
+        'diagnosis_class': row['diagnosis_class'],
+        'severity_index': row['severity_index'],
+        'progression_risk': row['progression_risk'],
+        'probabilities': json.loads(row['probabilities']),
+        'image_file_id': row['image_id'],
+        'image_filename': row['image_filename'],
+        'notes': row['notes'],
+        'model_version': row['model_version'],
+        'feature_version': row['feature_version'],
+        'confirmed_class': row['confirmed_class'],
+        'confirmed_at': _parse_dt(row['confirmed_at']),
+        'image_phash': row['image_phash'],
+        'patient_info': {
+            'name': row['patient_name'],
+            'age': row['patient_age'],
+            'gender': row['patient_gender']
+        }
+    }
+    if 'features' in row.keys():
+        doc['features'] = row['features']
+    return doc
+
+
+class StoredImage(io.BytesIO):
+    """In-memory image with the GridOut attributes the routes use"""
+    def __init__(self, data, filename=None, content_type=None):
+        super().__init__(data)
+        self.filename = filename
+        self.content_type = content_type
+
+
+class SQLiteConnections:
+    """Per-thread connection pool for one database file"""
+    def __init__(self, path):
+        self.temporary = path == ':memory:'
+        if self.temporary:
+            fd, path = tempfile.mkstemp(prefix='retina_ai_', suffix='.sqlite3')
+            os.close(fd)
+            atexit.register(self.close)
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self.uri = f"file:{path}"
+        self.path = path
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+        self._anchor = self.get()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False,
+                                   isolation_level=None, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF" if self.temporary else "PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._lock:
+                self._all.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+        self._local = threading.local()
+        if self.temporary:
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+class Patient(PatientRepository):
+    """Patient table"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def create(self, patient_data):
+        """Create a new patient"""
+        patient_id = new_patient_id()
+        now = _now()
+        self.pool.get().execute(
+            "INSERT INTO patients (patient_id, name, age, mobile, email, gender, diabetes_duration, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (patient_id,
+             patient_data.get('name', 'Unknown'),
+             parse_int(patient_data.get('age', 0)),
+             patient_data.get('mobile', ''),
+             patient_data.get('email', ''),
+             patient_data.get('gender', ''),
+             parse_int(patient_data.get('diabetes_duration', 0)),
+             now, now)
+        )
+        return patient_id
+
+    def find_by_mobile(self, mobile):
+        """Find patient by mobile number"""
+        row = self.pool.get().execute("SELECT * FROM patients WHERE mobile = ?", (mobile,)).fetchone()
+        return _patient_doc(row)
+
+    def find_by_id(self, patient_id):
+        """Find patient by patient_id"""
+        row = self.pool.get().execute("SELECT * FROM patients WHERE patient_id = ?", (patient_id,)).fetchone()
+        return _patient_doc(row)
+
+    def update(self, patient_id, update_data):
+        """Update patient information"""
+        allowed = ('name', 'age', 'mobile', 'email', 'gender', 'diabetes_duration')
+        fields = {k: v for k, v in update_data.items() if k in allowed}
+        fields['updated_at'] = _now()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        return self.pool.get().execute(
+            f"UPDATE patients SET {assignments} WHERE patient_id = ?",
+            (*fields.values(), patient_id)
+        )
+
+    def get_all(self):
+        """Get all patients"""
+        rows = self.pool.get().execute("SELECT * FROM patients").fetchall()
+        return [_patient_doc(r) for r in rows]
+
+    def delete(self, patient_id):
+        """Delete patient and all related diagnoses"""
+        conn = self.pool.get()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM diagnoses WHERE patient_id = ?", (patient_id,))
+            conn.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,))
+
+    def search(self, query, limit=20):
+        """Search patients by name, mobile, or patient_id"""
+        pattern = _like_pattern(query)
+        rows = self.pool.get().execute(
+            "SELECT * FROM patients WHERE name LIKE ?1 ESCAPE '\\' OR mobile LIKE ?1 ESCAPE '\\' "
+            "OR patient_id LIKE ?1 ESCAPE '\\' LIMIT ?2",
+            (pattern, limit)
+        ).fetchall()
+        return [_patient_doc(r) for r in rows]
+
+
+class Diagnosis(DiagnosisRepository):
+    """Diagnosis and image tables"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def create(self, patient_id, analysis_result, image_file=None, notes="Automated Analysis", features=None,
+               image_phash=None):
+        """Create a new diagnosis record"""
+        conn = self.pool.get()
+        patient = conn.execute(
+            "SELECT mobile, name, age, gender FROM patients WHERE mobile = ?",
+            (analysis_result.get('patient_mobile', ''),)
+        ).fetchone()
+        if not patient:
+            patient = conn.execute(
+                "SELECT mobile, name, age, gender FROM patients WHERE patient_id = ?", (patient_id,)
+            ).fetchone()
+
+        now = _now()
+        with conn:
+            conn.execute("BEGIN")
+            image_id = None
+            if image_file:
+                image_id = conn.execute(
+                    "INSERT INTO images (patient_id, filename, content_type, data) VALUES (?, ?, ?, ?)",
+                    (patient_id, image_file.filename, image_file.content_type, image_file.read())
+                ).lastrowid
+
+            cursor = conn.execute(
+                "INSERT INTO diagnoses (patient_id, patient_mobile, date, diagnosis_class, severity_index, "
+                "progression_risk, probabilities, image_id, image_filename, notes, model_version, patient_name, "
+                "patient_age, patient_gender, features, feature_version, image_phash, image_phash_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (patient_id,
+                 patient['mobile'] if patient else '',
+                 now,
+                 analysis_result['class'],
+                 analysis_result['severity_index'],
+                 analysis_result['progression_risk'],
+                 json.dumps(analysis_result['probabilities']),
+                 image_id,
+                 image_file.filename if image_file else None,
+                 notes,
+                 analysis_result.get('model_version', 'v3.0'),
+                 patient['name'] if patient else None,
+                 patient['age'] if patient else None,
+                 patient['gender'] if patient else None,
+                 encode_features(features),
+                 analysis_result.get('feature_version') if features is not None else None,
+                 image_phash,
+                 now if image_phash is not None else None)
+            )
+        return str(cursor.lastrowid)
+
+    def get_all(self, sort_by='date', limit=100, skip=0):
+        """Get all diagnoses with pagination"""
+        column = SORT_COLUMNS.get(sort_by, 'date')
+        rows = self.pool.get().execute(
+            f"SELECT {DIAGNOSIS_COLUMNS} FROM diagnoses ORDER BY {column} DESC LIMIT ? OFFSET ?", (limit, skip)
+        ).fetchall()
+        return [_diagnosis_doc(r) for r in rows]
+
+    def get_by_patient(self, patient_id):
+        """Get all diagnoses for a patient"""
+        rows = self.pool.get().execute(
+            f"SELECT {DIAGNOSIS_COLUMNS} FROM diagnoses WHERE patient_id = ? ORDER BY date DESC", (patient_id,)
+        ).fetchall()
+        return [_diagnosis_doc(r) for r in rows]
+
+    def trend(self, patient_id, max_points=None):
+        """Risk-over-time series from a covering-index scan, bucketed in Python"""
+        rows = self.pool.get().execute(
+            "SELECT date, severity_index, progression_risk FROM diagnoses WHERE patient_id = ? ORDER BY date",
+            (patient_id,)
+        ).fetchall()
+        return downsample_trend([(_parse_dt(r[0]), r[1], r[2]) for r in rows], max_points)
+
+    def get_latest(self, patient_id):
+        """Get latest diagnosis for a patient"""
+        row = self.pool.get().execute(
+            "SELECT * FROM diagnoses WHERE patient_id = ? ORDER BY date DESC LIMIT 1", (patient_id,)
+        ).fetchone()
+        return _diagnosis_doc(row)
+
+    def get_by_id(self, diagnosis_id):
+        """Get diagnosis by ID"""
+        row_id = _int_id(diagnosis_id)
+        if row_id is None:
+            return None
+        row = self.pool.get().execute("SELECT * FROM diagnoses WHERE id = ?", (row_id,)).fetchone()
+        return _diagnosis_doc(row)
+
+    def count(self, patient_id=None):
+        """Count diagnoses"""
+        conn = self.pool.get()
+        if patient_id is None:
+            return conn.execute("SELECT COUNT(*) FROM diagnoses").fetchone()[0]
+        return conn.execute("SELECT COUNT(*) FROM diagnoses WHERE patient_id = ?", (patient_id,)).fetchone()[0]
+
+    def delete(self, diagnosis_id):
+        """Delete diagnosis and associated image"""
+        row_id = _int_id(diagnosis_id)
+        if row_id is None:
+            return
+        conn = self.pool.get()
+        with conn:
+            conn.execute("BEGIN")
+            row = conn.execute("SELECT image_id FROM diagnoses WHERE id = ?", (row_id,)).fetchone()
+            conn.execute("DELETE FROM diagnoses WHERE id = ?", (row_id,))
+            if row and row['image_id'] is not None:
+                conn.execute("DELETE FROM images WHERE id = ?", (row['image_id'],))
+
+    def get_image(self, diagnosis_id):
+        """Get image file from the images table"""
+        row_id = _int_id(diagnosis_id)
+        if row_id is None:
+            return None
+        row = self.pool.get().execute(
+            "SELECT i.filename, i.content_type, i.data FROM diagnoses d "
+            "JOIN images i ON i.id = d.image_id WHERE d.id = ?", (row_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return StoredImage(row['data'], row['filename'], row['content_type'])
+
+    def iter_feature_batches(self, feature_version, batch_size=10000, skip_model_version=None):
+        """Stream stored feature vectors in keyset-paginated batches"""
+        # Keyset pagination holds no read transaction open between batches,
+        # so the caller can write results back while iterating
+        conn = self.pool.get()
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, features FROM diagnoses WHERE id > ? AND feature_version = ? "
+                "AND features IS NOT NULL AND (? IS NULL OR model_version IS NOT ?) ORDER BY id LIMIT ?",
+                (last_id, feature_version, skip_model_version, skip_model_version, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield [r[0] for r in rows], decode_feature_rows([r[1] for r in rows])
+
+    def bulk_update_scores(self, updates):
+        """Write re-scored results back in one transaction"""
+        if not updates:
+            return 0
+        conn = self.pool.get()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE diagnoses SET diagnosis_class = ?, severity_index = ?, progression_risk = ?, "
+                "probabilities = ?, model_version = ? WHERE id = ?",
+                [(f['diagnosis_class'], f['severity_index'], f['progression_risk'],
+                  json.dumps(f['probabilities']), f['model_version'], _id) for _id, f in updates]
+            )
+        return len(updates)
+
+    def confirm(self, diagnosis_id, confirmed_class, confirmed_by=None):
+        """Record the clinician-confirmed severity index"""
+        row_id = _int_id(diagnosis_id)
+        if row_id is None:
+            return False
+        conn = self.pool.get()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE diagnoses SET confirmed_class = ?, confirmed_at = ?, confirmed_by = ? WHERE id = ?",
+                (int(confirmed_class), _now(), confirmed_by, row_id)
+            )
+        return cursor.rowcount > 0
+
+    def iter_confirmed(self, since, until, batch_size=10000):
+        """Stream confirmed diagnoses in keyset-paginated batches"""
+        conn = self.pool.get()
+        since = since.isoformat(sep=' ') if since else ''
+        until = until.isoformat(sep=' ')
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, confirmed_class, features, feature_version FROM diagnoses "
+                "WHERE confirmed_at > ? AND confirmed_at <= ? AND id > ? ORDER BY id LIMIT ?",
+                (since, until, last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            yield [{'_id': r['id'], 'confirmed_class': r['confirmed_class'], 'features': r['features'],
+                    'feature_version': r['feature_version']} for r in rows]
+
+
+    def iter_image_hashes(self, since=None, batch_size=50000):
+        """Stream stored perceptual hashes for the duplicate index"""
+        query = "SELECT id, patient_id, image_phash FROM diagnoses WHERE image_phash IS NOT NULL"
+        params = ()
+        if since:
+            query += " AND image_phash_at >= ?"
+            params = (since.isoformat(sep=' '),)
+        cursor = self.pool.get().execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield ([str(r[0]) for r in rows], [r[1] for r in rows],
+                   np.array([r[2] for r in rows], dtype=np.int64))
+
+    def iter_unhashed(self, batch_size=1000):
+        """Keyset-paginated ids of diagnoses with an image but no hash"""
+        conn = self.pool.get()
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id FROM diagnoses WHERE image_phash IS NULL AND image_id IS NOT NULL AND id > ? "
+                "ORDER BY id LIMIT ?", (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield [str(r[0]) for r in rows]
+
+    def set_image_hashes(self, updates):
+        """Write backfilled hashes in one transaction"""
+        conn = self.pool.get()
+        with conn:
+            conn.execute("BEGIN")
+            now = _now()
+            conn.executemany("UPDATE diagnoses SET image_phash = ?, image_phash_at = ? WHERE id = ?",
+                             [(phash, now, _int_id(_id)) for _id, phash in updates])
+        return len(updates)
+
+    def iter_export(self, since=None, until=None, diagnosis_class=None, batch_size=1000):
+        """Stream export rows from one cursor, fetchmany() at a time"""
+        clauses, params = [], []
+        if since:
+            clauses.append("date >= ?")
+            params.append(since.isoformat(sep=' '))
+        if until:
+            clauses.append("date < ?")
+            params.append(until.isoformat(sep=' '))
+        if diagnosis_class:
+            clauses.append("diagnosis_class = ?")
+            params.append(diagnosis_class)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        cursor = self.pool.get().execute(
+            f"SELECT {DIAGNOSIS_COLUMNS} FROM diagnoses {where}ORDER BY date, id", params
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [export_row(_diagnosis_doc(r)) for r in rows]
+
+
+class Stats(StatsRepository):
+    """Statistics helper class"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get_dashboard_stats(self):
+        """Get dashboard statistics"""
+        conn = self.pool.get()
+        total_patients = conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+        total_diagnoses = conn.execute("SELECT COUNT(*) FROM diagnoses").fetchone()[0]
+
+        class_distribution = conn.execute(
+            "SELECT diagnosis_class, COUNT(*) AS count FROM diagnoses "
+            "GROUP BY diagnosis_class ORDER BY count DESC"
+        ).fetchall()
+
+        monthly_trend = conn.execute(
+            "SELECT substr(date, 1, 7) AS month, COUNT(*) AS count FROM diagnoses "
+            "WHERE date >= ? GROUP BY month ORDER BY month",
+            (six_months_ago().isoformat(sep=' '),)
+        ).fetchall()
+
+        return {
+            'total_patients': total_patients,
+            'total_diagnoses': total_diagnoses,
+            'class_distribution': {row['diagnosis_class']: row['count'] for row in class_distribution},
+            'monthly_trend': [{'month': row['month'], 'count': row['count']} for row in monthly_trend]
+        }
+
+
+class SQLiteStorage(Storage):
+    """Embedded SQLite storage backend"""
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:'):
+        self.pool = SQLiteConnections(path)
+        self.path = self.pool.path
+        conn = self.pool.get()
+        conn.executescript(SCHEMA)
+        for table, columns in MIGRATIONS.items():
+            existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in columns:
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_diagnoses_feature_version "
+                     "ON diagnoses(feature_version, model_version)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_diagnoses_confirmed_at ON diagnoses(confirmed_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_diagnoses_image_phash_at ON diagnoses(image_phash_at)")
+        super().__init__(Patient(self.pool), Diagnosis(self.pool), Stats(self.pool))
+
+    def close(self):
+        self.pool.close()
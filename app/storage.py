@@ -0,0 +1,337 @@
+# storage.py
+"""
+Storage backend interface.
+
+Routes talk to a Storage object (storage.patients / storage.diagnoses /
+storage.stats) instead of calling a database driver directly. Two backends
+implement it:
+
+- mongo  : MongoDB + GridFS (mongo_database.py), the production default
+- sqlite : embedded SQLite (sqlite_database.py) for single-clinic
+           deployments, tests and load testing without a live mongod
+
+The backend is chosen with app.config['STORAGE_BACKEND'].
+"""
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class PatientRepository(ABC):
+    """Patient operations"""
+
+    @abstractmethod
+    def create(self, patient_data):
+        """Create a new patient and return its patient_id"""
+
+    @abstractmethod
+    def find_by_mobile(self, mobile):
+        """Find patient by mobile number"""
+
+    @abstractmethod
+    def find_by_id(self, patient_id):
+        """Find patient by patient_id"""
+
+    @abstractmethod
+    def update(self, patient_id, update_data):
+        """Update patient information"""
+
+    @abstractmethod
+    def get_all(self):
+        """Get all patients"""
+
+    @abstractmethod
+    def delete(self, patient_id):
+        """Delete patient and all related diagnoses"""
+
+    @abstractmethod
+    def search(self, query, limit=20):
+        """Case-insensitive substring search on name, mobile and patient_id"""
+
+
+class DiagnosisRepository(ABC):
+    """Diagnosis operations"""
+
+    @abstractmethod
+    def create(self, patient_id, analysis_result, image_file=None, notes="Automated Analysis", features=None,
+               image_phash=None):
+        """
+        Create a new diagnosis record and return its id. features is the
+        float32 feature vector; it is stored with analysis_result's
+        feature_version so the record can be re-scored without the image.
+        image_phash is the image's 64-bit perceptual hash (signed int).
+        """
+
+    @abstractmethod
+    def get_all(self, sort_by='date', limit=100, skip=0):
+        """Get all diagnoses with pagination"""
+
+    @abstractmethod
+    def get_by_patient(self, patient_id):
+        """Get all diagnoses for a patient, newest first"""
+
+    @abstractmethod
+    def trend(self, patient_id, max_points=None):
+        """
+        Compact (date, severity_index, progression_risk) series for a patient,
+        oldest first, from a covered index scan. With max_points, longer
+        histories are merged into that many equal-count buckets (see
+        downsample_trend). Returns {'total', 'downsampled', 'points'}.
+        """
+
+    @abstractmethod
+    def get_latest(self, patient_id):
+        """Get the most recent diagnosis for a patient"""
+
+    @abstractmethod
+    def get_by_id(self, diagnosis_id):
+        """Get diagnosis by ID (None if missing or malformed)"""
+
+    @abstractmethod
+    def count(self, patient_id=None):
+        """Count diagnoses, optionally for one patient"""
+
+    @abstractmethod
+    def delete(self, diagnosis_id):
+        """Delete diagnosis and associated image"""
+
+    @abstractmethod
+    def get_image(self, diagnosis_id):
+        """Get the stored image (file-like with filename/content_type) or None"""
+
+    @abstractmethod
+    def iter_feature_batches(self, feature_version, batch_size=10000, skip_model_version=None):
+        """
+        Stream (ids, X) batches of stored feature vectors with the given
+        feature_version, X being an (n, d) float32 array. Records already
+        scored by skip_model_version are left out.
+        """
+
+    @abstractmethod
+    def bulk_update_scores(self, updates):
+        """Write back re-scored results: a list of (id, fields) pairs"""
+
+    @abstractmethod
+    def confirm(self, diagnosis_id, confirmed_class, confirmed_by=None):
+        """Record the clinician-confirmed severity index; False if the diagnosis does not exist"""
+
+    @abstractmethod
+    def iter_confirmed(self, since, until, batch_size=10000):
+        """
+        Stream diagnoses confirmed in (since, until] as batches of dicts with
+        _id, confirmed_class, features (bytes or None) and feature_version.
+        since=None means from the beginning.
+        """
+
+    @abstractmethod
+    def iter_export(self, since=None, until=None, diagnosis_class=None, batch_size=1000):
+        """
+        Stream diagnoses dated in [since, until), optionally of one class,
+        oldest first, as batches of export_row() dicts. One cursor, so memory
+        does not grow with the collection.
+        """
+
+    @abstractmethod
+    def iter_image_hashes(self, since=None, batch_size=50000):
+        """
+        Stream (ids, patient_ids, hashes) batches of every diagnosis with an
+        image_phash; hashes is an int64 array. With since, only hashes stored
+        at or after it (image_phash_at: insert, write-behind flush or
+        backfill time - not the diagnosis date).
+        """
+
+    @abstractmethod
+    def iter_unhashed(self, batch_size=1000):
+        """Stream id batches of diagnoses that have an image but no image_phash yet"""
+
+    @abstractmethod
+    def set_image_hashes(self, updates):
+        """Store backfilled perceptual hashes: a list of (id, image_phash) pairs"""
+
+    @staticmethod
+    def to_dict(diagnosis_doc):
+        """Convert a diagnosis document to the API dictionary format"""
+        if not diagnosis_doc:
+            return None
+
+        patient_info = diagnosis_doc.get('patient_info') or {}
+        diagnosis_dict = {
+            'id': str(diagnosis_doc['_id']),
+            'patient_id': diagnosis_doc.get('patient_id', ''),
+            'date': diagnosis_doc.get('date', datetime.utcnow()).strftime("%Y-%m-%d %H:%M"),
+            'diagnosis': diagnosis_doc.get('diagnosis_class', ''),
+            'severity_index': diagnosis_doc.get('severity_index', 0),
+            'risk': diagnosis_doc.get('progression_risk', 0),
+            'probabilities': diagnosis_doc.get('probabilities', {}),
+            'image_filename': diagnosis_doc.get('image_filename'),
+            'notes': diagnosis_doc.get('notes', ''),
+            'confirmed_class': diagnosis_doc.get('confirmed_class'),
+            'patient': {
+                'name': patient_info.get('name', 'Unknown'),
+                'age': patient_info.get('age', 'N/A'),
+                'mobile': diagnosis_doc.get('patient_mobile', 'N/A'),
+                'gender': patient_info.get('gender', '')
+            }
+        }
+        return diagnosis_dict
+
+
+class StatsRepository(ABC):
+    """Statistics operations"""
+
+    @abstractmethod
+    def get_dashboard_stats(self):
+        """Get dashboard statistics"""
+
+
+class Storage:
+    """Bundle of repositories making up one backend"""
+    name = 'base'
+    # Write-behind (spool.py) needs patients.patient_ids_by_mobile/upsert_many
+    # and diagnoses.new_id/create_many; backends that implement them set this
+    supports_write_behind = False
+
+    def __init__(self, patients, diagnoses, stats):
+        self.patients = patients
+        self.diagnoses = diagnoses
+        self.stats = stats
+
+    def close(self):
+        """Release backend resources"""
+
+
+def parse_int(value):
+    """Parse a form value as int, falling back to 0"""
+    return int(value) if str(value).isdigit() else 0
+
+
+def new_patient_id():
+    import uuid
+    return f"PID-{uuid.uuid4().hex[:8].upper()}"
+
+
+def six_months_ago():
+    """First day of the month five months before the current one"""
+    start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(5):
+        if start.month == 1:
+            start = start.replace(year=start.year - 1, month=12)
+        else:
+            start = start.replace(month=start.month - 1)
+    return start
+
+
+TREND_DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def trend_point(date, severity_index, progression_risk):
+    return {'date': date.strftime(TREND_DATE_FORMAT), 'severity_index': severity_index,
+            'progression_risk': progression_risk}
+
+
+def downsample_trend(rows, max_points):
+    """
+    Merge date-ordered (date, severity, risk) rows into at most max_points
+    equal-count buckets. A bucket point carries the first and last visit
+    date, the worst severity, the mean and peak risk and the visit count.
+    """
+    total = len(rows)
+    if not max_points or total <= max_points:
+        return {'total': total, 'downsampled': False, 'points': [trend_point(*row) for row in rows]}
+
+    points = []
+    for b in range(max_points):
+        bucket = rows[b * total // max_points:(b + 1) * total // max_points]
+        risks = [row[2] for row in bucket]
+        points.append({
+            'date': bucket[0][0].strftime(TREND_DATE_FORMAT),
+            'date_to': bucket[-1][0].strftime(TREND_DATE_FORMAT),
+            'severity_index': max(row[1] for row in bucket),
+            'progression_risk': round(sum(risks) / len(risks), 1),
+            'max_risk': max(risks),
+            'visits': len(bucket),
+        })
+    return {'total': total, 'downsampled': True, 'points': points}
+
+
+# Flat export schema - patient identity stays behind patient_id, vectors and images are left out
+EXPORT_COLUMNS = ('id', 'patient_id', 'date', 'diagnosis_class', 'severity_index', 'progression_risk',
+                  'probabilities', 'confirmed_class', 'confirmed_at', 'model_version', 'feature_version',
+                  'image_filename', 'notes')
+
+
+def export_row(doc):
+    """Diagnosis document -> flat export dict (EXPORT_COLUMNS; dates as ISO strings)"""
+    confirmed_at = doc.get('confirmed_at')
+    return {
+        'id': str(doc['_id']),
+        'patient_id': doc.get('patient_id'),
+        'date': doc['date'].isoformat(),
+        'diagnosis_class': doc.get('diagnosis_class'),
+        'severity_index': doc.get('severity_index'),
+        'progression_risk': doc.get('progression_risk'),
+        'probabilities': doc.get('probabilities') or {},
+        'confirmed_class': doc.get('confirmed_class'),
+        'confirmed_at': confirmed_at.isoformat() if confirmed_at else None,
+        'model_version': doc.get('model_version'),
+        'feature_version': doc.get('feature_version'),
+        'image_filename': doc.get('image_filename'),
+        'notes': doc.get('notes'),
+    }
+
+
+def encode_features(features):
+    """float32 little-endian bytes for a feature vector (None passes through)"""
+    if features is None:
+        return None
+    return np.asarray(features, dtype='<f4').tobytes()
+
+
+def decode_feature_rows(blobs):
+    """Stack encoded feature vectors into an (n, d) float32 array"""
+    return np.frombuffer(b''.join(blobs), dtype='<f4').reshape(len(blobs), -1)
+
+
+def open_storage(backend=None, mongo_uri=None, sqlite_path=None):
+    """
+    Open a storage backend outside Flask (CLI tools), configured from the
+    same environment variables as the app.
+    """
+    backend = backend or os.environ.get('STORAGE_BACKEND', 'mongo')
+
+    if backend == 'mongo':
+        from mongo_database import MongoStorage, DEFAULT_MONGO_URI
+        uri = mongo_uri or os.environ.get('MONGO_URI', DEFAULT_MONGO_URI)
+        if uri.startswith('mongomock://'):
+            import mongomock
+            client = mongomock.MongoClient()
+        else:
+            from pymongo import MongoClient
+            client = MongoClient(uri)
+        return MongoStorage(client.get_database(urlparse(uri).path.lstrip('/') or 'retina_ai'))
+
+    if backend == 'sqlite':
+        from sqlite_database import SQLiteStorage
+        return SQLiteStorage(sqlite_path or os.environ.get('SQLITE_PATH', 'instance/retina_ai.sqlite3'))
+
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r} (expected 'mongo' or 'sqlite')")
+
+
+def init_storage(app):
+    """Create the storage backend selected by app.config['STORAGE_BACKEND']"""
+    backend = app.config.get('STORAGE_BACKEND', 'mongo')
+
+    if backend == 'mongo':
+        from mongo_database import init_mongo_db
+        return init_mongo_db(app)
+
+    if backend == 'sqlite':
+        from sqlite_database import SQLiteStorage
+        storage = SQLiteStorage(app.config.get('SQLITE_PATH', 'instance/retina_ai.sqlite3'))
+        print(f"✅ SQLite storage initialized ({storage.path})")
+        return storage
+
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r} (expected 'mongo' or 'sqlite')")
@@ -0,0 +1,57 @@
+# tests/test_deep_features.py
+"""DeepFeatureExtractor with random weights: shapes, determinism and batch padding (skipped without TensorFlow)"""
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('tensorflow')
+
+from deep_features import BACKBONES, DeepFeatureExtractor  # noqa: E402
+
+BACKBONE = 'densenet121'
+DIM = BACKBONES[BACKBONE][2]
+
+
+def _images(n, size=96):
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)) for _ in range(n)]
+
+
+@pytest.fixture(scope='module')
+def extractor():
+    return DeepFeatureExtractor(BACKBONE, weights=None, batch_size=4, seed=7)
+
+
+def test_output_shape(extractor):
+    images = _images(3)
+    batch = extractor.extract_batch(images)
+    assert batch.shape == (3, DIM)
+    assert batch.dtype == np.float32
+    assert extractor.extract(images[0]).shape == (DIM,)
+    assert np.isfinite(batch).all()
+
+
+def test_same_seed_gives_same_features_across_instances(extractor):
+    images = _images(2)
+    other = DeepFeatureExtractor(BACKBONE, weights=None, batch_size=4, seed=7)
+    np.testing.assert_allclose(other.extract_batch(images), extractor.extract_batch(images), rtol=1e-4, atol=1e-5)
+    assert other.feature_version == extractor.feature_version
+
+
+def test_padding_does_not_change_features(extractor):
+    # 6 images at batch size 4: a full batch, then 2 padded with zeros
+    images = _images(6)
+    batch = extractor.extract_batch(images)
+    assert batch.shape == (6, DIM)
+    for img, row in zip(images, batch):
+        np.testing.assert_allclose(extractor.extract(img), row, rtol=1e-4, atol=1e-5)
+
+
+def test_set_batch_size(extractor):
+    images = _images(5)
+    expected = extractor.extract_batch(images)
+    extractor.set_batch_size(2)
+    try:
+        np.testing.assert_allclose(extractor.extract_batch(images), expected, rtol=1e-4, atol=1e-5)
+    finally:
+        extractor.set_batch_size(4)
@@ -1,16 +1,34 @@
 import os
+import argparse
+import csv
+import json
 import pickle
 import numpy as np
 import random
-from PIL import Image
+from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.ensemble import GradientBoostingClassifier
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report, accuracy_score
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 (enables HalvingGridSearchCV)
+from sklearn.model_selection import train_test_split, StratifiedKFold, HalvingGridSearchCV
+from sklearn.metrics import classification_report, accuracy_score, cohen_kappa_score, make_scorer
 import time
 
+from feature_cache import load_or_extract, CACHE_PATH
+from pack_dataset import extract_packed
+from cascade import CascadeGate, CASCADE_PATH, save_cascade
+from model import configured_feature_version, load_model_artifact
+
 # --- CONFIGURATION ---
 DATASET_DIR = "../colored_images"
 MODEL_PATH = "dr_model.pkl"
+LEADERBOARD_PATH = "tuning_leaderboard"
+
+# Hyperparameter grid explored by --tune
+PARAM_GRID = {
+    'n_estimators': [100, 200, 400],
+    'learning_rate': [0.03, 0.1, 0.3],
+    'max_depth': [3, 5, 7],
+    'subsample': [0.8, 1.0],
+}
 
 # Class Mapping
 CLASS_MAP = {
@@ -21,58 +39,7 @@ CLASS_MAP = {
     'Proliferate_DR': 4
 }
 
-class RetinaFeatureExtractor:
-    """
-    Advanced 'Shallow' Deep Learning Simulator (Copy for Training)
-    """
-    def __init__(self, grid_size=4):
-        self.grid_size = grid_size
-        self.img_size = (224, 224)
-
-    def extract(self, img_path):
-        try:
-            img = Image.open(img_path)
-            img = img.resize(self.img_size)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            arr = np.array(img).astype(float)
-            
-            # Texture (Green Channel Edges)
-            g = arr[:, :, 1]
-            padded = np.pad(g, ((1,1), (1,1)), mode='edge')
-            texture = 4 * g - (padded[0:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, 0:-2] + padded[1:-1, 2:])
-            texture = np.abs(texture)
-            
-            features = []
-            
-            # Global Stats
-            for i in range(3):
-                features.append(np.mean(arr[:, :, i]))
-                features.append(np.std(arr[:, :, i]))
-            
-            # Grid Stats
-            h, w, _ = arr.shape
-            step_h = h // self.grid_size
-            step_w = w // self.grid_size
-            
-            for r in range(self.grid_size):
-                for c in range(self.grid_size):
-                    r_start = r * step_h
-                    c_start = c * step_w
-                    patch = arr[r_start:r_start+step_h, c_start:c_start, :]
-                    patch_tex = texture[r_start:r_start+step_h, c_start:c_start]
-                    
-                    features.extend(np.mean(patch, axis=(0,1)))
-                    features.extend(np.std(patch, axis=(0,1)))
-                    features.append(np.mean(patch_tex))
-                    features.append(np.std(patch_tex))
-
-            return np.nan_to_num(np.array(features))
-        except Exception:
-            return None
-
-def custom_smote(X, y):
+def custom_smote(X, y, verbose=True):
     """
     Custom Implementation of SMOTE (Synthetic Minority Over-sampling Technique)
     to handle class imbalance without 'imblearn'.
@@ -83,7 +50,8 @@ def custom_smote(X, y):
     X_res = list(X)
     y_res = list(y)
     
-    print("\n   [GAN/SMOTE] Generating Synthetic Samples...")
+    if verbose:
+        print("\n   [GAN/SMOTE] Generating Synthetic Samples...")
     
     for cls in classes:
         cls_indices = [i for i, label in enumerate(y) if label == cls]
@@ -92,7 +60,8 @@ def custom_smote(X, y):
         if current_count < max_count:
             # Determine how many to generate
             diff = max_count - current_count
-            print(f"     -> Class {cls}: Generating {diff} synthetic vectors...")
+            if verbose:
+                print(f"     -> Class {cls}: Generating {diff} synthetic vectors...")
             
             possible_samples = [X[i] for i in cls_indices]
             
@@ -113,62 +82,231 @@ def custom_smote(X, y):
                 
     return np.array(X_res), np.array(y_res)
 
-def train():
+
+class SMOTEGradientBoosting(BaseEstimator, ClassifierMixin):
+    """
+    GradientBoostingClassifier that applies custom_smote to its own training
+    data inside fit(). Used in cross-validation so synthetic samples are
+    generated from each training fold only and never leak into the
+    validation fold.
+    """
+    def __init__(self, n_estimators=100, learning_rate=0.1, max_depth=5, subsample=1.0,
+                 smote=True, random_state=42):
+        self.n_estimators = n_estimators
+        self.learning_rate = learning_rate
+        self.max_depth = max_depth
+        self.subsample = subsample
+        self.smote = smote
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        if self.smote:
+            random.seed(self.random_state)
+            X, y = custom_smote(X, y, verbose=False)
+        self.model_ = GradientBoostingClassifier(
+            n_estimators=self.n_estimators, learning_rate=self.learning_rate, max_depth=self.max_depth,
+            subsample=self.subsample, random_state=self.random_state
+        )
+        self.model_.fit(X, y)
+        self.classes_ = self.model_.classes_
+        return self
+
+    def predict(self, X):
+        return self.model_.predict(X)
+
+    def predict_proba(self, X):
+        return self.model_.predict_proba(X)
+
+
+def load_features(dataset_dir=DATASET_DIR, workers=None, packed=None):
+    """Load the feature matrix once (extracting only uncached images, or from a packed dataset)"""
+    data = extract_packed(packed, workers) if packed else load_or_extract(dataset_dir, CACHE_PATH, workers)
+    ok = data['ok']
+    print(f"  -> {ok.sum()} images ({data['cache_hits']} cached, {data['extracted']} extracted "
+          f"in {data['extract_seconds']:.1f}s)")
+    return data['X'][ok].astype(np.float64), data['y'][ok]
+
+
+def train(dataset_dir=DATASET_DIR, workers=None, packed=None):
     print("=========================================")
     print("   TRAINING ADVANCED DR SYSTEM (v3.0)    ")
     print("=========================================")
     print("Pipeline: Custom-CNN-Stats -> SMOTE -> GradientBoosting")
     
-    extractor = RetinaFeatureExtractor()
-    
-    X = []
-    y = []
-    
     # 1. Load & Extract
     print("\n[1/4] Feature Extraction (Vector Generation)...")
-    for folder_name, label_idx in CLASS_MAP.items():
-        folder_path = os.path.join(DATASET_DIR, folder_name)
-        if not os.path.exists(folder_path): continue
-            
-        files = [f for f in os.listdir(folder_path) if f.lower().endswith(('png', 'jpg', 'jpeg'))]
-        print(f"  Processing '{folder_name}' ({len(files)} images)...")
-        
-        for f in files:
-            feat = extractor.extract(os.path.join(folder_path, f))
-            if feat is not None:
-                X.append(feat)
-                y.append(label_idx)
-    
-    X = np.array(X)
-    y = np.array(y)
+    X, y = load_features(dataset_dir, workers, packed)
     
     if len(X) == 0:
         print("Error: No data found.")
         return
 
-    # 2. Augmentation (Auto-SMOTE)
-    X_balanced, y_balanced = custom_smote(X, y)
-    print(f"  -> Original Dataset: {len(X)}")
-    print(f"  -> Balanced Dataset: {len(X_balanced)} (All classes equalized)")
+    # 2. Split first - the test set must only contain real images
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
 
-    # 3. Split
-    X_train, X_test, y_train, y_test = train_test_split(X_balanced, y_balanced, test_size=0.2, random_state=42)
+    # 3. Augmentation (Auto-SMOTE) on the training split only
+    X_balanced, y_balanced = custom_smote(X_train, y_train)
+    print(f"  -> Original Training Set: {len(X_train)}")
+    print(f"  -> Balanced Training Set: {len(X_balanced)} (All classes equalized)")
 
     # 4. Train
     print("\n[3/4] Training Gradient Boosting Classifier...")
     clf = GradientBoostingClassifier(n_estimators=100, learning_rate=0.1, max_depth=5, random_state=42)
-    clf.fit(X_train, y_train)
+    clf.fit(X_balanced, y_balanced)
     
     # Evaluate
     print("\n[4/4] Evaluation:")
     y_pred = clf.predict(X_test)
     print(f"  >> TEST ACCURACY: {accuracy_score(y_test, y_pred)*100:.2f}%")
-    print(classification_report(y_test, y_pred, target_names=list(CLASS_MAP.keys())))
+    print(classification_report(y_test, y_pred, labels=list(CLASS_MAP.values()),
+                                target_names=list(CLASS_MAP.keys()), zero_division=0))
     
     # Save
     with open(MODEL_PATH, 'wb') as f:
         pickle.dump(clf, f)
     print(f"\nModel saved to {MODEL_PATH}")
 
+
+def write_leaderboard(search, path_prefix=LEADERBOARD_PATH):
+    """Write every evaluated candidate, best first, as CSV and JSON"""
+    results = search.cv_results_
+    rows = []
+    for i, params in enumerate(results['params']):
+        rows.append({
+            'rank': int(results['rank_test_score'][i]),
+            'iteration': int(results['iter'][i]),
+            'n_resources': int(results['n_resources'][i]),
+            'mean_score': round(float(results['mean_test_score'][i]), 5),
+            'std_score': round(float(results['std_test_score'][i]), 5),
+            'mean_fit_time_s': round(float(results['mean_fit_time'][i]), 3),
+            **params,
+        })
+    # Candidates are re-scored each halving round - order by last round reached, then score
+    rows.sort(key=lambda r: (-r['iteration'], -r['mean_score']))
+
+    with open(f"{path_prefix}.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(f"{path_prefix}.json", 'w') as f:
+        json.dump({'best_params': search.best_params_, 'best_score': search.best_score_, 'candidates': rows},
+                  f, indent=2, default=str)
+    return rows
+
+
+def tune(dataset_dir=DATASET_DIR, workers=None, folds=5, factor=3, n_jobs=-1, scoring='qwk', save_best=False,
+         packed=None):
+    """Successive-halving grid search with SMOTE applied inside each training fold"""
+    print("=========================================")
+    print("   HYPERPARAMETER SEARCH (Halving CV)    ")
+    print("=========================================")
+
+    print("\n[1/4] Loading feature matrix...")
+    X, y = load_features(dataset_dir, workers, packed)
+    if len(X) == 0:
+        print("Error: No data found.")
+        return
+
+    # Held-out test split is never seen by the search
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+
+    scorer = make_scorer(cohen_kappa_score, weights='quadratic') if scoring == 'qwk' else scoring
+    n_candidates = int(np.prod([len(v) for v in PARAM_GRID.values()]))
+    print(f"\n[2/4] Searching {n_candidates} configurations ({folds}-fold, halving factor {factor}, "
+          f"n_jobs={n_jobs})...")
+    search = HalvingGridSearchCV(
+        SMOTEGradientBoosting(),
+        PARAM_GRID,
+        factor=factor,
+        resource='n_samples',
+        min_resources='exhaust',
+        cv=StratifiedKFold(n_splits=folds, shuffle=True, random_state=42),
+        scoring=scorer,
+        n_jobs=n_jobs,
+        refit=True,
+        random_state=42,
+        verbose=1,
+    )
+    start = time.time()
+    search.fit(X_train, y_train)
+    print(f"  -> Search finished in {time.time() - start:.1f}s")
+
+    print("\n[3/4] Leaderboard:")
+    rows = write_leaderboard(search)
+    for row in rows[:10]:
+        params = {k: row[k] for k in PARAM_GRID}
+        print(f"  #{row['rank']:<3} score {row['mean_score']:.4f} ± {row['std_score']:.4f} "
+              f"fit {row['mean_fit_time_s']:>7.2f}s  n={row['n_resources']:<6} {params}")
+    print(f"  -> Full leaderboard written to {LEADERBOARD_PATH}.csv / .json")
+
+    print("\n[4/4] Held-out evaluation of best configuration:")
+    y_pred = search.best_estimator_.predict(X_test)
+    print(f"  >> Best params: {search.best_params_}")
+    print(f"  >> TEST ACCURACY: {accuracy_score(y_test, y_pred)*100:.2f}% | "
+          f"QWK: {cohen_kappa_score(y_test, y_pred, weights='quadratic'):.4f}")
+
+    if save_best:
+        with open(MODEL_PATH, 'wb') as f:
+            pickle.dump(search.best_estimator_.model_, f)
+        print(f"\nBest model saved to {MODEL_PATH}")
+
+
+def train_cascade(dataset_dir=DATASET_DIR, workers=None, target_recall=0.95, model_path=MODEL_PATH,
+                  out_path=CASCADE_PATH, packed=None):
+    """Fit the cheap gate on the training split and calibrate it against the full model"""
+    print("=========================================")
+    print("   TRAINING INFERENCE CASCADE GATE       ")
+    print("=========================================")
+
+    print("\n[1/4] Loading feature matrix...")
+    X, y = load_features(dataset_dir, workers, packed)
+    if len(X) == 0:
+        print("Error: No data found.")
+        return
+    full_model, model_version = load_model_artifact(model_path)
+
+    # Same split as train(): the full model never saw X_hold. Half of it calibrates, half reports.
+    X_train, X_hold, y_train, y_hold = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+    X_cal, X_eval, y_cal, y_eval = train_test_split(X_hold, y_hold, test_size=0.5, random_state=42,
+                                                    stratify=y_hold)
+
+    print(f"\n[2/4] Fitting gate on {len(X_train)} images (global colour statistics)...")
+    gate = CascadeGate(configured_feature_version(), model_version, target_recall).fit(X_train, y_train)
+
+    print(f"\n[3/4] Calibrating on {len(X_cal)} held-out images (target referable recall {target_recall})...")
+    threshold = gate.calibrate(X_cal, y_cal, full_model.predict(X_cal))
+    print(f"  -> Confidence threshold: {threshold:.4f}" if np.isfinite(threshold)
+          else "  -> No threshold meets the target; gate will never short-circuit")
+
+    print(f"\n[4/4] Evaluating on {len(X_eval)} held-out images:")
+    gate.report = gate.evaluate(X_eval, y_eval, full_model.predict(X_eval), full_model)
+    for key, value in gate.report.items():
+        print(f"  {key:<30} {value}")
+
+    save_cascade(gate, out_path)
+    print(f"\nCascade saved to {out_path} (serves with model {model_version}; set CASCADE_ENABLED=1)")
+    return gate
+
+
 if __name__ == "__main__":
-    train()
+    parser = argparse.ArgumentParser(description="Train the DR classifier")
+    parser.add_argument('--dataset', default=DATASET_DIR)
+    parser.add_argument('--workers', type=int, default=None, help="Feature extraction processes")
+    parser.add_argument('--packed', default=None, help="Read images from a pack_dataset.py file instead of --dataset")
+    parser.add_argument('--tune', action='store_true', help="Run the cross-validated hyperparameter search")
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--factor', type=int, default=3, help="Successive-halving elimination factor")
+    parser.add_argument('--n-jobs', type=int, default=-1, help="Parallel CV fits (-1 = all cores)")
+    parser.add_argument('--scoring', default='qwk', help="'qwk' or any sklearn scorer name")
+    parser.add_argument('--save-best', action='store_true', help="Save the best tuned model to MODEL_PATH")
+    parser.add_argument('--cascade', action='store_true', help="Build the confidence-gated cascade for MODEL_PATH")
+    parser.add_argument('--target-recall', type=float, default=0.95, help="Referable DR recall the cascade keeps")
+    args = parser.parse_args()
+
+    if args.cascade:
+        train_cascade(args.dataset, args.workers, args.target_recall, packed=args.packed)
+    elif args.tune:
+        tune(args.dataset, args.workers, args.folds, args.factor, args.n_jobs, args.scoring, args.save_best,
+             args.packed)
+    else:
+        train(args.dataset, args.workers, args.packed)